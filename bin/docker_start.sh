@@ -11,7 +11,7 @@ fixtures_dir=${FIXTURES_DIR:-/app/fixtures}
 
 uwsgi_port=${UWSGI_PORT:-8000}
 uwsgi_processes=${UWSGI_PROCESSES:-4}
-uwsgi_threads=${UWSGI_THREADS:-1}
+uwsgi_threads=${UWSGI_THREADS:-8}
 
 until pg_isready; do
   >&2 echo "Waiting for database connection..."
@@ -38,4 +38,6 @@ uwsgi \
     --threads $uwsgi_threads \
     --post-buffering=8192 \
     --buffer-size=65535
-    # processes & threads are needed for concurrency without nginx sitting inbetween
+    # processes & threads are needed for concurrency without nginx sitting inbetween.
+    # Requests mostly wait on the DRC, so each process serves several requests
+    # at once with threads.
@@ -1,9 +1,15 @@
 from rest_framework.exceptions import APIException
 
-from dowc.core.constants import DOCUMENT_COULD_NOT_BE_UPDATED
+from dowc.core.constants import DOCUMENT_COULD_NOT_BE_UPDATED, DRC_UNAVAILABLE
 
 
 class UpdateException(APIException):
     status_code = 500
     default_detail = DOCUMENT_COULD_NOT_BE_UPDATED
     default_code = "update_error"
+
+
+class DRCUnavailable(APIException):
+    status_code = 503
+    default_detail = DRC_UNAVAILABLE
+    default_code = "drc_unavailable"
@@ -11,7 +11,7 @@ from zgw_consumers.api_models.documenten import Document
 from zgw_consumers.drf.serializers import APIModelSerializer
 
 from dowc.accounts.models import User
-from dowc.core.constants import EXTENSION_HANDLER, DocFileTypes
+from dowc.core.constants import EXTENSION_HANDLER, CloseStatus, DocFileTypes
 from dowc.core.models import DocumentFile
 from dowc.core.tokens import document_token_generator
 
@@ -197,6 +197,17 @@ class UnlockedDocumentSerializer(APIModelSerializer):
         return str(url)
 
 
+class CloseStatusSerializer(serializers.Serializer):
+    status = serializers.ChoiceField(
+        choices=CloseStatus.choices,
+        help_text=_("Status of closing the documentfile."),
+    )
+    document = UnlockedDocumentSerializer(
+        allow_null=True,
+        help_text=_("The checked in document, once the documentfile is closed."),
+    )
+
+
 class DocumentStatusSerializer(serializers.ModelSerializer):
     document = serializers.CharField(
         required=False,
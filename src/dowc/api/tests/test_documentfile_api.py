@@ -3,6 +3,8 @@ import uuid
 from io import BytesIO
 from unittest.mock import patch
 
+from django.test import override_settings
+
 import requests_mock
 from privates.test import temp_private_root
 from rest_framework import status
@@ -63,7 +65,8 @@ class DocumentFileAPITests(APITestCase):
         # Create fake content
         cls.content = b"some content"
         cls.download_document_content_patcher = patch(
-            "dowc.core.models.get_document_content", return_value=cls.content
+            "dowc.core.models.stream_document_content",
+            return_value=[cls.content],
         )
 
         # Create random lock data
@@ -85,7 +88,7 @@ class DocumentFileAPITests(APITestCase):
         )
 
         cls.update_document_patcher = patch(
-            "dowc.api.viewsets.update_document",
+            "dowc.core.models.update_document",
             return_value=(cls.doc_data, True),
         )
 
@@ -270,7 +273,7 @@ class DocumentFileAPITests(APITestCase):
         with patch(
             "dowc.core.models.DocumentFile.update_drc_document", return_value=True
         ):
-            with patch("dowc.api.viewsets.update_document", return_value=(None, True)):
+            with patch("dowc.core.models.update_document", return_value=(None, True)):
                 response = self.client.delete(delete_url)
 
         # Check response status
@@ -299,7 +302,7 @@ class DocumentFileAPITests(APITestCase):
         with patch(
             "dowc.core.models.DocumentFile.update_drc_document", return_value=True
         ):
-            with patch("dowc.api.viewsets.update_document", return_value=(None, False)):
+            with patch("dowc.core.models.update_document", return_value=(None, False)):
                 response = self.client.delete(delete_url)
 
         # Check response status
@@ -308,6 +311,23 @@ class DocumentFileAPITests(APITestCase):
         self.assertTrue(docfile.error)
         self.assertEqual(docfile.error_msg, DOCUMENT_COULD_NOT_BE_UPDATED)
 
+    def test_delete_write_document_file_drc_unavailable_through_API(self, m):
+        docfile = DocumentFileFactory.create(
+            drc_url=self.doc_url, purpose=DocFileTypes.write, user=self.user
+        )
+        delete_url = reverse("documentfile-detail", kwargs={"uuid": docfile.uuid})
+
+        with patch(
+            "dowc.core.models.DocumentFile.update_drc_document", return_value=True
+        ):
+            with patch("dowc.core.models.update_document", return_value=(None, None)):
+                response = self.client.delete(delete_url)
+
+        self.assertEqual(response.status_code, 503)
+        docfile.refresh_from_db()
+        self.assertFalse(docfile.error)
+        self.assertFalse(docfile.safe_for_deletion)
+
     def test_changed_document_persisted_through_to_documents_api(self, m):
         mock_service_oas_get(m, self.DRC_URL, "drc")
         docfile = DocumentFileFactory.create(
@@ -326,6 +346,118 @@ class DocumentFileAPITests(APITestCase):
             response.json()["versionedUrl"], f"{self.doc_data['url']}?versie=42"
         )
 
+    @override_settings(DOCUMENT_CLOSE_ASYNC_ENABLED=True)
+    def test_close_write_document_file_async_through_API(self, m):
+        docfile = DocumentFileFactory.create(
+            drc_url=self.doc_url, purpose=DocFileTypes.write, user=self.user
+        )
+        delete_url = reverse("documentfile-detail", kwargs={"uuid": docfile.uuid})
+        status_url = reverse("documentfile-close-status", kwargs={"uuid": docfile.uuid})
+
+        with patch("dowc.api.viewsets.enqueue_close") as mock_enqueue:
+            response = self.client.delete(delete_url, HTTP_PREFER="respond-async")
+            # A second request doesn't queue the job again.
+            second_response = self.client.delete(
+                delete_url, HTTP_PREFER="respond-async"
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.json(), {"status": "closing", "document": None})
+        self.assertEqual(response["Location"], f"http://testserver{status_url}")
+        self.assertEqual(second_response.status_code, status.HTTP_202_ACCEPTED)
+        mock_enqueue.assert_called_once_with(docfile, application=None)
+        self.mock_unlock.assert_not_called()
+
+        docfile.refresh_from_db()
+        self.assertTrue(docfile.closing)
+
+        response = self.client.get(status_url)
+        self.assertEqual(response.json(), {"status": "closing", "document": None})
+
+    @override_settings(DOCUMENT_CLOSE_ASYNC_ENABLED=True)
+    def test_close_write_document_file_async_enqueue_fails_through_API(self, m):
+        docfile = DocumentFileFactory.create(
+            drc_url=self.doc_url, purpose=DocFileTypes.write, user=self.user
+        )
+        delete_url = reverse("documentfile-detail", kwargs={"uuid": docfile.uuid})
+
+        with patch("dowc.api.viewsets.enqueue_close", side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                self.client.delete(delete_url, HTTP_PREFER="respond-async")
+
+        # The next request can queue the job again.
+        docfile.refresh_from_db()
+        self.assertFalse(docfile.closing)
+
+    def test_close_status_closed_through_API(self, m):
+        _uuid = uuid.uuid4()
+        status_url = reverse("documentfile-close-status", kwargs={"uuid": _uuid})
+        document = factory(Document, {**self.doc_data, "versie": 42})
+
+        result = {"document": document, "user": self.user.pk, "application": None}
+
+        with patch("dowc.api.viewsets.get_close_result", return_value=result):
+            response = self.client.get(status_url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {
+                "status": "closed",
+                "document": {
+                    "url": self.doc_data["url"],
+                    "versie": 42,
+                    "versionedUrl": f"{self.doc_data['url']}?versie=42",
+                },
+            },
+        )
+
+    def test_close_status_closed_of_other_user_through_API(self, m):
+        _uuid = uuid.uuid4()
+        status_url = reverse("documentfile-close-status", kwargs={"uuid": _uuid})
+        document = factory(Document, {**self.doc_data, "versie": 42})
+        other_user = UserFactory.create()
+        result = {"document": document, "user": other_user.pk, "application": None}
+
+        with patch("dowc.api.viewsets.get_close_result", return_value=result):
+            response = self.client.get(status_url)
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_close_status_closed_by_application_through_API(self, m):
+        _uuid = uuid.uuid4()
+        status_url = reverse("documentfile-close-status", kwargs={"uuid": _uuid})
+        document = factory(Document, {**self.doc_data, "versie": 42})
+        token, other_token = ApplicationTokenFactory.create_batch(2)
+        result = {"document": document, "user": self.user.pk, "application": token.pk}
+        self.client.logout()
+
+        with patch("dowc.api.viewsets.get_close_result", return_value=result):
+            response = self.client.get(
+                status_url, HTTP_AUTHORIZATION=f"ApplicationToken {token.token}"
+            )
+            other_response = self.client.get(
+                status_url, HTTP_AUTHORIZATION=f"ApplicationToken {other_token.token}"
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["status"], "closed")
+        self.assertEqual(other_response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_close_write_document_file_async_disabled_through_API(self, m):
+        docfile = DocumentFileFactory.create(
+            drc_url=self.doc_url, purpose=DocFileTypes.write, user=self.user
+        )
+        delete_url = reverse("documentfile-detail", kwargs={"uuid": docfile.uuid})
+
+        with patch(
+            "dowc.core.models.DocumentFile.update_drc_document", return_value=None
+        ):
+            response = self.client.delete(delete_url, HTTP_PREFER="respond-async")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(DocumentFile.objects.filter(uuid=docfile.uuid).exists())
+
     def test_return_409_on_duplicate_write_document_file_through_API(self, m):
         """
         This tests if a request for the same write documentfile from the same user
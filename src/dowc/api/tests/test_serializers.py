@@ -3,7 +3,6 @@ import uuid
 from unittest.mock import patch
 from urllib.parse import urlparse
 
-from django.conf import settings
 from django.contrib.sites.models import Site
 from django.test import override_settings
 
@@ -29,12 +28,8 @@ from .utils import get_url_kwargs
 tmpdir = tempfile.mkdtemp()
 
 # Mock storage for test_magic_url_get
-@override_settings(PRIVATE_MEDIA_ROOT=tmpdir)
 def get_storage_mock():
-    storage_mock = WebDavResource
-    storage_mock.root = settings.PRIVATE_MEDIA_ROOT
-    storage_mock.exists = True
-    return storage_mock
+    return type("WebDavResourceMock", (WebDavResource,), {"exists": True})
 
 
 class DocumentFileSerializerTests(APITestCase):
@@ -67,7 +62,8 @@ class DocumentFileSerializerTests(APITestCase):
         # Create fake content
         cls.content = b"some content"
         cls.download_document_content_patcher = patch(
-            "dowc.core.models.get_document_content", return_value=cls.content
+            "dowc.core.models.stream_document_content",
+            return_value=[cls.content],
         )
 
         # Create mock url for drc object
@@ -142,7 +138,7 @@ class DocumentFileSerializerTests(APITestCase):
         )
         self.assertFalse(invalid_token)
 
-    @patch("dowc.core.resource.WebDavResource", get_storage_mock())
+    @patch("dowc.core.views.WebDavView.resource_class", get_storage_mock())
     @override_settings(PRIVATE_MEDIA_ROOT=tmpdir)
     def test_magic_url_get(self):
         """
@@ -1,23 +1,30 @@
+from typing import Optional
+
+from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 
 from drf_spectacular.openapi import OpenApiParameter, OpenApiTypes
 from drf_spectacular.utils import extend_schema, extend_schema_view
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
 from rest_framework.settings import api_settings
 
 from dowc.accounts.authentication import ApplicationTokenAuthentication
+from dowc.accounts.models import ApplicationToken
 from dowc.accounts.permissions import HasTokenAuth
-from dowc.core.constants import DOCUMENT_COULD_NOT_BE_UPDATED, DocFileTypes
+from dowc.core.constants import CloseStatus, DocFileTypes
+from dowc.core.jobs import enqueue_close, get_close_result
 from dowc.core.models import DocumentFile
-from dowc.core.utils import update_document
 
-from .exceptions import UpdateException
+from .exceptions import DRCUnavailable, UpdateException
 from .filters import IsOwnerOrApplicationFilterBackend
 from .permissions import CanCloseDocumentFile
 from .serializers import (
+    CloseStatusSerializer,
     DocumentFileSerializer,
     DocumentStatusSerializer,
     StatusSerializer,
@@ -58,7 +65,19 @@ from .serializers import (
     partial_update=extend_schema(summary=_("Patch documentfile")),
     destroy=extend_schema(
         summary=_("Delete documentfile"),
-        responses={200: UnlockedDocumentSerializer},
+        parameters=[
+            OpenApiParameter(
+                "Prefer",
+                OpenApiTypes.STR,
+                OpenApiParameter.HEADER,
+                description=_(
+                    "Send `respond-async` to close a 'write' documentfile in the "
+                    "background, if enabled. The `Location` header of the 202 "
+                    "response points to its close status."
+                ),
+            ),
+        ],
+        responses={200: UnlockedDocumentSerializer, 202: CloseStatusSerializer},
     ),
 )
 class DocumentFileViewset(viewsets.ModelViewSet):
@@ -118,24 +137,65 @@ class DocumentFileViewset(viewsets.ModelViewSet):
 
         """
         instance = self.get_object()
+        if instance.closing:
+            return self.get_closing_response(instance)
+
+        if self.should_close_async(instance):
+            # Only the request that flags the documentfile queues the job.
+            flagged = (
+                DocumentFile.objects.for_documentfile(instance)
+                .filter(closing=False)
+                .update(closing=True)
+            )
+            if flagged:
+                try:
+                    enqueue_close(instance, application=self.get_application())
+                except Exception:
+                    # Nothing would ever close the documentfile otherwise.
+                    DocumentFile.objects.for_documentfile(instance).update(
+                        closing=False
+                    )
+                    raise
+            return self.get_closing_response(instance)
+
         self.perform_destroy(instance)
         serializer = UnlockedDocumentSerializer(instance=instance.api_document)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    def get_application(self) -> Optional[str]:
+        if isinstance(self.request.auth, ApplicationToken):
+            return self.request.auth.pk
+        return None
+
+    def should_close_async(self, instance) -> bool:
+        return (
+            settings.DOCUMENT_CLOSE_ASYNC_ENABLED
+            and instance.purpose == DocFileTypes.write
+            and "respond-async" in self.request.headers.get("Prefer", "")
+        )
+
+    def get_closing_response(self, instance) -> Response:
+        serializer = CloseStatusSerializer(
+            {"status": CloseStatus.closing, "document": None}
+        )
+        status_url = reverse(
+            "documentfile-close-status",
+            kwargs={"uuid": instance.uuid},
+            request=self.request,
+        )
+        return Response(
+            serializer.data,
+            status=status.HTTP_202_ACCEPTED,
+            headers={"Location": status_url},
+        )
+
     def perform_destroy(self, instance):
         if instance.purpose == DocFileTypes.write:
-            updated_doc = instance.update_drc_document()
-            if updated_doc:
-                doc, success = update_document(instance.unversioned_url, updated_doc)
-                if success:  # Destroy instance
-                    instance.unlock_drc_document()
-                else:
-                    instance.error = True
-                    instance.error_msg = DOCUMENT_COULD_NOT_BE_UPDATED
-                    instance.save()
-                    raise UpdateException()
-            else:
-                instance.unlock_drc_document()
+            success = instance.check_in_drc_document()
+            if success is None:
+                raise DRCUnavailable()
+            if not success:
+                raise UpdateException()
 
         return super().perform_destroy(instance)
 
@@ -164,3 +224,32 @@ class DocumentFileViewset(viewsets.ModelViewSet):
         queryset = self.get_queryset().filter(purpose=DocFileTypes.write, **filters)
         serializer = DocumentStatusSerializer(queryset, many=True)
         return Response(serializer.data)
+
+    @extend_schema(
+        summary=_("Retrieve the close status of a documentfile."),
+        responses={200: CloseStatusSerializer},
+    )
+    @action(methods=["get"], detail=True, url_path="close-status")
+    def close_status(self, request, *args, **kwargs):
+        result = get_close_result(kwargs[self.lookup_field])
+        if result is not None:
+            # The documentfile is gone, so only its owner may see the result.
+            application = self.get_application()
+            if application is not None:
+                if result["application"] != application:
+                    raise NotFound()
+            elif result["user"] != request.user.pk:
+                raise NotFound()
+            data = {"status": CloseStatus.closed, "document": result["document"]}
+        else:
+            instance = self.get_object()
+            if instance.closing:
+                close_status = CloseStatus.closing
+            elif instance.error:
+                close_status = CloseStatus.error
+            else:
+                close_status = CloseStatus.open
+            data = {"status": close_status, "document": None}
+
+        serializer = CloseStatusSerializer(data)
+        return Response(serializer.data)
@@ -1,48 +1,267 @@
+import copy
+import logging
+import os
+import threading
 import time
+from typing import Dict, List, Tuple, Union
+from urllib.parse import urljoin
 from uuid import UUID, uuid4
 
+from django.conf import settings
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from zds_client.client import ClientError, Object
 from zds_client.log import Log
+from zds_client.schema import get_headers
 from zgw_consumers.client import ZGWClient
 from zgw_consumers.nlx import NLXClientMixin
 
+logger = logging.getLogger(__name__)
+
 
 class DurationLog(Log):
+    """
+    Request log with the duration of each request.
+
+    The log is shared by all clients in the process. Requests are made from
+    several threads at once (uWSGI threads and `parallel` blocks), so the log
+    is only accessed while holding the lock.
+    """
 
     durations = {}
+    _lock = threading.RLock()
 
     @classmethod
     def add(cls, service: str, url: str, method: str, *args, **kwargs):
-        # find the matchin request
-        for request_id, info in cls.durations.items():
-            request = info["request"]
-            if request == (service, url, method, request_id):
-                break
-        else:
-            raise ValueError("request not found in durations log")
-
-        duration = cls.durations.pop(request_id)["duration"]
-
-        super().add(service, url, method, *args, **kwargs)
-
-        entry = next(
-            (
-                entry
-                for entry in reversed(cls._entries)
-                if entry["service"] == service
-                and entry["request"]["url"] == url
-                and entry["request"]["method"] == method
+        with cls._lock:
+            # find the matchin request
+            for request_id, info in cls.durations.items():
+                request = info["request"]
+                if request == (service, url, method, request_id):
+                    break
+            else:
+                raise ValueError("request not found in durations log")
+
+            duration = cls.durations.pop(request_id)["duration"]
+
+            super().add(service, url, method, *args, **kwargs)
+
+            entry = next(
+                (
+                    entry
+                    for entry in reversed(cls._entries)
+                    if entry["service"] == service
+                    and entry["request"]["url"] == url
+                    and entry["request"]["method"] == method
+                )
             )
-        )
-        entry["duration"] = duration
+            entry["duration"] = duration
+
+    def start(self, request_id: UUID, request: tuple):
+        with self._lock:
+            self.durations[request_id] = {"request": request, "duration": 0}
 
     def add_duration(self, request_id: UUID, duration: int):
+        with self._lock:
+            try:
+                self.durations[request_id]["duration"] = duration
+            except KeyError:
+                pass
+
+    def discard(self, request_id: UUID):
+        with self._lock:
+            self.durations.pop(request_id, None)
+
+
+class SessionPool:
+    """
+    Keeps a keep-alive session per API root for the current process.
+
+    Requests to the same API root reuse the connections of its session instead
+    of setting up a new TCP and TLS connection for every request. Sessions are
+    not shared with forked processes.
+
+    The connection stats are logged every `DRC_HTTP_POOL_STATS_INTERVAL`
+    seconds.
+    """
+
+    def __init__(self):
+        self._sessions: Dict[str, requests.Session] = {}
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats_logged_at = time.monotonic()
+
+    def get(self, api_root: str) -> requests.Session:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._sessions = {}
+                self._pid = os.getpid()
+
+            if api_root not in self._sessions:
+                self._sessions[api_root] = self._build_session()
+            return self._sessions[api_root]
+
+    def _build_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=settings.DRC_HTTP_POOL_SIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Returns the number of requests, the number of connections that were
+        set up and the number of requests that reused a connection per API root.
+        """
+        with self._lock:
+            return self._stats()
+
+    def _stats(self) -> Dict[str, Dict[str, int]]:
+        stats = {}
+        for api_root, session in self._sessions.items():
+            num_requests = num_connections = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    num_requests += pool.num_requests
+                    num_connections += pool.num_connections
+
+            stats[api_root] = {
+                "requests": num_requests,
+                "connections": num_connections,
+                "reused": num_requests - num_connections,
+            }
+        return stats
+
+    def log_stats(self) -> None:
+        for api_root, stats in self.stats().items():
+            logger.info(
+                "Connection pool for '%s': %d request(s), %d connection(s), "
+                "%d reused.",
+                api_root,
+                stats["requests"],
+                stats["connections"],
+                stats["reused"],
+            )
+
+    def log_stats_if_due(self) -> None:
+        interval = settings.DRC_HTTP_POOL_STATS_INTERVAL
+        if not interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            if now - self._stats_logged_at < interval:
+                return
+            self._stats_logged_at = now
+        self.log_stats()
+
+    def clear(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+session_pool = SessionPool()
+
+
+def get_session(api_root: str) -> requests.Session:
+    return session_pool.get(api_root)
+
+
+def get_timeout() -> Tuple[float, float]:
+    return (settings.DRC_HTTP_CONNECT_TIMEOUT, settings.DRC_HTTP_READ_TIMEOUT)
+
+
+def log_pool_stats() -> None:
+    session_pool.log_stats()
+
+
+class PooledSessionMixin:
+    """
+    Send requests with the pooled session of the API root.
+
+    Replaces the request implementation of `zds_client.Client`, which sends
+    every request with a new session.
+    """
+
+    @property
+    def session(self) -> requests.Session:
+        return get_session(self.base_url)
+
+    def request(
+        self,
+        path: str,
+        operation: str,
+        method="GET",
+        expected_status=200,
+        request_kwargs=None,
+        **kwargs,
+    ) -> Union[List[Object], Object]:
+        url = urljoin(self.base_url, path)
+
+        if request_kwargs:
+            kwargs.update(request_kwargs)
+
+        headers = CaseInsensitiveDict(kwargs.pop("headers", {}))
+        headers.setdefault("Accept", "application/json")
+        headers.setdefault("Content-Type", "application/json")
+        schema_headers = get_headers(self.schema, operation)
+        for header, value in schema_headers.items():
+            headers.setdefault(header, value)
+        if self.auth:
+            headers.update(self.auth.credentials())
+
+        kwargs["headers"] = headers
+        kwargs.setdefault("timeout", get_timeout())
+
+        pre_id = self.pre_request(method, url, **kwargs)
+
         try:
-            self.durations[request_id]["duration"] = duration
-        except KeyError:
-            pass
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self.discard_request(pre_id)
+            raise
+        finally:
+            session_pool.log_stats_if_due()
 
+        try:
+            response_json = response.json()
+        except Exception:
+            response_json = None
+
+        self.post_response(pre_id, response_json)
 
-class Client(NLXClientMixin, ZGWClient):
+        self._log.add(
+            self.service,
+            url,
+            method,
+            dict(headers),
+            copy.deepcopy(kwargs.get("data", kwargs.get("json", None))),
+            response.status_code,
+            dict(response.headers),
+            response_json,
+            params=kwargs.get("params"),
+        )
+
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as exc:
+            if response.status_code >= 500:
+                raise
+            raise ClientError(response_json) from exc
+
+        assert response.status_code == expected_status, response_json
+        return response_json
+
+
+class Client(NLXClientMixin, PooledSessionMixin, ZGWClient):
     _log = DurationLog()
     request_starts = {}
 
@@ -52,7 +271,7 @@ class Client(NLXClientMixin, ZGWClient):
         request_id = uuid4()
         self.request_starts[request_id] = time.time()
         request = (self.service, url, method, request_id)
-        self._log.durations[request_id] = {"request": request, "duration": 0}
+        self._log.start(request_id, request)
         return request_id
 
     def post_response(self, request_id, response_json) -> None:
@@ -61,3 +280,10 @@ class Client(NLXClientMixin, ZGWClient):
         start = self.request_starts.pop(request_id)
         duration = (time.time() - start) * 1000
         self._log.add_duration(request_id, int(duration))
+
+    def discard_request(self, request_id) -> None:
+        """
+        Forget a request that didn't get a response.
+        """
+        self.request_starts.pop(request_id, None)
+        self._log.discard(request_id)
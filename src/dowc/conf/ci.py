@@ -20,6 +20,9 @@ logging.disable(logging.CRITICAL)
 
 ENVIRONMENT = "ci"
 
+# Don't wait before retrying failed requests to the DRC
+DRC_RETRY_BACKOFF = 0
+
 #
 # Django-axes
 #
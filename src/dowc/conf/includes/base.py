@@ -79,6 +79,11 @@ CACHES = {
     },
 }
 
+# The singleton models, like the configuration read on every WebDAV request,
+# are cached by django-solo.
+SOLO_CACHE = "default"
+SOLO_CACHE_TIMEOUT = config("SOLO_CACHE_TIMEOUT", default=60 * 5)
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -202,6 +207,10 @@ EMAIL_TIMEOUT = 10
 
 DEFAULT_FROM_EMAIL = config("DEFAULT_FROM_EMAIL", default="dowc@example.com")
 
+# Queue emails in Redis instead of sending them directly. Queued emails are
+# sent by the `send_queued_emails` management command.
+EMAIL_QUEUE_ENABLED = config("EMAIL_QUEUE_ENABLED", default=False)
+
 #
 # LOGGING
 #
@@ -436,13 +445,98 @@ FILE_UPLOAD_PERMISSIONS = None
 #
 SENDFILE_ROOT = PRIVATE_MEDIA_ROOT
 SENDFILE_URL = PRIVATE_MEDIA_URL
-SENDFILE_BACKEND = "sendfile.backends.nginx"
+SENDFILE_BACKEND = config("SENDFILE_BACKEND", default="django_sendfile.backends.nginx")
 
 #
 # DOCUMENT TOKEN CONFIGURATION
 #
 DOCUMENT_TOKEN_TIMEOUT_DAYS = 1
 
+#
+# DOCUMENT CLOSE CONFIGURATION
+#
+# Allow clients to close 'write' documentfiles in the background by sending a
+# `Prefer: respond-async` header. The jobs are queued in Redis and processed
+# by the `process_close_jobs` management command.
+DOCUMENT_CLOSE_ASYNC_ENABLED = config("DOCUMENT_CLOSE_ASYNC_ENABLED", default=False)
+# Number of times a failing close job is retried.
+DOCUMENT_CLOSE_RETRIES = config("DOCUMENT_CLOSE_RETRIES", default=5)
+# Seconds before the first retry, doubled for every next retry.
+DOCUMENT_CLOSE_RETRY_DELAY = config("DOCUMENT_CLOSE_RETRY_DELAY", default=30)
+# Maximum number of seconds between two retries. Jobs are retried without limit
+# while the DRC is unavailable.
+DOCUMENT_CLOSE_RETRY_MAX_DELAY = config("DOCUMENT_CLOSE_RETRY_MAX_DELAY", default=3600)
+# Seconds without a heartbeat after which the jobs of a worker are queued again.
+# Should be longer than closing a single documentfile takes.
+DOCUMENT_CLOSE_WORKER_TIMEOUT = config("DOCUMENT_CLOSE_WORKER_TIMEOUT", default=600)
+# Number of times the `retry_errored_files` management command retries to check
+# in and unlock an errored documentfile before the error is escalated.
+DOCUMENT_ERROR_MAX_ATTEMPTS = config("DOCUMENT_ERROR_MAX_ATTEMPTS", default=5)
+# Seconds before an errored documentfile is retried again after a failed
+# retry, doubled for every next retry.
+DOCUMENT_ERROR_RETRY_DELAY = config("DOCUMENT_ERROR_RETRY_DELAY", default=15 * 60)
+
+#
+# DRC CONFIGURATION
+#
+# Seconds that clients are cached per API root. Keep this well below the JWT
+# expiry of the DRC, as the client credentials are reused for this long.
+DRC_CLIENT_CACHE_TIMEOUT = config("DRC_CLIENT_CACHE_TIMEOUT", default=300)
+# Maximum number of keep-alive connections per API root and process.
+DRC_HTTP_POOL_SIZE = config("DRC_HTTP_POOL_SIZE", default=10)
+# Seconds between two log lines with the number of requests and connections
+# per API root and process. 0 disables the log lines.
+DRC_HTTP_POOL_STATS_INTERVAL = config("DRC_HTTP_POOL_STATS_INTERVAL", default=300)
+# Timeouts in seconds for connecting to and reading from the DRC.
+DRC_HTTP_CONNECT_TIMEOUT = config("DRC_HTTP_CONNECT_TIMEOUT", default=10.0)
+DRC_HTTP_READ_TIMEOUT = config("DRC_HTTP_READ_TIMEOUT", default=300.0)
+# Size in bytes of the chunks in which document content is streamed from the DRC.
+DRC_CONTENT_CHUNK_SIZE = config("DRC_CONTENT_CHUNK_SIZE", default=1024 * 1024)
+# Documents of at least this many bytes are uploaded in parts (bestandsdelen)
+# if the DRC supports it.
+DRC_UPLOAD_IN_PARTS_THRESHOLD = config(
+    "DRC_UPLOAD_IN_PARTS_THRESHOLD", default=100 * 1024 * 1024
+)
+# Number of parts that are uploaded at the same time.
+DRC_UPLOAD_PART_WORKERS = config("DRC_UPLOAD_PART_WORKERS", default=4)
+# Number of times the upload of a single part is retried after a connection
+# or server error, with the same backoff as DRC_RETRIES.
+DRC_UPLOAD_PART_RETRIES = config("DRC_UPLOAD_PART_RETRIES", default=3)
+# Number of times a request that failed with a connection or server error is
+# retried, and the backoff in seconds before the first retry. The backoff is
+# doubled for every next retry.
+DRC_RETRIES = config("DRC_RETRIES", default=3)
+DRC_RETRY_BACKOFF = config("DRC_RETRY_BACKOFF", default=0.5)
+# Requests to an API fail fast for DRC_CIRCUIT_BREAKER_TIMEOUT seconds after
+# DRC_CIRCUIT_BREAKER_THRESHOLD consecutive requests to it failed.
+DRC_CIRCUIT_BREAKER_THRESHOLD = config("DRC_CIRCUIT_BREAKER_THRESHOLD", default=5)
+DRC_CIRCUIT_BREAKER_TIMEOUT = config("DRC_CIRCUIT_BREAKER_TIMEOUT", default=30)
+# Number of documents that are checked in at the same time on a force delete.
+DRC_BULK_UPDATE_WORKERS = config("DRC_BULK_UPDATE_WORKERS", default=8)
+
+#
+# WEBDAV CONFIGURATION
+#
+# Backend that stores the WebDAV locks. Use `dowc.core.locks.RedisWebDAVLock`
+# to store them in the default cache Redis, where they expire by themselves.
+WEBDAV_LOCK_BACKEND = config(
+    "WEBDAV_LOCK_BACKEND", default="dowc.core.locks.WebDAVLock"
+)
+# Let the web server send the documents on a WebDAV GET through the
+# SENDFILE_BACKEND instead of streaming them through Django.
+WEBDAV_SENDFILE_ENABLED = config("WEBDAV_SENDFILE_ENABLED", default=False)
+# Number of seconds the documentfile of a WebDAV request is cached for the next
+# requests, 0 to disable the cache.
+WEBDAV_OBJECT_CACHE_TIMEOUT = config("WEBDAV_OBJECT_CACHE_TIMEOUT", default=10)
+# Number of seconds rendered PROPFIND responses are cached, 0 to disable the cache.
+WEBDAV_PROPFIND_CACHE_TIMEOUT = config("WEBDAV_PROPFIND_CACHE_TIMEOUT", default=60)
+# Maximum size in bytes of a document uploaded with a WebDAV PUT, 0 for no limit.
+WEBDAV_PUT_MAX_SIZE = config("WEBDAV_PUT_MAX_SIZE", default=0)
+# Number of bytes of a WebDAV PUT that are read and written at a time.
+WEBDAV_PUT_BUFFER_SIZE = config("WEBDAV_PUT_BUFFER_SIZE", default=64 * 1024)
+# Flush uploaded documents to disk before they replace the old document.
+WEBDAV_PUT_FSYNC = config("WEBDAV_PUT_FSYNC", default=True)
+
 # ZGW-CONSUMERS
 #
 ZGW_CONSUMERS_CLIENT_CLASS = "dowc.client.Client"
@@ -6,6 +6,7 @@ from djchoices import ChoiceItem, DjangoChoices
 class ResourceSubFolders(DjangoChoices):
     public = ChoiceItem("public", _("public"))
     protected = ChoiceItem("protected", _("Protected"))
+    temporary = ChoiceItem("temporary", _("Temporary"))
 
 
 class DocFileTypes(DjangoChoices):
@@ -14,6 +15,13 @@ class DocFileTypes(DjangoChoices):
     download = ChoiceItem("download", _("Download"))
 
 
+class CloseStatus(DjangoChoices):
+    open = ChoiceItem("open", _("Open"))
+    closing = ChoiceItem("closing", _("Closing"))
+    closed = ChoiceItem("closed", _("Closed"))
+    error = ChoiceItem("error", _("Error"))
+
+
 EXTENSION_HANDLER = {
     ".doc": "ms-word",
     ".docm": "ms-word",
@@ -66,3 +74,7 @@ EXTENSION_HANDLER = {
 
 DOCUMENT_COULD_NOT_BE_UNLOCKED = "Document could not be unlocked on DRC."
 DOCUMENT_COULD_NOT_BE_UPDATED = "Document could not be updated on DRC."
+DRC_UNAVAILABLE = "DRC is unavailable, please try again later."
+
+DOCUMENTFILE_CACHE_KEY = "dowc:webdav:documentfile:{uuid}"
+PROPFIND_VERSION_KEY = "dowc:propfind:version:{folder}"
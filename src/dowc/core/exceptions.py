@@ -0,0 +1,9 @@
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework.exceptions import APIException
+
+
+class DocumentTooLarge(APIException):
+    status_code = 413
+    default_detail = _("The document exceeds the maximum document size.")
+    default_code = "document_too_large"
@@ -0,0 +1,308 @@
+import base64
+import hashlib
+import json
+import math
+import os
+import shutil
+import uuid
+from typing import Iterable, Iterator, Optional, Tuple
+
+from django.conf import settings
+from django.core.files.base import File
+from django.db.models.fields.files import FieldFile
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+# ioctl request code to create a copy-on-write clone, see linux/fs.h.
+FICLONE = 0x40049409
+
+
+class StreamedFile(File):
+    """
+    A file that is backed by an iterable of byte chunks instead of a file object.
+
+    Storage backends write a file by iterating over its chunks, so the chunks
+    can be written to disk as they come in without ever buffering the
+    whole file in memory. The chunks can only be consumed once.
+
+    The SHA-256 digest of the content is computed as the chunks are consumed.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], name: str):
+        super().__init__(None, name=name)
+        self._chunks = chunks
+        self._hash = hashlib.sha256()
+
+    def chunks(self, chunk_size=None):
+        for chunk in self._chunks:
+            self._hash.update(chunk)
+            yield chunk
+
+    @property
+    def digest(self) -> str:
+        return self._hash.hexdigest()
+
+    def multiple_chunks(self, chunk_size=None):
+        return True
+
+
+class StreamedBody:
+    """
+    Base class for request bodies that are generated while they are sent.
+
+    Subclasses implement `__iter__` and `__len__`, so that `requests` sends the
+    body with a Content-Length header instead of chunked transfer encoding.
+    """
+
+    file: FieldFile
+
+    def __iter__(self) -> Iterator[bytes]:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__}: {self.file.name}>"
+
+    def __deepcopy__(self, memo) -> str:
+        # Request logging deep copies request data, don't copy the content.
+        return repr(self)
+
+
+class Base64JSONBody(StreamedBody):
+    """
+    A JSON request body of which one field holds the base64 encoded content of
+    a stored file.
+
+    Iterating over the body reads and encodes the file chunk by chunk, so the
+    file is never held in memory as a whole. The length of the body is known
+    beforehand, which allows it to be sent with a Content-Length header instead
+    of chunked transfer encoding. The body can be iterated over more than once.
+    """
+
+    def __init__(self, data: dict, field: str, chunk_size: Optional[int] = None):
+        self.file = data[field]
+        self.field = field
+
+        # Base64 encodes 3 bytes to 4 characters, keep chunks a multiple of 3
+        # so the encoded chunks can be concatenated without padding.
+        chunk_size = chunk_size or settings.DRC_CONTENT_CHUNK_SIZE
+        self.chunk_size = max(chunk_size - chunk_size % 3, 3)
+
+        # Put the encoded content last so it can be streamed in between.
+        other_data = {key: value for key, value in data.items() if key != field}
+        encoded = json.dumps({**other_data, field: ""}).encode("utf-8")
+        self._prefix, self._suffix = encoded[:-2], encoded[-2:]
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield self._prefix
+        with self.file.storage.open(self.file.name, "rb") as f:
+            while chunk := f.read(self.chunk_size):
+                yield base64.b64encode(chunk)
+        yield self._suffix
+
+    def __len__(self) -> int:
+        encoded_size = math.ceil(self.file.size / 3) * 4
+        return len(self._prefix) + encoded_size + len(self._suffix)
+
+
+class MultipartFileRangeBody(StreamedBody):
+    """
+    A multipart/form-data request body of which one field holds a byte range of
+    a stored file.
+
+    Like `Base64JSONBody`, the file is read chunk by chunk while the body is
+    sent and the body can be iterated over more than once.
+    """
+
+    def __init__(
+        self,
+        data: dict,
+        field: str,
+        offset: int,
+        size: int,
+        chunk_size: Optional[int] = None,
+    ):
+        self.file = data[field]
+        self.offset = offset
+        self.size = size
+        self.chunk_size = chunk_size or settings.DRC_CONTENT_CHUNK_SIZE
+
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+
+        filename = os.path.basename(self.file.name).replace('"', "%22")
+        head = [
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n'
+            f"{value}\r\n"
+            for key, value in data.items()
+            if key != field
+        ]
+        head.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; '
+            f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+        )
+        self._head = "".join(head).encode("utf-8")
+        self._tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield self._head
+        with self.file.storage.open(self.file.name, "rb") as f:
+            f.seek(self.offset)
+            remaining = self.size
+            while remaining and (chunk := f.read(min(self.chunk_size, remaining))):
+                remaining -= len(chunk)
+                yield chunk
+        yield self._tail
+
+    def __len__(self) -> int:
+        return len(self._head) + self.size + len(self._tail)
+
+
+def read_file_range(
+    path: str, offset: int, size: int, chunk_size: int = 64 * 1024
+) -> Iterator[bytes]:
+    """
+    Reads `size` bytes of the file at `path`, starting at `offset`, in chunks.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        remaining = size
+        while remaining and (chunk := f.read(min(chunk_size, remaining))):
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_digest(field_file: FieldFile) -> str:
+    """
+    Computes the SHA-256 digest of a stored file, reading it in chunks.
+    """
+    file_hash = hashlib.sha256()
+    with field_file.open("rb") as f:
+        for chunk in f.chunks():
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def clone_file(src_fd: int, dst_fd: int) -> None:
+    """
+    Copies the content of `src_fd` to `dst_fd` without passing it through Python.
+
+    A reflink (copy-on-write clone) is attempted first, which shares the data
+    blocks until one of the files is written to. If the filesystem doesn't
+    support it, the kernel copies the data (which is a server-side copy on
+    network filesystems that support it). Only if that isn't possible either,
+    the data is copied in buffered chunks.
+    """
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return
+        except OSError:
+            pass
+
+    size = os.fstat(src_fd).st_size
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                sent = os.copy_file_range(src_fd, dst_fd, size - copied)
+                if sent == 0:
+                    break
+                copied += sent
+        except OSError:
+            pass
+
+    os.lseek(src_fd, copied, os.SEEK_SET)
+    os.lseek(dst_fd, copied, os.SEEK_SET)
+    while chunk := os.read(src_fd, shutil.COPY_BUFSIZE):
+        os.write(dst_fd, chunk)
+
+
+def copy_field_file(source: FieldFile, target: FieldFile, filename: str) -> None:
+    """
+    Copies the file of `source` to a new file named `filename` in `target`.
+
+    On file system storages the copy is made with `clone_file`, other storages
+    fall back to a single streamed copy.
+    """
+    storage = target.storage
+    name = target.field.generate_filename(target.instance, filename)
+
+    try:
+        source_path = source.path
+        storage.path(name)
+    except NotImplementedError:
+        with source.open("rb") as source_file:
+            target.save(filename, source_file, save=False)
+        return
+
+    name, dst_fd = create_file(target, name)
+    try:
+        with open(source_path, "rb") as source_file:
+            clone_file(source_file.fileno(), dst_fd)
+    except Exception:
+        os.close(dst_fd)
+        target.storage.delete(name)
+        raise
+    else:
+        os.close(dst_fd)
+
+    commit_file(target, name)
+
+
+def save_streamed_file(target: FieldFile, filename: str, content: File) -> None:
+    """
+    Saves the chunks of `content` to a new file named `filename` in `target`.
+
+    If the chunks stop coming in halfway, the partly written file is deleted
+    again before the error is raised. Storages without a file system path save
+    the file themselves.
+    """
+    name = target.field.generate_filename(target.instance, filename)
+
+    try:
+        target.storage.path(name)
+    except NotImplementedError:
+        target.save(filename, content, save=False)
+        return
+
+    name, fd = create_file(target, name)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in content.chunks():
+                f.write(chunk)
+    except BaseException:
+        target.storage.delete(name)
+        raise
+
+    commit_file(target, name)
+
+
+def create_file(target: FieldFile, name: str) -> Tuple[str, int]:
+    """
+    Creates a new empty file with an available name based on `name` in the
+    storage of `target`. Returns the name and the file descriptor.
+    """
+    storage = target.storage
+    os.makedirs(os.path.dirname(storage.path(name)), exist_ok=True)
+    while True:
+        name = storage.get_available_name(name, max_length=target.field.max_length)
+        try:
+            return name, os.open(storage.path(name), storage.OS_OPEN_FLAGS, 0o666)
+        except FileExistsError:
+            # A file was created in the meantime, get a new name.
+            continue
+
+
+def commit_file(target: FieldFile, name: str) -> None:
+    storage = target.storage
+    if storage.file_permissions_mode is not None:
+        os.chmod(storage.path(name), storage.file_permissions_mode)
+
+    target.name = name
+    target._committed = True
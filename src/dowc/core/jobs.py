@@ -0,0 +1,181 @@
+"""
+Background jobs that close 'write' documentfiles.
+
+The jobs are queued in a Redis list. Failing jobs are retried with an
+exponential backoff through a sorted set scored by the time they are due.
+
+A worker moves the job it processes to its own processing list, which is kept
+alive by a heartbeat. If the worker dies, its jobs are moved back to the queue
+once the heartbeat expires.
+"""
+import json
+import logging
+import time
+import uuid
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from django_redis import get_redis_connection
+from zgw_consumers.api_models.documenten import Document
+
+from .constants import DOCUMENT_COULD_NOT_BE_UPDATED
+from .models import DocumentFile
+
+logger = logging.getLogger(__name__)
+
+CLOSE_QUEUE_KEY = "dowc:close:queue"
+CLOSE_RETRY_KEY = "dowc:close:retry"
+CLOSE_PROCESSING_KEY = "dowc:close:processing:{worker}"
+CLOSE_HEARTBEAT_KEY = "dowc:close:heartbeat:{worker}"
+CLOSE_RESULT_CACHE_KEY = "dowc:close:result:{uuid}"
+CLOSE_RESULT_TIMEOUT = 60 * 60 * 24
+
+
+def enqueue_close(docfile: DocumentFile, application: Optional[str] = None) -> None:
+    """
+    Queues closing the documentfile, on behalf of `application` if it was
+    closed with an application token.
+
+    """
+    job = {"uuid": str(docfile.uuid), "attempt": 0, "application": application}
+    get_redis_connection("default").lpush(CLOSE_QUEUE_KEY, json.dumps(job))
+
+
+def get_close_result(uuid) -> Optional[dict]:
+    """
+    Returns the checked in document of a documentfile closed in the background,
+    together with the user and application it belongs to.
+
+    """
+    return cache.get(CLOSE_RESULT_CACHE_KEY.format(uuid=uuid))
+
+
+def schedule_retry(job: dict) -> None:
+    retries = job["attempt"] + job.get("postponed", 0)
+    delay = min(
+        settings.DOCUMENT_CLOSE_RETRY_DELAY * 2 ** (retries - 1),
+        settings.DOCUMENT_CLOSE_RETRY_MAX_DELAY,
+    )
+    get_redis_connection("default").zadd(
+        CLOSE_RETRY_KEY, {json.dumps(job): time.time() + delay}
+    )
+
+
+def close_documentfile(job: dict) -> None:
+    """
+    Checks in and unlocks the document and deletes the documentfile.
+
+    """
+    docfile = (
+        DocumentFile.objects.select_related("user")
+        .filter(uuid=job["uuid"], closing=True)
+        .first()
+    )
+    if docfile is None:
+        return
+
+    try:
+        success = docfile.check_in_drc_document()
+    except Exception:
+        logger.warning("Closing documentfile %s failed.", docfile.uuid, exc_info=True)
+        success = False
+
+    if success is None:
+        # The DRC is unavailable, which doesn't count as a failed attempt.
+        job["postponed"] = job.get("postponed", 0) + 1
+        logger.warning(
+            "Closing documentfile %s postponed, the DRC is unavailable.",
+            docfile.uuid,
+        )
+        schedule_retry(job)
+        return
+
+    if not success:
+        job["attempt"] += 1
+        if job["attempt"] <= settings.DOCUMENT_CLOSE_RETRIES:
+            logger.warning("Retrying to close documentfile %s.", docfile.uuid)
+            # The documentfile stays flagged as closing, so it is only flagged
+            # as errored if the last attempt fails as well.
+            if docfile.error:
+                DocumentFile.objects.for_documentfile(docfile).update(
+                    error=False, error_msg=""
+                )
+            schedule_retry(job)
+            return
+
+        logger.error("Closing documentfile %s failed.", docfile.uuid)
+        docfile.error = True
+        docfile.error_msg = docfile.error_msg or DOCUMENT_COULD_NOT_BE_UPDATED
+
+    docfile.closing = False
+    docfile.save()
+    if success and docfile.safe_for_deletion:
+        result = {
+            "document": docfile.api_document,
+            "user": docfile.user_id,
+            "application": job.get("application"),
+        }
+        cache.set(
+            CLOSE_RESULT_CACHE_KEY.format(uuid=docfile.uuid),
+            result,
+            timeout=CLOSE_RESULT_TIMEOUT,
+        )
+        docfile.delete()
+
+
+def requeue_due_retries() -> None:
+    redis = get_redis_connection("default")
+    for job in redis.zrangebyscore(CLOSE_RETRY_KEY, 0, time.time()):
+        # Only the worker that removes the job from the retry set queues it.
+        if redis.zrem(CLOSE_RETRY_KEY, job):
+            redis.lpush(CLOSE_QUEUE_KEY, job)
+
+
+def requeue_abandoned_jobs() -> None:
+    """
+    Moves the jobs of workers whose heartbeat expired back to the queue.
+
+    """
+    redis = get_redis_connection("default")
+    prefix = CLOSE_PROCESSING_KEY.format(worker="")
+    for key in redis.scan_iter(match=CLOSE_PROCESSING_KEY.format(worker="*")):
+        key = key.decode() if isinstance(key, bytes) else key
+        worker = key[len(prefix) :]
+        if redis.exists(CLOSE_HEARTBEAT_KEY.format(worker=worker)):
+            continue
+        while (job := redis.rpoplpush(key, CLOSE_QUEUE_KEY)) is not None:
+            logger.warning("Requeued close job %s of worker %s.", job, worker)
+
+
+def process_close_jobs(burst: bool = False, timeout: int = 5) -> int:
+    """
+    Processes close jobs until stopped, or until the queue is empty if `burst`.
+
+    """
+    redis = get_redis_connection("default")
+    worker = uuid.uuid4().hex
+    processing_key = CLOSE_PROCESSING_KEY.format(worker=worker)
+    heartbeat_key = CLOSE_HEARTBEAT_KEY.format(worker=worker)
+    processed = 0
+    while True:
+        redis.set(heartbeat_key, 1, ex=settings.DOCUMENT_CLOSE_WORKER_TIMEOUT)
+        requeue_abandoned_jobs()
+        requeue_due_retries()
+
+        if burst:
+            job = redis.rpoplpush(CLOSE_QUEUE_KEY, processing_key)
+            if job is None:
+                redis.delete(heartbeat_key)
+                return processed
+        else:
+            job = redis.brpoplpush(CLOSE_QUEUE_KEY, processing_key, timeout=timeout)
+            if job is None:
+                continue
+
+        close_old_connections()
+        close_documentfile(json.loads(job))
+        redis.lrem(processing_key, 1, job)
+        processed += 1
@@ -1,3 +1,11 @@
+import json
+from typing import Iterable, List, Type
+from uuid import uuid4
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from django_redis import get_redis_connection
 from djangodav.base.locks import BaseLock
 
 from dowc.core.utils import clean_token
@@ -5,36 +13,236 @@ from dowc.core.utils import clean_token
 from .models import DocumentLock
 
 
+def get_lock_class() -> Type["WebDAVLock"]:
+    """
+    Returns the WebDAV lock backend configured in `WEBDAV_LOCK_BACKEND`.
+    """
+    return import_string(settings.WEBDAV_LOCK_BACKEND)
+
+
 class WebDAVLock(BaseLock):
     """
     Locks are given a random uuid and stored in the DB.
-    Periodically all locks that are still open are deleted.
+    Locks expire after their timeout and expired locks are deleted
+    periodically in batches.
 
     """
 
     def get(self):
         """Gets all active locks for the requested resource. Returns a list of locks."""
-        locks = DocumentLock.objects.filter(resource_path=self.resource.get_path())
-        raise [lock.token for lock in locks]
+        return list(
+            DocumentLock.objects.active()
+            .filter(resource_path=self.resource.get_path())
+            .values_list("token", flat=True)
+        )
 
     def acquire(self, lockscope, locktype, depth, timeout, owner):
         """Creates a new lock for the given resource."""
+        path = self.resource.get_path()
+        # Expired locks of the resource are cleaned up right away.
+        DocumentLock.objects.expired().filter(resource_path=path).delete()
 
-        lock = DocumentLock.objects.create(
-            resource_path=self.resource.get_path(),
+        lock = DocumentLock(
+            resource_path=path,
             lockscope=lockscope,
             locktype=locktype,
             depth=depth,
             timeout=timeout,
             owner=owner,
         )
+        lock.expires_at = lock.get_expires_at()
+        lock.save()
         return lock.token
 
+    def refresh(self, token) -> bool:
+        """Extends the lock referenced by the given lock id, if it is active."""
+        token = clean_token(token)
+        if token is None:
+            return False
+
+        lock = DocumentLock.objects.active().filter(token=token).only("timeout").first()
+        if lock is None:
+            return False
+
+        if lock.timeout:
+            DocumentLock.objects.filter(pk=lock.pk).update(
+                expires_at=lock.get_expires_at()
+            )
+        return True
+
     def release(self, token):
         """Releases the lock referenced by the given lock id."""
         token = clean_token(token)
-        DocumentLock.objects.get(token=token).delete()
+        if token is None:
+            return False
+
+        deleted, _rest = DocumentLock.objects.filter(token=token).delete()
+        return bool(deleted)
 
     def del_locks(self):
         """Releases all locks for the given resource."""
         DocumentLock.objects.filter(resource_path=self.resource.get_path()).delete()
+
+    @classmethod
+    def del_locks_for_paths(cls, paths: Iterable[str]):
+        """Releases all locks for the resources at the given paths."""
+        DocumentLock.objects.filter(resource_path__in=paths).delete()
+
+    @classmethod
+    def del_expired_locks(cls, batch_size: int = 1000) -> int:
+        """Releases the expired locks. Returns the number of released locks."""
+        return DocumentLock.objects.delete_expired(batch_size=batch_size)
+
+    @classmethod
+    def del_all_locks(cls):
+        """Releases all locks."""
+        DocumentLock.objects.all().delete()
+
+
+class RedisWebDAVLock(WebDAVLock):
+    """
+    Locks are stored in Redis and expire by themselves after their timeout.
+
+    Every lock is stored under its token. The tokens of the locks of a
+    resource are kept in a set, which expires with its longest lasting lock.
+
+    Changes that depend on what was read before are made in WATCH/MULTI
+    transactions, which are retried if another client changed the watched
+    keys in the meantime.
+
+    """
+
+    KEY_PREFIX = "dowc:webdav-lock"
+
+    @property
+    def redis(self):
+        return get_redis_connection("default")
+
+    @classmethod
+    def token_key(cls, token) -> str:
+        return f"{cls.KEY_PREFIX}:token:{token}"
+
+    @classmethod
+    def path_key(cls, path: str) -> str:
+        return f"{cls.KEY_PREFIX}:path:{path}"
+
+    def get(self) -> List[str]:
+        """Gets all active locks for the requested resource. Returns a list of locks."""
+        path_key = self.path_key(self.resource.get_path())
+        tokens = [token.decode() for token in self.redis.smembers(path_key)]
+        active = [token for token in tokens if self.redis.exists(self.token_key(token))]
+        expired = set(tokens) - set(active)
+        if expired:
+            self.redis.srem(path_key, *expired)
+        return active
+
+    def acquire(self, lockscope, locktype, depth, timeout, owner):
+        """Creates a new lock for the given resource."""
+        path = self.resource.get_path()
+        token = str(uuid4())
+        lock = {
+            "resource_path": path,
+            "lockscope": lockscope,
+            "locktype": locktype,
+            "depth": depth,
+            "timeout": timeout,
+            "owner": owner,
+        }
+        # A timeout of 0 seconds is treated as a lock without expiry.
+        expiry = timeout * 1000 if timeout else None
+        token_key = self.token_key(token)
+        path_key = self.path_key(path)
+
+        def store(pipe):
+            # -2 if the set doesn't exist yet, -1 if it doesn't expire.
+            ttl = pipe.pttl(path_key)
+            pipe.multi()
+            pipe.set(token_key, json.dumps(lock), nx=True, px=expiry)
+            pipe.sadd(path_key, token)
+            if expiry is None:
+                pipe.persist(path_key)
+            elif ttl == -2 or 0 <= ttl < expiry:
+                pipe.pexpire(path_key, expiry)
+
+        self.redis.transaction(store, path_key)
+        return token
+
+    def refresh(self, token) -> bool:
+        """Refreshes the lock referenced by the given lock id, if it exists."""
+        token = clean_token(token)
+        if token is None:
+            return False
+
+        token_key = self.token_key(token)
+
+        def extend(pipe) -> bool:
+            lock = pipe.get(token_key)
+            if lock is None:
+                return False
+
+            lock = json.loads(lock)
+            if lock["timeout"]:
+                expiry = lock["timeout"] * 1000
+                path_key = self.path_key(lock["resource_path"])
+                pipe.watch(path_key)
+                ttl = pipe.pttl(path_key)
+                pipe.multi()
+                pipe.pexpire(token_key, expiry)
+                if 0 <= ttl < expiry:
+                    pipe.pexpire(path_key, expiry)
+            return True
+
+        return self.redis.transaction(extend, token_key, value_from_callable=True)
+
+    def release(self, token):
+        """Releases the lock referenced by the given lock id."""
+        token = clean_token(token)
+        if token is None:
+            return False
+
+        token_key = self.token_key(token)
+
+        def delete(pipe) -> bool:
+            lock = pipe.get(token_key)
+            if lock is None:
+                return False
+
+            pipe.multi()
+            pipe.delete(token_key)
+            pipe.srem(self.path_key(json.loads(lock)["resource_path"]), token)
+            return True
+
+        return self.redis.transaction(delete, token_key, value_from_callable=True)
+
+    def del_locks(self):
+        """Releases all locks for the given resource."""
+        self.del_locks_for_paths([self.resource.get_path()])
+
+    @classmethod
+    def del_locks_for_paths(cls, paths: Iterable[str]):
+        """Releases all locks for the resources at the given paths."""
+        redis = get_redis_connection("default")
+        for path in paths:
+            path_key = cls.path_key(path)
+
+            def delete(pipe):
+                tokens = pipe.smembers(path_key)
+                pipe.multi()
+                pipe.delete(
+                    path_key, *[cls.token_key(token.decode()) for token in tokens]
+                )
+
+            redis.transaction(delete, path_key)
+
+    @classmethod
+    def del_expired_locks(cls, batch_size: int = 1000) -> int:
+        """Redis expires the locks by itself."""
+        return 0
+
+    @classmethod
+    def del_all_locks(cls):
+        """Releases all locks."""
+        redis = get_redis_connection("default")
+        keys = list(redis.scan_iter(f"{cls.KEY_PREFIX}:*"))
+        if keys:
+            redis.delete(*keys)
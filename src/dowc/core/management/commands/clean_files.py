@@ -1,12 +1,20 @@
+import itertools
 import logging
-from typing import List
+import time
+from typing import Iterator, List, Optional, Tuple
 
 from django.core.management import BaseCommand, CommandError
+from django.db import transaction
 
+from zgw_consumers.concurrent import parallel
+
+from dowc.client import log_pool_stats
 from dowc.core.constants import DocFileTypes
+from dowc.core.locks import get_lock_class
 from dowc.core.managers import DowcQuerySet
-from dowc.core.models import DocumentFile, DocumentLock
+from dowc.core.models import DocumentFile
 from dowc.emails.data import EmailData
+from dowc.emails.email import collect_emails
 
 logger = logging.getLogger(__name__)
 
@@ -14,17 +22,75 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = "Delete documentfile objects and related objects from the DoWC. Users that were in the middle of an editing process will be emailed."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of documentfile objects that are processed per transaction.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of threads that process 'write' documentfile objects at the same time.",
+        )
+
     def handle(self, **options):
+        self.batch_size = options["batch_size"]
+        if self.batch_size < 1:
+            raise CommandError("The batch size should be at least 1.")
+        self.workers = options["workers"]
+        if self.workers < 1:
+            raise CommandError("The number of workers should be at least 1.")
+
         self.bulk_delete_read_files()
-        self.bulk_delete_write_files()
+        # Users get a single email for all of their documents that were closed.
+        with collect_emails():
+            self.bulk_delete_write_files()
         self.bulk_delete_locks()
+        log_pool_stats()
+
+    def get_batches(self, qs: DowcQuerySet, after: int = 0) -> Iterator[List[int]]:
+        """
+        Yields the primary keys of the objects in `qs` in batches, ordered by
+        primary key and starting after primary key `after`.
+
+        """
+        while True:
+            pks = list(
+                qs.filter(pk__gt=after)
+                .order_by("pk")
+                .values_list("pk", flat=True)[: self.batch_size]
+            )
+            if not pks:
+                return
+            yield pks
+            after = pks[-1]
+
+    def write_batch_stats(self, batch: str, deleted: int, count: int, start: float):
+        duration = time.monotonic() - start
+        rate = deleted / duration if duration else deleted
+        self.stdout.write(
+            f"Batch {batch}: deleted {deleted} of {count} documentfile object(s) "
+            f"in {duration:.2f}s ({rate:.1f}/s)."
+        )
 
     def bulk_delete_read_files(self):
         read_qs = DocumentFile.objects.filter(purpose=DocFileTypes.read)
         count = read_qs.count()
         self.stdout.write(f"Found {count} 'read' documentfile object(s).")
         if count > 0:
-            deleted, rest = read_qs.delete()
+            deleted = 0
+            for batch, pks in enumerate(self.get_batches(read_qs), start=1):
+                start = time.monotonic()
+                with transaction.atomic():
+                    batch_deleted, rest = DocumentFile.objects.filter(
+                        pk__in=pks
+                    ).delete()
+                deleted += batch_deleted
+                self.write_batch_stats(str(batch), batch_deleted, len(pks), start)
+
             self.stdout.write(f"Deleted {deleted} 'read' documentfile object(s).")
 
             # Make sure no read documentfile objects remain
@@ -33,15 +99,70 @@ class Command(BaseCommand):
                     f"{count - deleted} 'read' documentfile object(s) failed to be deleted."
                 )
 
+    def claim_and_delete_write_files(
+        self, after: int = 0
+    ) -> Optional[Tuple[List[int], int]]:
+        """
+        Claims a batch of 'write' documentfile objects after primary key
+        `after` and force deletes them.
+
+        The rows stay locked until the batch is committed and rows locked by
+        other workers are skipped, so every document is unlocked in the DRC by
+        one worker only. Processed rows are either deleted or marked as
+        errored, which excludes them from the next claim, so an interrupted
+        run resumes where it stopped. Rows that were skipped because the DRC
+        is unavailable are left for the next run.
+
+        """
+        with transaction.atomic():
+            pks = list(
+                DocumentFile.objects.select_for_update(skip_locked=True)
+                .filter(
+                    purpose=DocFileTypes.write,
+                    error=False,
+                    closing=False,
+                    pk__gt=after,
+                )
+                .order_by("pk")
+                .values_list("pk", flat=True)[: self.batch_size]
+            )
+            if not pks:
+                return None
+
+            # Delete the documentfile objects related to the unlocked documents
+            deleted = DocumentFile.objects.filter(pk__in=pks).force_delete()
+        return pks, deleted
+
+    def delete_write_files(self, worker: int) -> int:
+        deleted = 0
+        after = 0
+        for batch in itertools.count(start=1):
+            start = time.monotonic()
+            result = self.claim_and_delete_write_files(after)
+            if result is None:
+                return deleted
+
+            pks, batch_deleted = result
+            after = pks[-1]
+            count = len(pks)
+            deleted += batch_deleted
+            self.write_batch_stats(f"{worker}.{batch}", batch_deleted, count, start)
+
     def bulk_delete_write_files(self):
-        write_qs = DocumentFile.objects.select_related("user").filter(
-            purpose=DocFileTypes.write
-        )
+        write_qs = DocumentFile.objects.filter(purpose=DocFileTypes.write)
         count = write_qs.count()
         self.stdout.write(f"Found {count} 'write' documentfile object(s).")
         if count > 0:
-            # Delete the documentfile objects related to the unlocked documents
-            deleted = DocumentFile.objects.force_delete()
+            if self.workers == 1:
+                deleted = self.delete_write_files(1)
+            else:
+                with parallel(max_workers=self.workers) as executor:
+                    deleted = sum(
+                        executor.map(
+                            self.delete_write_files, range(1, self.workers + 1)
+                        )
+                    )
+
             self.stdout.write(f"Unlocked {deleted} document(s).")
             self.stdout.write(f"Deleted {deleted} 'write' documentfile object(s).")
 
@@ -52,4 +173,4 @@ class Command(BaseCommand):
                 )
 
     def bulk_delete_locks(self):
-        DocumentLock.objects.all().delete()
+        get_lock_class().del_all_locks()
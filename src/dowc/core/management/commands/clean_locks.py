@@ -0,0 +1,23 @@
+from django.core.management import BaseCommand, CommandError
+
+from dowc.core.locks import get_lock_class
+
+
+class Command(BaseCommand):
+    help = "Delete the WebDAV locks that have expired."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of locks that are deleted per query.",
+        )
+
+    def handle(self, **options):
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("The batch size should be at least 1.")
+
+        deleted = get_lock_class().del_expired_locks(batch_size=batch_size)
+        self.stdout.write(f"Deleted {deleted} expired lock(s).")
@@ -0,0 +1,18 @@
+from django.core.management import BaseCommand
+
+from dowc.core.jobs import process_close_jobs
+
+
+class Command(BaseCommand):
+    help = "Check in and unlock the documents of documentfile objects that are closed in the background."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--burst",
+            action="store_true",
+            help="Stop once the queue is empty instead of waiting for new jobs.",
+        )
+
+    def handle(self, **options):
+        processed = process_close_jobs(burst=options["burst"])
+        self.stdout.write(f"Processed {processed} close job(s).")
@@ -0,0 +1,14 @@
+from django.core.management import BaseCommand
+
+from dowc.core.models import DocumentFile
+from dowc.emails.email import collect_emails
+
+
+class Command(BaseCommand):
+    help = "Retry to check in, unlock and delete documentfile objects that errored in the DRC lock/unlock/update loop."
+
+    def handle(self, **options):
+        with collect_emails():
+            retried, deleted = DocumentFile.objects.retry_errored()
+        self.stdout.write(f"Retried {retried} errored 'write' documentfile object(s).")
+        self.stdout.write(f"Deleted {deleted} 'write' documentfile object(s).")
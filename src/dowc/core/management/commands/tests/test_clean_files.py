@@ -1,9 +1,12 @@
+import threading
 import uuid
+from collections import Counter
+from io import StringIO
 from unittest.mock import patch
 
 from django.core import mail
-from django.core.management import call_command
-from django.test import TestCase
+from django.core.management import CommandError, call_command
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
 from django.utils.translation import gettext_lazy as _
 
 from furl import furl
@@ -52,7 +55,8 @@ class CleanFilesTests(TestCase):
         # Create fake content
         cls.content = b"some content"
         cls.download_document_content_patcher = patch(
-            "dowc.core.models.get_document_content", return_value=cls.content
+            "dowc.core.models.stream_document_content",
+            return_value=[cls.content],
         )
 
         # Create a response for update_document call
@@ -115,7 +119,8 @@ class CleanFilesTests(TestCase):
         with patch(
             "dowc.core.managers.unlock_document", return_value=(self.document, True)
         ):
-            call_command("clean_files")
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command("clean_files")
 
         # Assert number of documents is zero
         number_of_documentfiles = DocumentFile.objects.all().count()
@@ -193,3 +198,131 @@ class CleanFilesTests(TestCase):
         df = DocumentFile.objects.get()
         self.assertTrue(df.error)
         self.assertEqual(df.error_msg, DOCUMENT_COULD_NOT_BE_UNLOCKED)
+
+    @temp_private_root()
+    def test_clean_document_files_drc_unavailable(self):
+        for i in range(2):
+            DocumentFileFactory.create(
+                drc_url=self.test_doc_url,
+                unversioned_url=f"{self.test_doc_url}-{i}",
+                purpose=DocFileTypes.write,
+                user=self.user,
+            )
+
+        with patch(
+            "dowc.core.managers.unlock_document",
+            side_effect=lambda url, lock: (url, None),
+        ) as mock_unlock:
+            call_command("clean_files", batch_size=1, stdout=StringIO())
+
+        # Every documentfile is tried once and left for the next run.
+        self.assertEqual(mock_unlock.call_count, 2)
+        self.assertEqual(DocumentFile.objects.filter(error=False).count(), 2)
+        self.assertFalse(mail.outbox)
+
+    @temp_private_root()
+    def test_clean_document_files_in_batches(self):
+        DocumentFileFactory.create_batch(
+            3, drc_url=self.test_doc_url, purpose=DocFileTypes.write, user=self.user
+        )
+
+        stdout = StringIO()
+        with patch(
+            "dowc.core.managers.unlock_document", return_value=(self.document, True)
+        ):
+            call_command("clean_files", batch_size=2, stdout=stdout)
+
+        self.assertFalse(DocumentFile.objects.exists())
+        output = stdout.getvalue()
+        self.assertIn("Batch 1.1: deleted 2 of 2 documentfile object(s)", output)
+        self.assertIn("Batch 1.2: deleted 1 of 1 documentfile object(s)", output)
+        self.assertIn("Deleted 3 'write' documentfile object(s).", output)
+
+    @temp_private_root()
+    def test_clean_document_files_skips_errored(self):
+        """
+        Errored documentfile objects are not claimed again, so the run ends
+        even though they are not deleted.
+        """
+        errored = DocumentFileFactory.create(
+            drc_url=self.test_doc_url,
+            purpose=DocFileTypes.write,
+            user=self.user,
+            error=True,
+        )
+        DocumentFileFactory.create(
+            drc_url=self.test_doc_url, purpose=DocFileTypes.write, user=self.user
+        )
+
+        with patch(
+            "dowc.core.managers.unlock_document", return_value=(self.document, True)
+        ):
+            with patch("dowc.core.managers.update_document") as mock_update:
+                call_command("clean_files", batch_size=1)
+
+        self.assertEqual(list(DocumentFile.objects.all()), [errored])
+        mock_update.assert_not_called()
+
+    def test_clean_document_files_invalid_workers(self):
+        with self.assertRaises(CommandError):
+            call_command("clean_files", workers=0)
+
+
+@temp_private_root()
+class CleanFilesWorkersTests(TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = UserFactory.create()
+        self.document = factory(
+            Document,
+            generate_oas_component(
+                "drc",
+                "schemas/EnkelvoudigInformatieObject",
+                url=f"https://some.drc.nl/api/v1/enkelvoudiginformatieobjecten/{uuid.uuid4()}",
+                bestandsnaam="bestandsnaam.docx",
+            ),
+        )
+        for target, return_value in [
+            ("dowc.core.models.get_document", self.document),
+            ("dowc.core.models.stream_document_content", [b"some content"]),
+            ("dowc.core.models.lock_document", uuid.uuid4().hex),
+        ]:
+            patcher = patch(target, return_value=return_value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @skipUnlessDBFeature("has_select_for_update_skip_locked")
+    def test_clean_document_files_with_workers(self):
+        """
+        Workers claim their batches with SKIP LOCKED, which needs a database
+        that supports it.
+        """
+        docfiles = [
+            DocumentFileFactory.create(
+                drc_url=self.document.url,
+                unversioned_url=f"{self.document.url}-{i}",
+                purpose=DocFileTypes.write,
+                user=self.user,
+            )
+            for i in range(7)
+        ]
+        unlocked = Counter()
+        unlocked_lock = threading.Lock()
+
+        def unlock_document(url, lock):
+            with unlocked_lock:
+                unlocked[url] += 1
+            return self.document, True
+
+        stdout = StringIO()
+        with patch("dowc.core.managers.unlock_document", side_effect=unlock_document):
+            call_command("clean_files", batch_size=2, workers=3, stdout=stdout)
+
+        # Every documentfile is claimed, unlocked and emailed exactly once.
+        self.assertEqual(
+            unlocked, Counter(docfile.unversioned_url for docfile in docfiles)
+        )
+        self.assertFalse(DocumentFile.objects.exists())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(len(mail.outbox[0].body.split(".docx")) - 1, 7)
+        self.assertIn("Deleted 7 'write' documentfile object(s).", stdout.getvalue())
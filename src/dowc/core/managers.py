@@ -1,18 +1,30 @@
-from typing import List, Tuple
+import logging
+from datetime import timedelta
+from typing import List, Optional, Tuple, Union
 
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import F, Q
 from django.db.models.deletion import Collector
+from django.utils import timezone
 
 from zgw_consumers.api_models.documenten import Document
 from zgw_consumers.concurrent import parallel
 
 from dowc.core.utils import unlock_document, update_document
+from dowc.emails.data import EmailData
+from dowc.emails.email import send_emails
 
 from .constants import (
     DOCUMENT_COULD_NOT_BE_UNLOCKED,
     DOCUMENT_COULD_NOT_BE_UPDATED,
+    DOCUMENTFILE_CACHE_KEY,
     DocFileTypes,
 )
+from .resource import delete_temporary_files
+
+logger = logging.getLogger(__name__)
 
 
 class DowcQuerySet(models.QuerySet):
@@ -25,6 +37,44 @@ class DowcQuerySet(models.QuerySet):
     DRC API and then continue to delete.
     """
 
+    # The uuids of the documentfiles the queryset is limited to, if known.
+    _known_uuids: Optional[List] = None
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._known_uuids = self._known_uuids
+        return clone
+
+    def for_documentfile(self, docfile) -> "DowcQuerySet":
+        """
+        Limits the queryset to `docfile`, whose cached object is cleared on an
+        update without querying its uuid first.
+        """
+        qs = self.filter(pk=docfile.pk)
+        qs._known_uuids = [docfile.uuid]
+        return qs
+
+    def update(self, **kwargs) -> int:
+        # Updates, including bulk updates, bypass the signals that clear the
+        # cached documentfiles.
+        uuids = self._known_uuids
+        if uuids is None:
+            uuids = (
+                list(self.values_list("uuid", flat=True))
+                if settings.WEBDAV_OBJECT_CACHE_TIMEOUT
+                else []
+            )
+        updated = super().update(**kwargs)
+        self._clear_cache(uuids)
+        return updated
+
+    @staticmethod
+    def _clear_cache(uuids: list) -> None:
+        if uuids:
+            cache.delete_many(
+                [DOCUMENTFILE_CACHE_KEY.format(uuid=_uuid) for _uuid in uuids]
+            )
+
     def delete(self) -> Tuple[int, dict]:
         qs = self._chain()
         deletion_query = qs.filter(
@@ -35,20 +85,22 @@ class DowcQuerySet(models.QuerySet):
         deleted, _rows_count = collector.delete()
         return deleted, _rows_count
 
+    @staticmethod
+    def _update_on_drc(document) -> Optional[Tuple[Union[str, Document], bool]]:
+        changed_doc = document.update_drc_document()
+        if not changed_doc:
+            return None
+        return update_document(document.unversioned_url, changed_doc)
+
     def _bulk_update_on_drc(
         self, documents: models.QuerySet
-    ) -> List[Tuple[Document, bool]]:
-        documents_to_be_updated = []
-        urls = []
-        for document in documents:
-            changed_doc = document.update_drc_document()
-            if changed_doc:
-                documents_to_be_updated.append(changed_doc)
-                urls.append(document.unversioned_url)
-
-        with parallel() as executor:
-            results = list(executor.map(update_document, urls, documents_to_be_updated))
-        return results
+    ) -> List[Tuple[Union[str, Document], Optional[bool]]]:
+        # Every document is compared, encoded and uploaded by one worker, so
+        # only as many documents are in flight as there are workers.
+        documents = documents.select_related("user").iterator()
+        with parallel(max_workers=settings.DRC_BULK_UPDATE_WORKERS) as executor:
+            results = executor.map(self._update_on_drc, documents)
+            return [result for result in results if result is not None]
 
     def handle_errors(self, errored_docs: List[str], error_msg: str = ""):
         qs = self._chain()
@@ -62,19 +114,30 @@ class DowcQuerySet(models.QuerySet):
         qs = self._chain()
 
         # Get all documentfile objects with the purpose 'write' and which have not yet been marked as safe for deletion
-        unsafe_for_deletion = qs.filter(
-            purpose=DocFileTypes.write, safe_for_deletion=False, error=False
-        ).all()
+        unsafe_for_deletion = (
+            qs.select_related("user")
+            .filter(
+                purpose=DocFileTypes.write,
+                safe_for_deletion=False,
+                error=False,
+                closing=False,
+            )
+            .all()
+        )
 
         # Update documents on DRC
         results = self._bulk_update_on_drc(unsafe_for_deletion)
 
         # Handle any errors and filter documents that didn't error out:
         self.handle_errors(
-            [doc for doc, success in results if not success],
+            [doc for doc, success in results if success is False],
             error_msg=DOCUMENT_COULD_NOT_BE_UPDATED,
         )
-        unsafe_for_deletion = unsafe_for_deletion.all()
+        # Documents that couldn't reach the DRC are tried again on a next run.
+        unavailable = [doc for doc, success in results if success is None]
+        unsafe_for_deletion = unsafe_for_deletion.exclude(
+            unversioned_url__in=unavailable
+        )
 
         # Initialize empty lists for the drc urls and the related locks
         unlock_urls = []
@@ -90,10 +153,13 @@ class DowcQuerySet(models.QuerySet):
 
         # Handle any errors and filter documents that didn't error out:
         self.handle_errors(
-            [doc for doc, success in results if not success],
+            [doc for doc, success in results if success is False],
             error_msg=DOCUMENT_COULD_NOT_BE_UNLOCKED,
         )
-        unsafe_for_deletion = unsafe_for_deletion.all()
+        unavailable = [doc for doc, success in results if success is None]
+        unsafe_for_deletion = unsafe_for_deletion.exclude(
+            unversioned_url__in=unavailable
+        )
 
         # Mark safe for deletion
         for docfile in unsafe_for_deletion:
@@ -103,11 +169,146 @@ class DowcQuerySet(models.QuerySet):
         # Bulk update the safe_for_deletion field
         self.bulk_update(unsafe_for_deletion, ["safe_for_deletion", "force_deleted"])
 
-        # Call 'normal' delete method on object to send email
-        deleted = 0
-        for docfile in unsafe_for_deletion:
-            docfile.delete()
-            deleted += 1
+        # Delete the objects, their files and locks in bulk and email the users
+        deleted = self._bulk_force_delete(list(unsafe_for_deletion))
 
         read_deleted, _ = self.delete()
         return deleted + read_deleted
+
+    def _bulk_force_delete(self, docfiles: List) -> int:
+        """
+        Deletes force deleted documentfile objects with a single query.
+
+        This bypasses the post_delete signals, so the files, the WebDAV locks,
+        the cached objects and the emails they would take care of per object
+        are handled here in bulk instead, once the deletion is committed.
+        """
+        if not docfiles:
+            return 0
+
+        deleted = self.model.objects.filter(
+            pk__in=[docfile.pk for docfile in docfiles]
+        )._raw_delete(self.db)
+        transaction.on_commit(
+            lambda: self._clean_up_force_deleted(docfiles), using=self.db
+        )
+        return deleted
+
+    def _clean_up_force_deleted(self, docfiles: List) -> None:
+        from .locks import get_lock_class
+        from .models import get_propfind_version_key
+
+        resource_paths = []
+        for docfile in docfiles:
+            for field_file in (docfile.document, docfile.original_document):
+                if field_file.name:
+                    field_file.storage.delete(field_file.name)
+            if docfile.document.name:
+                delete_temporary_files(docfile.document.path)
+            resource_paths.append(docfile.get_resource_path())
+
+        get_lock_class().del_locks_for_paths(resource_paths)
+        self._clear_cache([docfile.uuid for docfile in docfiles])
+        cache.delete_many(
+            list({get_propfind_version_key(docfile) for docfile in docfiles})
+        )
+
+        send_emails(
+            [
+                EmailData(
+                    user=docfile.user,
+                    filename=docfile.filename,
+                    info_url=docfile.info_url,
+                )
+                for docfile in docfiles
+            ]
+        )
+
+    def retry_errored(self) -> Tuple[int, int]:
+        """
+        Retries to check in, unlock and delete errored 'write' documentfiles
+        that are due for a retry.
+
+        Documentfiles that error again are retried with an exponential
+        backoff. After `DOCUMENT_ERROR_MAX_ATTEMPTS` attempts the error is
+        escalated and the documentfile is no longer retried.
+
+        Returns the number of retried and deleted documentfiles.
+        """
+        now = timezone.now()
+        qs = self._chain()
+        pks = list(
+            qs.filter(
+                purpose=DocFileTypes.write,
+                error=True,
+                error_attempts__lt=settings.DOCUMENT_ERROR_MAX_ATTEMPTS,
+                closing=False,
+            )
+            .filter(Q(next_retry__isnull=True) | Q(next_retry__lte=now))
+            .values_list("pk", flat=True)
+        )
+        if not pks:
+            return 0, 0
+
+        self.model.objects.filter(pk__in=pks).update(
+            error=False,
+            error_attempts=F("error_attempts") + 1,
+            next_retry=None,
+        )
+        deleted = self.model.objects.filter(pk__in=pks).force_delete()
+
+        # Documentfiles that were skipped because the DRC is unavailable are
+        # flagged again, without counting the attempt.
+        skipped = list(
+            self.model.objects.filter(pk__in=pks, error=False).values_list(
+                "pk", flat=True
+            )
+        )
+        self.model.objects.filter(pk__in=skipped).update(
+            error=True, error_attempts=F("error_attempts") - 1
+        )
+
+        errored = list(
+            self.model.objects.filter(pk__in=pks, error=True).exclude(pk__in=skipped)
+        )
+        for docfile in errored:
+            if docfile.error_attempts >= settings.DOCUMENT_ERROR_MAX_ATTEMPTS:
+                logger.error(
+                    "Giving up on documentfile %s after %d attempts. Document %s is still locked with lock %s: %s",
+                    docfile.uuid,
+                    docfile.error_attempts,
+                    docfile.unversioned_url,
+                    docfile.lock,
+                    docfile.error_msg,
+                )
+            else:
+                delay = settings.DOCUMENT_ERROR_RETRY_DELAY * 2 ** (
+                    docfile.error_attempts - 1
+                )
+                docfile.next_retry = now + timedelta(seconds=delay)
+        self.bulk_update(errored, ["next_retry"])
+        return len(pks), deleted
+
+
+class DocumentLockQuerySet(models.QuerySet):
+    def active(self) -> "DocumentLockQuerySet":
+        return self.filter(
+            Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now())
+        )
+
+    def expired(self) -> "DocumentLockQuerySet":
+        return self.filter(expires_at__lte=timezone.now())
+
+    def delete_expired(self, batch_size: int = 1000) -> int:
+        """
+        Deletes the expired locks in batches, so the table is never locked
+        for long.
+
+        """
+        deleted = 0
+        while True:
+            pks = list(self.expired().values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            batch_deleted, _rest = self.model.objects.filter(pk__in=pks).delete()
+            deleted += batch_deleted
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.12 on 2026-10-17 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0013_documentfile_zaak"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="documentfile",
+            name="original_digest",
+            field=models.CharField(
+                blank=True,
+                default="",
+                help_text="SHA-256 digest of the original document. Used to check if the document is edited without comparing the files byte for byte.",
+                max_length=64,
+                verbose_name="original document digest",
+            ),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.12 on 2026-10-17 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0014_documentfile_original_digest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="documentfile",
+            name="closing",
+            field=models.BooleanField(
+                default=False,
+                help_text="Flags that the document is being checked in and unlocked on the DRC by a background worker.",
+            ),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.12 on 2026-10-17 15:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0015_documentfile_closing"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="documentfile",
+            name="error_attempts",
+            field=models.PositiveSmallIntegerField(
+                default=0,
+                help_text="Number of times the DRC lock/unlock/update loop was retried.",
+            ),
+        ),
+        migrations.AddField(
+            model_name="documentfile",
+            name="next_retry",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="Moment the DRC lock/unlock/update loop is retried. Errored documentfiles without one are retried on the next run.",
+                null=True,
+            ),
+        ),
+    ]
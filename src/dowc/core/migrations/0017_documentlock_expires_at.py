@@ -0,0 +1,33 @@
+# Generated by Django 3.2.12 on 2026-10-17 04:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0016_documentfile_error_attempts_next_retry"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="documentlock",
+            name="expires_at",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="Moment the lock expires. Locks without one never expire.",
+                null=True,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="documentlock",
+            index=models.Index(
+                fields=["resource_path", "expires_at"],
+                name="core_lock_path_expires_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="documentlock",
+            index=models.Index(fields=["expires_at"], name="core_lock_expires_idx"),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.12 on 2026-10-17 04:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0017_documentlock_expires_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="documentfile",
+            name="document_digest",
+            field=models.CharField(
+                blank=True,
+                default="",
+                help_text="SHA-256 digest of the document, computed while it is uploaded over WebDAV.",
+                max_length=64,
+                verbose_name="document digest",
+            ),
+        ),
+    ]
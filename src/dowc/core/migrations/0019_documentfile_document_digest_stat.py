@@ -0,0 +1,33 @@
+# Generated by Django 3.2.12 on 2026-10-17 04:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0018_documentfile_document_digest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="documentfile",
+            name="document_digest_mtime_ns",
+            field=models.BigIntegerField(
+                blank=True,
+                help_text="Modification time in nanoseconds of the document the digest was computed for. The digest is not used if the document was modified since.",
+                null=True,
+                verbose_name="document digest modification time",
+            ),
+        ),
+        migrations.AddField(
+            model_name="documentfile",
+            name="document_digest_size",
+            field=models.PositiveBigIntegerField(
+                blank=True,
+                help_text="Size of the document the digest was computed for. The digest is not used if the document has a different size.",
+                null=True,
+                verbose_name="document digest size",
+            ),
+        ),
+    ]
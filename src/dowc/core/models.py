@@ -1,28 +1,34 @@
-import base64
 import functools
 import logging
 import os
 import uuid
-from typing import Dict, Optional
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
 
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.cache import cache
 from django.db import models
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_save
 from django.dispatch.dispatcher import receiver
+from django.utils import timezone
 from django.utils.crypto import salted_hmac
 from django.utils.translation import gettext_lazy as _
 
 from privates.fields import PrivateMediaFileField
 from rest_framework.exceptions import APIException
 from zgw_consumers.api_models.documenten import Document
+from zgw_consumers.concurrent import parallel
+from zgw_consumers.models import Service
 
 from dowc.accounts.models import User
 from dowc.core.utils import (
+    circuit_breaker,
+    client_cache,
     get_document,
-    get_document_content,
     lock_document,
+    stream_document_content,
     unlock_document,
+    update_document,
 )
 from dowc.emails.data import EmailData
 from dowc.emails.email import send_emails
@@ -30,10 +36,14 @@ from dowc.emails.email import send_emails
 from .constants import (
     DOCUMENT_COULD_NOT_BE_UNLOCKED,
     DOCUMENT_COULD_NOT_BE_UPDATED,
+    DOCUMENTFILE_CACHE_KEY,
+    PROPFIND_VERSION_KEY,
     DocFileTypes,
     ResourceSubFolders,
 )
-from .managers import DowcQuerySet
+from .files import StreamedFile, copy_field_file, file_digest, save_streamed_file
+from .managers import DocumentLockQuerySet, DowcQuerySet
+from .resource import delete_temporary_files
 
 logger = logging.getLogger(__name__)
 
@@ -110,6 +120,11 @@ def get_parent_folder(instance, subfolder):
     return os.path.join(hash_string, subfolder)
 
 
+def get_propfind_version_key(instance) -> str:
+    folder = get_parent_folder(instance, ResourceSubFolders.public)
+    return PROPFIND_VERSION_KEY.format(folder=folder)
+
+
 def get_user_filepath_protected(instance, filename):
     parent_folder = get_parent_folder(instance, ResourceSubFolders.protected)
     return os.path.join(parent_folder, filename)
@@ -178,6 +193,40 @@ class DocumentFile(models.Model):
         ),
         upload_to=get_user_filepath_protected,
     )
+    original_digest = models.CharField(
+        _("original document digest"),
+        help_text=_(
+            "SHA-256 digest of the original document. Used to check if the document is edited without comparing the files byte for byte."
+        ),
+        max_length=64,
+        default="",
+        blank=True,
+    )
+    document_digest = models.CharField(
+        _("document digest"),
+        help_text=_(
+            "SHA-256 digest of the document, computed while it is uploaded over WebDAV."
+        ),
+        max_length=64,
+        default="",
+        blank=True,
+    )
+    document_digest_size = models.PositiveBigIntegerField(
+        _("document digest size"),
+        help_text=_(
+            "Size of the document the digest was computed for. The digest is not used if the document has a different size."
+        ),
+        null=True,
+        blank=True,
+    )
+    document_digest_mtime_ns = models.BigIntegerField(
+        _("document digest modification time"),
+        help_text=_(
+            "Modification time in nanoseconds of the document the digest was computed for. The digest is not used if the document was modified since."
+        ),
+        null=True,
+        blank=True,
+    )
     purpose = models.CharField(
         max_length=8,
         choices=DocFileTypes.choices,
@@ -217,6 +266,23 @@ class DocumentFile(models.Model):
         ),
     )
     error_msg = models.TextField(default="", help_text=_("Copy of the error message."))
+    error_attempts = models.PositiveSmallIntegerField(
+        default=0,
+        help_text=_("Number of times the DRC lock/unlock/update loop was retried."),
+    )
+    next_retry = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text=_(
+            "Moment the DRC lock/unlock/update loop is retried. Errored documentfiles without one are retried on the next run."
+        ),
+    )
+    closing = models.BooleanField(
+        default=False,
+        help_text=_(
+            "Flags that the document is being checked in and unlocked on the DRC by a background worker."
+        ),
+    )
 
     class Meta:
         verbose_name = _("Document file")
@@ -260,29 +326,63 @@ class DocumentFile(models.Model):
 
         """
         if self.purpose == DocFileTypes.write:
-            self.unlock_drc_document()
+            if self.unlock_drc_document() is None:
+                # The DRC is unavailable, the document is still locked.
+                return
 
         self.force_deleted = True
         self.save()
 
         self.delete()
 
-    def get_drc_document(self):
+    def get_resource_path(self) -> str:
+        """
+        Returns the path of the WebDAV resource of the document, which its
+        WebDAV locks are stored under.
+
+        """
+        return "/" + self.document.name.strip("/")
+
+    def get_drc_document(self, document: Optional[Document] = None) -> StreamedFile:
+        """
+        Creates a StreamedFile from document data from DRC API.
+
+        The content is streamed in chunks as it is written to storage,
+        so it can only be consumed once. If the document metadata was already
+        retrieved it is not fetched again.
+
         """
-        Creates a temporary ContentFile from document data from DRC API.
+        if document is None:
+            document = get_document(self.drc_url)
+        content = stream_document_content(document.inhoud)
+        return StreamedFile(content, name=document.bestandsnaam)
 
+    def lock_and_get_drc_document(self) -> Document:
         """
-        document = get_document(self.drc_url)
-        content = get_document_content(document.inhoud)
-        temp_doc = ContentFile(content, name=document.bestandsnaam)
-        return temp_doc
+        Locks the document in the DRC API and retrieves its metadata.
+
+        The retrieve doesn't depend on the lock, so both requests are sent
+        concurrently. The lock is stored on the instance even if the retrieve
+        fails, so it is released again when the creation is rolled back.
+
+        """
+        with parallel(max_workers=2) as executor:
+            lock = executor.submit(lock_document, self.unversioned_url)
+            document = executor.submit(get_document, self.drc_url)
+
+        self.lock = lock.result()
+        return document.result()
 
-    def unlock_drc_document(self):
+    def unlock_drc_document(self) -> Optional[bool]:
         """
         This unlocks the documents and marks it safe for deletion.
 
+        Returns None, without flagging an error, if the DRC is unavailable.
+
         """
         self.api_document, success = unlock_document(self.unversioned_url, self.lock)
+        if success is None:
+            return None
 
         if success:
             self.safe_for_deletion = True
@@ -290,38 +390,60 @@ class DocumentFile(models.Model):
             self.error = True
             self.error_msg = DOCUMENT_COULD_NOT_BE_UNLOCKED
         self.save()
+        return success
 
-    def update_drc_document(self) -> Optional[Dict[str, str]]:
+    def check_in_drc_document(self) -> Optional[bool]:
         """
-        Checks against the local original of the document to see if the
-        document was changed.
+        Updates the document on the DRC if it was changed and unlocks it.
 
-        If it was changed - return the new data.
+        Returns False if the document could not be updated, in which case it
+        is left locked. Returns None if the DRC is unavailable and the check in
+        should be tried again later.
 
         """
+        updated_doc = self.update_drc_document()
+        if updated_doc:
+            doc, success = update_document(self.unversioned_url, updated_doc)
+            if success is None:
+                return None
+            if not success:
+                self.error = True
+                self.error_msg = DOCUMENT_COULD_NOT_BE_UPDATED
+                self.save()
+                return False
+
+        if self.unlock_drc_document() is None:
+            return None
+        return True
+
+    def update_drc_document(self) -> Optional[Dict[str, Any]]:
+        """
+        Checks against the local original of the document to see if the
+        document was changed.
 
-        # Get original document
-        with self.original_document.storage.open(
-            self.original_document.name
-        ) as ori_doc:
-            original_content = ori_doc.read()
-            original_document = ContentFile(original_content, name=self.filename)
+        If it was changed - return the new data. The `inhoud` is the edited
+        document file, which is encoded while it is uploaded to the DRC.
 
-        # Get new document
-        with self.document.storage.open(self.document.name) as edi_doc:
-            edited_content = edi_doc.read()
-            edited_document = ContentFile(edited_content, name=self.filename)
+        """
 
-        # Check for any changes in size, content or name
-        size_change = original_document.size != edited_document.size
-        content_change = original_content != edited_content
+        # Check for any changes in size, content or name. The content is
+        # only hashed if the size and name didn't change.
+        edited_size = self.document.size
+        size_change = self.original_document.size != edited_size
+        content_change = False
+        if not size_change and not self.changed_name:
+            original_digest = self.original_digest or file_digest(
+                self.original_document
+            )
+            edited_digest = self.get_document_digest()
+            content_change = edited_digest != original_digest
 
         if any([size_change, content_change, self.changed_name]):
             data = {
                 "auteur": self.user.get_full_name() or self.user.username,
-                "bestandsomvang": edited_document.size,
+                "bestandsomvang": edited_size,
                 "bestandsnaam": self.filename,
-                "inhoud": base64.b64encode(edited_content).decode("utf-8"),
+                "inhoud": self.document,
                 "lock": self.lock,
             }
 
@@ -330,6 +452,26 @@ class DocumentFile(models.Model):
 
         return None
 
+    def get_document_digest(self) -> str:
+        """
+        Returns the digest of the document.
+
+        The digest computed during the WebDAV upload is only used if the
+        document wasn't changed since, otherwise the document is hashed.
+
+        """
+        if self.document_digest:
+            try:
+                stat = os.stat(self.document.path)
+            except OSError:
+                stat = None
+            if stat and (stat.st_size, stat.st_mtime_ns) == (
+                self.document_digest_size,
+                self.document_digest_mtime_ns,
+            ):
+                return self.document_digest
+        return file_digest(self.document)
+
     @rollback_file_creation(logger)
     def save(self, **kwargs):
         """
@@ -341,17 +483,20 @@ class DocumentFile(models.Model):
         if not self.pk:
             # Lock document in DRC API if purpose is to write
             if self.purpose == DocFileTypes.write:
-                self.lock = lock_document(self.unversioned_url)
+                document = self.lock_and_get_drc_document()
+            else:
+                document = get_document(self.drc_url)
 
-            drc_doc = self.get_drc_document()
+            drc_doc = self.get_drc_document(document)
             self.filename = drc_doc.name
 
-            # Save it to document...
-            self.document = drc_doc
+            # Stream it to document...
+            save_streamed_file(self.document, drc_doc.name, drc_doc)
+            self.original_digest = drc_doc.digest
 
-            # ... and original document fields.
+            # ... and copy it to original document fields.
             if self.purpose == DocFileTypes.write:
-                self.original_document = drc_doc
+                copy_field_file(self.document, self.original_document, self.filename)
 
         super().save(**kwargs)
 
@@ -364,6 +509,46 @@ class DocumentLock(models.Model):
     timeout = models.IntegerField()
     owner = models.CharField(max_length=256, blank=True, null=True)
     token = models.UUIDField(unique=True, default=uuid.uuid4)
+    expires_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text=_("Moment the lock expires. Locks without one never expire."),
+    )
+
+    objects = DocumentLockQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["resource_path", "expires_at"],
+                name="core_lock_path_expires_idx",
+            ),
+            models.Index(fields=["expires_at"], name="core_lock_expires_idx"),
+        ]
+
+    def get_expires_at(self) -> Optional[datetime]:
+        return (
+            timezone.now() + timedelta(seconds=self.timeout) if self.timeout else None
+        )
+
+
+@receiver([post_save, post_delete], sender=DocumentFile)
+def clear_documentfile_cache(sender, instance, **kwargs):
+    """
+    Makes sure the WebDAV views don't use a changed or deleted documentfile.
+
+    """
+    cache.delete(DOCUMENTFILE_CACHE_KEY.format(uuid=instance.uuid))
+
+
+@receiver(post_delete, sender=DocumentFile)
+def clear_propfind_cache(sender, instance, **kwargs):
+    """
+    Makes sure the cached PROPFIND responses of the folder don't list the
+    deleted document anymore.
+
+    """
+    cache.delete(get_propfind_version_key(instance))
 
 
 @receiver(post_delete, sender=DocumentFile)
@@ -399,6 +584,17 @@ def email_user_that_documentfile_was_force_deleted(sender, instance, **kwargs):
         )
 
 
+@receiver([post_save, post_delete], sender=Service)
+def clear_client_cache(sender, instance, **kwargs):
+    """
+    Makes sure clients are rebuilt with the new service configuration, and
+    that requests to the service are tried again.
+
+    """
+    client_cache.clear()
+    circuit_breaker.clear()
+
+
 def delete_files(instance):
     """
     Deletes files from a DocumentFile instance
@@ -411,6 +607,7 @@ def delete_files(instance):
     if name:
         if storage.exists(name):
             storage.delete(name)
+        delete_temporary_files(storage.path(name))
 
     original_storage = instance.original_document.storage
     original_name = instance.original_document.name
@@ -421,6 +618,7 @@ def delete_files(instance):
 
 
 def delete_locks(instance):
+    from .locks import get_lock_class
+
     assert type(instance) == DocumentFile
-    locks = DocumentLock.objects.filter(resource_path=instance.document.path)
-    locks.delete()
+    get_lock_class().del_locks_for_paths([instance.get_resource_path()])
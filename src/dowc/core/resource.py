@@ -1,18 +1,124 @@
-import shutil
+import hashlib
+import os
+import re
+import uuid
+from typing import Optional
 
 from django.conf import settings
 
 from djangodav.base.resources import MetaEtagMixIn
 from djangodav.fs.resources import BaseFSDavResource
 
+from .constants import ResourceSubFolders
+from .exceptions import DocumentTooLarge
+
+
+def get_temporary_folder(path: str) -> str:
+    """
+    Returns the folder for the temporary files of the resource at `path`.
+
+    The folder is a sibling of the folder of the resource, so the files aren't
+    listed in the WebDAV folder but can still be renamed into place.
+    """
+    return os.path.join(
+        os.path.dirname(os.path.dirname(path)), ResourceSubFolders.temporary
+    )
+
+
+def get_temporary_path(path: str) -> str:
+    filename = os.path.basename(path)
+    return os.path.join(
+        get_temporary_folder(path), f".{filename}.{uuid.uuid4().hex}.tmp"
+    )
+
+
+def delete_temporary_files(path: str) -> None:
+    """
+    Deletes the temporary files that writes to the resource at `path` left
+    behind, e.g. when the process was killed.
+    """
+    folder = get_temporary_folder(path)
+    filename = re.escape(os.path.basename(path))
+    pattern = re.compile(rf"\.{filename}\.[0-9a-f]{{32}}\.tmp")
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if pattern.fullmatch(name):
+            try:
+                os.remove(os.path.join(folder, name))
+            except FileNotFoundError:
+                pass
+
 
 class WebDavResource(MetaEtagMixIn, BaseFSDavResource):
-    root = settings.PRIVATE_MEDIA_ROOT
+    # SHA-256 digest and stat of the content of the last write.
+    digest: Optional[str] = None
+    stat: Optional[os.stat_result] = None
+
+    @property
+    def root(self):
+        return settings.PRIVATE_MEDIA_ROOT
 
     def read(self):
         with open(self.get_abs_path(), "rb") as f:
             return f.read()
 
     def write(self, request):
-        with open(self.get_abs_path(), "wb") as dst:
-            shutil.copyfileobj(request, dst)
+        """
+        Writes the request body to a temporary file in the temporary folder
+        and replaces the resource with it once the whole body is received.
+
+        Readers see either the old or the new content, never a partially
+        written file. The content is hashed while it is written, the digest
+        is only valid for a file with the same size and modification time.
+
+        """
+        max_size = settings.WEBDAV_PUT_MAX_SIZE
+        content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+        if max_size and content_length > max_size:
+            raise DocumentTooLarge()
+
+        path = self.get_abs_path()
+        directory = os.path.dirname(path)
+        tmp_path = get_temporary_path(path)
+        os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+        file_hash = hashlib.sha256()
+        size = 0
+
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, "wb") as dst:
+                while chunk := request.read(settings.WEBDAV_PUT_BUFFER_SIZE):
+                    size += len(chunk)
+                    if max_size and size > max_size:
+                        raise DocumentTooLarge()
+                    file_hash.update(chunk)
+                    dst.write(chunk)
+
+                dst.flush()
+                if settings.WEBDAV_PUT_FSYNC:
+                    os.fsync(dst.fileno())
+                # The file keeps its size and modification time when it is
+                # renamed.
+                stat = os.fstat(dst.fileno())
+
+            if settings.FILE_UPLOAD_PERMISSIONS is not None:
+                os.chmod(tmp_path, settings.FILE_UPLOAD_PERMISSIONS)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if settings.WEBDAV_PUT_FSYNC:
+            # Persist the rename as well.
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+        self.digest = file_hash.hexdigest()
+        self.stat = stat
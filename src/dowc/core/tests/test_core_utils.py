@@ -1,20 +1,41 @@
+import base64
+import json
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
 from urllib.parse import urlparse
 
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db.models.fields.files import FieldFile
+from django.test import override_settings
+
+import requests
 import requests_mock
 from furl import furl
+from privates.storages import private_media_storage
+from privates.test import temp_private_root
 from rest_framework.test import APITestCase
 from zgw_consumers.api_models.base import factory
 from zgw_consumers.api_models.documenten import Document
-from zgw_consumers.constants import APITypes
+from zgw_consumers.constants import APITypes, AuthTypes
 from zgw_consumers.models import Service
 from zgw_consumers.test import generate_oas_component, mock_service_oas_get
 
-from dowc.client import Client
+from dowc.client import Client, SessionPool, get_session
+from dowc.core.models import DocumentFile
 from dowc.core.utils import (
+    CircuitOpenError,
+    circuit_breaker,
+    client_cache,
     get_client,
     get_document,
     lock_document,
+    stream_document_content,
+    supports_bestandsdelen,
     unlock_document,
     update_document,
 )
@@ -26,6 +47,11 @@ class GetClientTests(APITestCase):
         super().setUpTestData()
         cls.DRC_URL = "https://some.drc.nl/api/v1/"
 
+    def setUp(self):
+        super().setUp()
+        client_cache.clear()
+        self.addCleanup(client_cache.clear)
+
     def test_fail_get_client_no_service(self):
         with self.assertRaises(RuntimeError):
             get_client("https://some-url.com")
@@ -37,6 +63,56 @@ class GetClientTests(APITestCase):
         self.assertEqual(client.base_path, parsed_result.path)
         self.assertTrue(type(client) is Client)
 
+    def test_get_client_is_cached(self):
+        Service.objects.create(api_type=APITypes.drc, api_root=self.DRC_URL)
+        client = get_client(f"{self.DRC_URL}enkelvoudiginformatieobjecten/1")
+
+        with self.assertNumQueries(0):
+            self.assertIs(
+                get_client(f"{self.DRC_URL}enkelvoudiginformatieobjecten/2"), client
+            )
+
+    def test_get_client_most_specific_api_root(self):
+        Service.objects.create(api_type=APITypes.drc, api_root="https://some.drc.nl/")
+        Service.objects.create(api_type=APITypes.drc, api_root=self.DRC_URL)
+
+        client = get_client(f"{self.DRC_URL}enkelvoudiginformatieobjecten/1")
+        self.assertEqual(client.base_url, self.DRC_URL)
+
+    def test_get_client_cache_cleared_on_service_save(self):
+        service = Service.objects.create(api_type=APITypes.drc, api_root=self.DRC_URL)
+        client = get_client(self.DRC_URL)
+
+        service.header_key = "Authorization"
+        service.header_value = "Token some-token"
+        service.auth_type = AuthTypes.api_key
+        service.save()
+
+        new_client = get_client(self.DRC_URL)
+        self.assertIsNot(new_client, client)
+        self.assertEqual(new_client.auth_value, {"Authorization": "Token some-token"})
+
+    def test_get_client_cache_cleared_on_service_delete(self):
+        service = Service.objects.create(api_type=APITypes.drc, api_root=self.DRC_URL)
+        get_client(self.DRC_URL)
+
+        service.delete()
+
+        with self.assertRaises(RuntimeError):
+            get_client(self.DRC_URL)
+
+    @override_settings(DRC_CLIENT_CACHE_TIMEOUT=60)
+    def test_get_client_cache_expires(self):
+        Service.objects.create(api_type=APITypes.drc, api_root=self.DRC_URL)
+        with patch("dowc.core.utils.time.monotonic", return_value=0):
+            client = get_client(self.DRC_URL)
+
+        with patch("dowc.core.utils.time.monotonic", return_value=59):
+            self.assertIs(get_client(self.DRC_URL), client)
+
+        with patch("dowc.core.utils.time.monotonic", return_value=60):
+            self.assertIsNot(get_client(self.DRC_URL), client)
+
 
 @requests_mock.Mocker()
 class CoreUtilTests(APITestCase):
@@ -163,3 +239,463 @@ class CoreUtilTests(APITestCase):
         response, success = update_document(self.doc_url_nonget, self.doc_data)
         self.assertTrue(success)
         self.assertEqual(factory(Document, self.doc_data), response)
+
+    @override_settings(DRC_CONTENT_CHUNK_SIZE=4)
+    def test_stream_document_content(self, m):
+        content_url = f"{self.doc_url_nonget}/download"
+        m.get(content_url, content=b"some content")
+
+        chunks = list(stream_document_content(content_url))
+        self.assertEqual(chunks, [b"some", b" con", b"tent"])
+        self.assertTrue(m.last_request.stream)
+
+    @temp_private_root()
+    def test_update_document_with_file_content(self, m):
+        # Mock drc_client service
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        m.patch(self.doc_url_nonget, json=self.doc_data)
+
+        name = private_media_storage.save("some.docx", ContentFile(b"some content"))
+        content = FieldFile(None, DocumentFile._meta.get_field("document"), name)
+
+        response, success = update_document(
+            self.doc_url_nonget, {"bestandsnaam": "some.docx", "inhoud": content}
+        )
+        self.assertTrue(success)
+        self.assertEqual(factory(Document, self.doc_data), response)
+
+        body = b"".join(m.last_request.body)
+        self.assertEqual(m.last_request.headers["Content-Length"], str(len(body)))
+        self.assertEqual(
+            json.loads(body),
+            {
+                "bestandsnaam": "some.docx",
+                "inhoud": base64.b64encode(b"some content").decode("utf-8"),
+            },
+        )
+
+
+@temp_private_root()
+@override_settings(DRC_UPLOAD_IN_PARTS_THRESHOLD=10, DRC_UPLOAD_PART_RETRIES=1)
+@patch("dowc.core.utils.supports_bestandsdelen", return_value=True)
+@requests_mock.Mocker()
+class UploadDocumentInPartsTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.DRC_URL = "https://some.drc.nl/api/v1/"
+        Service.objects.create(api_type=APITypes.drc, api_root=cls.DRC_URL)
+
+        _uuid = str(uuid.uuid4())
+        cls.doc_url = f"{cls.DRC_URL}enkelvoudiginformatieobjecten/{_uuid}"
+        cls.doc_data = generate_oas_component(
+            "drc",
+            "schemas/EnkelvoudigInformatieObject",
+            url=cls.doc_url,
+        )
+        cls.parts = [
+            {
+                "url": f"{cls.DRC_URL}bestandsdelen/{uuid.uuid4()}",
+                "volgnummer": volgnummer,
+                "omvang": omvang,
+                "voltooid": False,
+            }
+            for volgnummer, omvang in [(2, 5), (1, 8)]
+        ]
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(cache.clear)
+        self.addCleanup(circuit_breaker.clear)
+        name = private_media_storage.save("some.docx", ContentFile(b"some content!"))
+        self.data = {
+            "bestandsnaam": "some.docx",
+            "bestandsomvang": 13,
+            "inhoud": FieldFile(None, DocumentFile._meta.get_field("document"), name),
+            "lock": "some-lock",
+        }
+
+    def _get_part_content(self, request) -> bytes:
+        body = b"".join(request.body)
+        self.assertEqual(request.headers["Content-Length"], str(len(body)))
+        self.assertTrue(
+            request.headers["Content-Type"].startswith("multipart/form-data")
+        )
+        self.assertIn(b'name="lock"\r\n\r\nsome-lock\r\n', body)
+        return body.split(b"\r\n\r\n")[-1].rsplit(b"\r\n--", 1)[0]
+
+    def test_upload_in_parts(self, mock_supports, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        m.patch(self.doc_url, json={**self.doc_data, "bestandsdelen": self.parts})
+        m.get(self.doc_url, json=self.doc_data)
+        part_mocks = [m.put(part["url"], json=part) for part in self.parts]
+
+        response, success = update_document(self.doc_url, self.data)
+
+        self.assertTrue(success)
+        self.assertEqual(factory(Document, self.doc_data), response)
+
+        patch_request = next(req for req in m.request_history if req.method == "PATCH")
+        self.assertEqual(
+            patch_request.json(),
+            {
+                "bestandsnaam": "some.docx",
+                "bestandsomvang": 13,
+                "inhoud": None,
+                "lock": "some-lock",
+            },
+        )
+        self.assertEqual(
+            self._get_part_content(part_mocks[1].last_request), b"some con"
+        )
+        self.assertEqual(self._get_part_content(part_mocks[0].last_request), b"tent!")
+
+    def test_upload_part_is_retried(self, mock_supports, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        m.patch(self.doc_url, json={**self.doc_data, "bestandsdelen": self.parts[:1]})
+        m.get(self.doc_url, json=self.doc_data)
+        part_mock = m.put(
+            self.parts[0]["url"],
+            [{"status_code": 500}, {"json": self.parts[0]}],
+        )
+
+        response, success = update_document(self.doc_url, self.data)
+
+        self.assertTrue(success)
+        self.assertEqual(part_mock.call_count, 2)
+
+    def test_upload_part_fails(self, mock_supports, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        m.patch(self.doc_url, json={**self.doc_data, "bestandsdelen": self.parts[:1]})
+        part_mock = m.put(self.parts[0]["url"], status_code=500)
+
+        response, success = update_document(self.doc_url, self.data)
+
+        self.assertFalse(success)
+        self.assertEqual(response, self.doc_url)
+        self.assertEqual(part_mock.call_count, 2)
+
+    def test_upload_part_connection_error(self, mock_supports, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        m.patch(self.doc_url, json={**self.doc_data, "bestandsdelen": self.parts[:1]})
+        part_mock = m.put(self.parts[0]["url"], exc=requests.ConnectionError)
+
+        response, success = update_document(self.doc_url, self.data)
+
+        # The DRC is unavailable, so the update is tried again later.
+        self.assertIsNone(success)
+        self.assertEqual(response, self.doc_url)
+        self.assertEqual(part_mock.call_count, 2)
+
+    def test_upload_part_timeout_is_retried(self, mock_supports, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        m.patch(self.doc_url, json={**self.doc_data, "bestandsdelen": self.parts[:1]})
+        m.get(self.doc_url, json=self.doc_data)
+        part_mock = m.put(
+            self.parts[0]["url"],
+            [{"exc": requests.ReadTimeout}, {"json": self.parts[0]}],
+        )
+
+        response, success = update_document(self.doc_url, self.data)
+
+        self.assertTrue(success)
+        self.assertEqual(part_mock.call_count, 2)
+
+    @override_settings(DRC_CIRCUIT_BREAKER_THRESHOLD=2)
+    def test_upload_part_opens_circuit(self, mock_supports, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        m.patch(self.doc_url, json={**self.doc_data, "bestandsdelen": self.parts})
+        part_mocks = [
+            m.put(part["url"], exc=requests.ConnectTimeout) for part in self.parts
+        ]
+
+        with override_settings(DRC_UPLOAD_PART_WORKERS=1):
+            response, success = update_document(self.doc_url, self.data)
+
+        self.assertIsNone(success)
+        # The failed retries of the first part open the circuit, so the
+        # second part isn't sent at all.
+        self.assertEqual(sum(part_mock.call_count for part_mock in part_mocks), 2)
+
+    def test_start_upload_in_parts_is_retried(self, mock_supports, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        patch_mock = m.patch(
+            self.doc_url,
+            [
+                {"status_code": 502},
+                {"json": {**self.doc_data, "bestandsdelen": self.parts[:1]}},
+            ],
+        )
+        m.get(self.doc_url, json=self.doc_data)
+        m.put(self.parts[0]["url"], json=self.parts[0])
+
+        response, success = update_document(self.doc_url, self.data)
+
+        self.assertTrue(success)
+        self.assertEqual(patch_mock.call_count, 2)
+
+    def test_resume_upload_in_parts(self, mock_supports, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        m.patch(self.doc_url, json={**self.doc_data, "bestandsdelen": self.parts})
+        m.put(self.parts[0]["url"], status_code=500)
+        m.put(self.parts[1]["url"], json={**self.parts[1], "voltooid": True})
+
+        # First attempt fails to upload the second part
+        response, success = update_document(self.doc_url, self.data)
+        self.assertFalse(success)
+
+        # Second attempt only uploads the part that isn't completed yet
+        parts = [self.parts[0], {**self.parts[1], "voltooid": True}]
+        m.get(self.doc_url, json={**self.doc_data, "bestandsdelen": parts})
+        part_mock = m.put(self.parts[0]["url"], json=self.parts[0])
+        m.reset_mock()
+
+        response, success = update_document(self.doc_url, self.data)
+
+        self.assertTrue(success)
+        self.assertFalse(any(req.method == "PATCH" for req in m.request_history))
+        self.assertEqual(part_mock.call_count, 1)
+        self.assertEqual(
+            [req.url for req in m.request_history if req.method == "PUT"],
+            [self.parts[0]["url"]],
+        )
+        self.assertEqual(self._get_part_content(part_mock.last_request), b"tent!")
+
+
+class SupportsBestandsdelenTests(APITestCase):
+    @requests_mock.Mocker()
+    def test_supports_bestandsdelen(self, m):
+        DRC_URL = "https://some.drc.nl/api/v1/"
+        service = Service.objects.create(api_type=APITypes.drc, api_root=DRC_URL)
+        mock_service_oas_get(m, DRC_URL, "drc")
+        client = service.build_client()
+
+        self.assertFalse(supports_bestandsdelen(client))
+
+        client.schema["paths"]["/bestandsdelen/{uuid}"] = {
+            "put": {"operationId": "bestandsdeel_update"}
+        }
+        self.assertTrue(supports_bestandsdelen(client))
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "12")
+        self.end_headers()
+        self.wfile.write(b"some content")
+
+    def log_message(self, *args):
+        pass
+
+
+class SessionPoolTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = SessionPool()
+        self.addCleanup(self.pool.clear)
+
+    def test_session_per_api_root(self):
+        session = self.pool.get("https://some.drc.nl/api/v1/")
+        self.assertIs(session, self.pool.get("https://some.drc.nl/api/v1/"))
+        self.assertIsNot(session, self.pool.get("https://other.drc.nl/api/v1/"))
+
+    def test_session_not_shared_with_forked_process(self):
+        session = self.pool.get("https://some.drc.nl/api/v1/")
+        with patch("dowc.client.os.getpid", return_value=-1):
+            self.assertIsNot(session, self.pool.get("https://some.drc.nl/api/v1/"))
+
+    def test_client_uses_pooled_session(self):
+        service = Service.objects.create(
+            api_type=APITypes.drc, api_root="https://some.drc.nl/api/v1/"
+        )
+        client = get_client(service.api_root)
+        self.assertIs(client.session, get_session(service.api_root))
+
+    def test_connections_are_reused(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        api_root = f"http://127.0.0.1:{server.server_port}/api/v1/"
+        session = self.pool.get(api_root)
+        for _ in range(3):
+            response = session.get(f"{api_root}enkelvoudiginformatieobjecten")
+            self.assertEqual(response.content, b"some content")
+
+        self.assertEqual(
+            self.pool.stats(),
+            {api_root: {"requests": 3, "connections": 1, "reused": 2}},
+        )
+
+    @override_settings(DRC_HTTP_POOL_STATS_INTERVAL=60)
+    def test_stats_are_logged_periodically(self):
+        self.pool.get("https://some.drc.nl/api/v1/")
+        now = time.monotonic()
+
+        with patch("dowc.client.logger") as mock_logger:
+            with patch("dowc.client.time.monotonic", return_value=now + 30):
+                self.pool.log_stats_if_due()
+            mock_logger.info.assert_not_called()
+
+            with patch("dowc.client.time.monotonic", return_value=now + 61):
+                self.pool.log_stats_if_due()
+                # Not due again until the next interval passed.
+                self.pool.log_stats_if_due()
+
+        mock_logger.info.assert_called_once_with(
+            "Connection pool for '%s': %d request(s), %d connection(s), %d reused.",
+            "https://some.drc.nl/api/v1/",
+            0,
+            0,
+            0,
+        )
+
+
+@requests_mock.Mocker()
+class ConcurrentRequestsTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.DRC_URL = "https://some.drc.nl/api/v1/"
+        cls.service = Service.objects.create(
+            api_type=APITypes.drc, api_root=cls.DRC_URL
+        )
+
+    def test_concurrent_requests_log(self, m):
+        client = self.service.build_client()
+
+        def log_request(i):
+            url = f"{self.DRC_URL}enkelvoudiginformatieobjecten/{i}"
+            request_id = Client.pre_request(client, "GET", url)
+            Client.post_response(client, request_id, None)
+            client._log.add(client.service, url, "GET", {}, None, 200, {}, None)
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            list(executor.map(log_request, range(500)))
+
+        self.assertEqual(Client._log.durations, {})
+        self.assertEqual(Client.request_starts, {})
+
+    def test_failed_request_is_discarded(self, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        url = f"{self.DRC_URL}enkelvoudiginformatieobjecten/{uuid.uuid4()}"
+        m.get(url, exc=requests.ConnectionError)
+
+        client = self.service.build_client()
+        with self.assertRaises(requests.ConnectionError):
+            get_document(url, client=client)
+
+        self.assertEqual(Client._log.durations, {})
+        self.assertEqual(Client.request_starts, {})
+
+
+@requests_mock.Mocker()
+class RetryTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.DRC_URL = "https://some.drc.nl/api/v1/"
+        Service.objects.create(api_type=APITypes.drc, api_root=cls.DRC_URL)
+        cls.doc_url = f"{cls.DRC_URL}enkelvoudiginformatieobjecten/{uuid.uuid4()}"
+        cls.doc_data = generate_oas_component(
+            "drc",
+            "schemas/EnkelvoudigInformatieObject",
+            url=cls.doc_url,
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(circuit_breaker.clear)
+
+    def test_retry_server_error(self, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        doc_mock = m.get(self.doc_url, [{"status_code": 502}, {"json": self.doc_data}])
+
+        document = get_document(self.doc_url)
+
+        self.assertEqual(document.url, self.doc_url)
+        self.assertEqual(doc_mock.call_count, 2)
+
+    def test_no_retry_client_error(self, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        m.patch(self.doc_url, status_code=400, json={"detail": "invalid"})
+
+        response, success = update_document(self.doc_url, {"titel": "titel"})
+
+        self.assertFalse(success)
+        self.assertEqual(m.last_request.method, "PATCH")
+        self.assertEqual(
+            len(
+                [request for request in m.request_history if request.method == "PATCH"]
+            ),
+            1,
+        )
+
+    def test_no_retry_download_client_error(self, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        content_mock = m.get(self.doc_url, status_code=404)
+
+        with self.assertRaises(requests.HTTPError):
+            stream_document_content(self.doc_url)
+
+        self.assertEqual(content_mock.call_count, 1)
+        # Client errors don't count towards opening the circuit
+        self.assertEqual(circuit_breaker._failures, {})
+
+    def test_no_retry_lock_after_sending(self, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        lock_mock = m.post(f"{self.doc_url}/lock", exc=requests.ReadTimeout)
+
+        with self.assertRaises(requests.ReadTimeout):
+            lock_document(self.doc_url)
+
+        self.assertEqual(lock_mock.call_count, 1)
+
+    def test_retry_lock_connect_error(self, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        lock_mock = m.post(
+            f"{self.doc_url}/lock",
+            [{"exc": requests.ConnectTimeout}, {"json": {"lock": "some-lock"}}],
+        )
+
+        self.assertEqual(lock_document(self.doc_url), "some-lock")
+        self.assertEqual(lock_mock.call_count, 2)
+
+    @override_settings(DRC_RETRIES=0, DRC_CIRCUIT_BREAKER_THRESHOLD=1)
+    def test_drc_unavailable(self, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        m.patch(self.doc_url, exc=requests.ConnectionError)
+
+        self.assertEqual(
+            update_document(self.doc_url, {"titel": "titel"}), (self.doc_url, None)
+        )
+        # The circuit is open
+        self.assertEqual(
+            unlock_document(self.doc_url, "some-lock"), (self.doc_url, None)
+        )
+        self.assertFalse(any(req.method == "POST" for req in m.request_history))
+
+    @override_settings(DRC_RETRIES=0, DRC_CIRCUIT_BREAKER_THRESHOLD=2)
+    def test_circuit_breaker(self, m):
+        mock_service_oas_get(m, self.DRC_URL, "drc")
+        doc_mock = m.get(self.doc_url, exc=requests.ConnectTimeout)
+
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectTimeout):
+                get_document(self.doc_url)
+
+        # The circuit is open, so no request is sent
+        with self.assertRaises(CircuitOpenError):
+            get_document(self.doc_url)
+        self.assertEqual(doc_mock.call_count, 2)
+
+        # Once the timeout passed, a successful trial request closes the circuit
+        m.get(self.doc_url, json=self.doc_data)
+        with patch("dowc.core.utils.time.monotonic", return_value=10**9):
+            get_document(self.doc_url)
+            get_document(self.doc_url)
@@ -0,0 +1,27 @@
+from django.core.cache import cache
+
+from rest_framework.test import APITestCase
+
+from dowc.core.models import CoreConfig
+
+
+class CoreConfigCacheTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(cache.clear)
+
+    def test_core_config_is_cached(self):
+        CoreConfig.get_solo()
+
+        with self.assertNumQueries(0):
+            config = CoreConfig.get_solo()
+
+        self.assertTrue(config.webdav_adfs_authentication)
+
+    def test_save_core_config_updates_cache(self):
+        config = CoreConfig.get_solo()
+        config.webdav_adfs_authentication = False
+        config.save()
+
+        with self.assertNumQueries(0):
+            self.assertFalse(CoreConfig.get_solo().webdav_adfs_authentication)
@@ -1,3 +1,5 @@
+import hashlib
+import os
 import uuid
 from unittest.mock import patch
 
@@ -56,7 +58,8 @@ class DocumentFileModelTests(APITestCase):
         # Create fake content
         cls.content = b"some content"
         cls.download_document_content_patcher = patch(
-            "dowc.core.models.get_document_content", return_value=cls.content
+            "dowc.core.models.stream_document_content",
+            return_value=[cls.content],
         )
 
         cls.get_client_patcher = patch(
@@ -216,6 +219,18 @@ class DocumentFileModelTests(APITestCase):
         original_storage = docfile.original_document.storage
         self.assertTrue(original_storage.exists(original_doc_name))
 
+        # Check if the original document is a separate copy of the document
+        self.assertNotEqual(
+            storage.path(doc_name), original_storage.path(original_doc_name)
+        )
+        with original_storage.open(original_doc_name) as original_doc:
+            self.assertEqual(original_doc.read(), self.content)
+
+        # Check if the digest of the original document is stored
+        self.assertEqual(
+            docfile.original_digest, hashlib.sha256(self.content).hexdigest()
+        )
+
     def test_update_content_and_size_write_documentfile(self, m):
         """
         A content change should trigger the update_document request
@@ -283,6 +298,25 @@ class DocumentFileModelTests(APITestCase):
         self.assertTrue(type(doc) is dict)
         self.assertEqual(doc["auteur"], "First Last")
 
+    def test_update_content_write_documentfile_without_digest(self, m):
+        """
+        Documentfiles created before the digest was stored are compared
+        against the digest of the original document.
+        """
+        docfile = DocumentFileFactory.create(
+            drc_url=self.test_doc_url,
+            purpose=DocFileTypes.write,
+        )
+        docfile.original_digest = ""
+
+        self.assertIsNone(docfile.update_drc_document())
+
+        with docfile.document.storage.open(docfile.document.name, mode="wb") as new_doc:
+            new_doc.write(b"some-content")
+
+        doc = docfile.update_drc_document()
+        self.assertTrue(type(doc) is dict)
+
     def test_no_change_write_documentfile(self, m):
         """
         No changes made to the original document so update_document shouldn't trigger
@@ -423,6 +457,60 @@ class DocumentFileModelTests(APITestCase):
         docfiles = DocumentFile.objects.filter(drc_url=self.test_doc_url)
         self.assertEqual(len(docfiles), 1)
 
+    def test_fail_retrieve_write_creation_unlocks_document(self, m):
+        """
+        The lock and the retrieve are sent concurrently. If the retrieve
+        fails, the lock that was obtained should be released again.
+
+        """
+        unversioned_url = furl(self.test_doc_url).remove(args=True).url
+        with patch(
+            "dowc.core.models.get_document", side_effect=Exception("retrieve failed")
+        ):
+            with patch(
+                "dowc.core.models.unlock_document", return_value=(None, True)
+            ) as mock_unlock:
+                with self.assertRaises(APIException):
+                    DocumentFile.objects.create(
+                        drc_url=self.test_doc_url,
+                        purpose=DocFileTypes.write,
+                        user=self.user,
+                        unversioned_url=unversioned_url,
+                    )
+
+        mock_unlock.assert_called_once_with(unversioned_url, self.lock)
+        self.assertFalse(DocumentFile.objects.exists())
+
+    def test_fail_stream_creation_deletes_partial_file(self, m):
+        """
+        If the content stream breaks off, the partly written document should
+        be deleted.
+
+        """
+
+        def stream():
+            yield b"x" * 1000
+            raise ConnectionError("stream failed")
+
+        storage = DocumentFile._meta.get_field("document").storage
+
+        def stored_files():
+            return {
+                os.path.join(root, name)
+                for root, _, names in os.walk(storage.location)
+                for name in names
+            }
+
+        existing_files = stored_files()
+        with patch("dowc.core.models.stream_document_content", return_value=stream()):
+            with self.assertRaises(APIException):
+                DocumentFile.objects.create(
+                    drc_url=self.test_doc_url, purpose=DocFileTypes.read, user=self.user
+                )
+
+        self.assertFalse(DocumentFile.objects.exists())
+        self.assertEqual(stored_files(), existing_files)
+
     def test_duplicate_read_creation(self, m):
         """
         An attempt to save duplicate read documentfiles should be successful.
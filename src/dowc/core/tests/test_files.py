@@ -0,0 +1,99 @@
+import base64
+import copy
+import json
+import os
+import tempfile
+from unittest.mock import patch
+
+from django.core.files.base import ContentFile
+from django.db.models.fields.files import FieldFile
+from django.test import SimpleTestCase
+
+from privates.storages import private_media_storage
+from privates.test import temp_private_root
+
+from dowc.core.files import Base64JSONBody, StreamedFile, clone_file
+from dowc.core.models import DocumentFile
+
+
+class StreamedFileTests(SimpleTestCase):
+    def test_chunks(self):
+        streamed_file = StreamedFile(iter([b"some", b" content"]), name="some.docx")
+        self.assertEqual(streamed_file.name, "some.docx")
+        self.assertEqual(b"".join(streamed_file.chunks()), b"some content")
+
+
+class CloneFileTests(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.src = os.path.join(tmpdir.name, "src")
+        self.dst = os.path.join(tmpdir.name, "dst")
+        self.content = os.urandom(1024 * 100)
+        with open(self.src, "wb") as f:
+            f.write(self.content)
+
+    def _clone(self):
+        with open(self.src, "rb") as src, open(self.dst, "wb") as dst:
+            clone_file(src.fileno(), dst.fileno())
+
+        with open(self.dst, "rb") as dst:
+            self.assertEqual(dst.read(), self.content)
+
+    def test_clone_file(self):
+        self._clone()
+
+    @patch("dowc.core.files.fcntl.ioctl", side_effect=OSError)
+    def test_clone_file_without_reflink_support(self, mock_ioctl):
+        self._clone()
+        mock_ioctl.assert_called_once()
+
+    @patch("dowc.core.files.os.copy_file_range", side_effect=OSError)
+    @patch("dowc.core.files.fcntl.ioctl", side_effect=OSError)
+    def test_clone_file_buffered_fallback(self, mock_ioctl, mock_copy_file_range):
+        self._clone()
+        mock_copy_file_range.assert_called_once()
+
+    def test_clone_does_not_share_writes(self):
+        self._clone()
+        with open(self.dst, "wb") as dst:
+            dst.write(b"some other content")
+
+        with open(self.src, "rb") as src:
+            self.assertEqual(src.read(), self.content)
+
+
+@temp_private_root()
+class Base64JSONBodyTests(SimpleTestCase):
+    def _get_file(self, content: bytes):
+        name = private_media_storage.save("some.docx", ContentFile(content))
+        return FieldFile(None, DocumentFile._meta.get_field("document"), name)
+
+    def test_body(self):
+        for size in range(0, 10):
+            with self.subTest(size=size):
+                content = os.urandom(size)
+                doc = self._get_file(content)
+                body = Base64JSONBody(
+                    {"inhoud": doc, "bestandsnaam": "some.docx"},
+                    "inhoud",
+                    chunk_size=4,
+                )
+
+                encoded = b"".join(body)
+                self.assertEqual(len(encoded), len(body))
+                self.assertEqual(
+                    json.loads(encoded),
+                    {
+                        "bestandsnaam": "some.docx",
+                        "inhoud": base64.b64encode(content).decode("utf-8"),
+                    },
+                )
+                # Can be iterated over more than once
+                self.assertEqual(b"".join(body), encoded)
+
+    def test_deepcopy_does_not_copy_content(self):
+        doc = self._get_file(b"some content")
+        body = Base64JSONBody({"inhoud": doc}, "inhoud")
+        self.assertEqual(copy.deepcopy(body), repr(body))
@@ -0,0 +1,215 @@
+import json
+import time
+import uuid
+from unittest.mock import MagicMock, patch
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from privates.test import temp_private_root
+from zgw_consumers.api_models.base import factory
+from zgw_consumers.api_models.documenten import Document
+from zgw_consumers.test import generate_oas_component
+
+from dowc.accounts.tests.factories import UserFactory
+from dowc.core.constants import DOCUMENT_COULD_NOT_BE_UPDATED, DocFileTypes
+from dowc.core.jobs import (
+    CLOSE_PROCESSING_KEY,
+    CLOSE_QUEUE_KEY,
+    CLOSE_RETRY_KEY,
+    close_documentfile,
+    enqueue_close,
+    get_close_result,
+    process_close_jobs,
+    requeue_abandoned_jobs,
+)
+from dowc.core.models import DocumentFile
+from dowc.core.tests.factories import DocumentFileFactory
+
+
+@temp_private_root()
+@override_settings(
+    DOCUMENT_CLOSE_RETRIES=1,
+    DOCUMENT_CLOSE_RETRY_DELAY=10,
+    DOCUMENT_CLOSE_RETRY_MAX_DELAY=60,
+)
+class CloseJobTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = UserFactory.create()
+        cls.doc_url = (
+            f"https://some.drc.nl/api/v1/enkelvoudiginformatieobjecten/{uuid.uuid4()}"
+        )
+        cls.document = factory(
+            Document,
+            generate_oas_component(
+                "drc",
+                "schemas/EnkelvoudigInformatieObject",
+                url=cls.doc_url,
+                bestandsnaam="some-filename.docx",
+            ),
+        )
+
+    def setUp(self):
+        super().setUp()
+        for target, return_value in [
+            ("dowc.core.models.get_document", self.document),
+            ("dowc.core.models.stream_document_content", [b"some content"]),
+            ("dowc.core.models.lock_document", uuid.uuid4().hex),
+            ("dowc.core.models.unlock_document", (self.document, True)),
+        ]:
+            patcher = patch(target, return_value=return_value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.redis = MagicMock()
+        patcher = patch("dowc.core.jobs.get_redis_connection", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.docfile = DocumentFileFactory.create(
+            drc_url=self.doc_url,
+            purpose=DocFileTypes.write,
+            user=self.user,
+            closing=True,
+        )
+        self.addCleanup(cache.clear)
+
+    def test_enqueue_close(self):
+        enqueue_close(self.docfile, application="some-token")
+
+        key, job = self.redis.lpush.call_args[0]
+        self.assertEqual(key, CLOSE_QUEUE_KEY)
+        self.assertEqual(
+            json.loads(job),
+            {
+                "uuid": str(self.docfile.uuid),
+                "attempt": 0,
+                "application": "some-token",
+            },
+        )
+
+    def test_close_documentfile(self):
+        close_documentfile(
+            {"uuid": str(self.docfile.uuid), "attempt": 0, "application": None}
+        )
+
+        self.assertFalse(DocumentFile.objects.exists())
+        self.assertEqual(
+            get_close_result(self.docfile.uuid),
+            {"document": self.document, "user": self.user.pk, "application": None},
+        )
+
+    def test_close_documentfile_postponed_while_drc_unavailable(self):
+        job = {"uuid": str(self.docfile.uuid), "attempt": 0}
+        with patch(
+            "dowc.core.models.DocumentFile.check_in_drc_document", return_value=None
+        ):
+            # More postponements than retries don't flag the documentfile as
+            # errored.
+            for _ in range(8):
+                close_documentfile(job)
+
+        self.assertEqual(
+            job, {"uuid": str(self.docfile.uuid), "attempt": 0, "postponed": 8}
+        )
+        self.assertEqual(self.redis.zadd.call_count, 8)
+        # The delay between retries is capped.
+        key, mapping = self.redis.zadd.call_args[0]
+        self.assertAlmostEqual(list(mapping.values())[0], time.time() + 60, delta=5)
+        self.docfile.refresh_from_db()
+        self.assertTrue(self.docfile.closing)
+        self.assertFalse(self.docfile.error)
+
+    def test_close_documentfile_retries(self):
+        job = {"uuid": str(self.docfile.uuid), "attempt": 0}
+        with patch(
+            "dowc.core.models.DocumentFile.update_drc_document",
+            side_effect=ConnectionError,
+        ):
+            close_documentfile(job)
+
+            key, mapping = self.redis.zadd.call_args[0]
+            self.assertEqual(key, CLOSE_RETRY_KEY)
+            self.assertEqual(json.loads(list(mapping)[0])["attempt"], 1)
+            self.docfile.refresh_from_db()
+            self.assertTrue(self.docfile.closing)
+
+            # The last attempt flags the documentfile as errored.
+            close_documentfile(job)
+
+        self.docfile.refresh_from_db()
+        self.assertFalse(self.docfile.closing)
+        self.assertTrue(self.docfile.error)
+        self.assertEqual(self.docfile.error_msg, DOCUMENT_COULD_NOT_BE_UPDATED)
+        self.assertEqual(self.redis.zadd.call_count, 1)
+        self.assertIsNone(get_close_result(self.docfile.uuid))
+
+    def test_close_documentfile_retries_failed_update(self):
+        job = {"uuid": str(self.docfile.uuid), "attempt": 0}
+        with patch(
+            "dowc.core.models.DocumentFile.update_drc_document",
+            return_value={"inhoud": None},
+        ), patch(
+            "dowc.core.models.update_document", return_value=(self.doc_url, False)
+        ):
+            close_documentfile(job)
+
+            self.assertEqual(self.redis.zadd.call_count, 1)
+            self.docfile.refresh_from_db()
+            self.assertTrue(self.docfile.closing)
+            self.assertFalse(self.docfile.error)
+
+            close_documentfile(job)
+
+        self.docfile.refresh_from_db()
+        self.assertFalse(self.docfile.closing)
+        self.assertTrue(self.docfile.error)
+        self.assertEqual(self.docfile.error_msg, DOCUMENT_COULD_NOT_BE_UPDATED)
+        self.assertEqual(self.redis.zadd.call_count, 1)
+
+
+class CloseWorkerTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis = MagicMock()
+        patcher = patch("dowc.core.jobs.get_redis_connection", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_process_close_jobs_keeps_job_until_processed(self):
+        job = json.dumps({"uuid": str(uuid.uuid4()), "attempt": 0}).encode()
+        self.redis.scan_iter.return_value = []
+        self.redis.zrangebyscore.return_value = []
+        self.redis.rpoplpush.side_effect = [job, None]
+
+        with patch("dowc.core.jobs.close_documentfile") as mock_close:
+            processed = process_close_jobs(burst=True)
+
+        self.assertEqual(processed, 1)
+        mock_close.assert_called_once_with(json.loads(job))
+        source, processing_key = self.redis.rpoplpush.call_args_list[0][0]
+        self.assertEqual(source, CLOSE_QUEUE_KEY)
+        self.redis.lrem.assert_called_once_with(processing_key, 1, job)
+
+    def test_requeue_abandoned_jobs(self):
+        processing_key = CLOSE_PROCESSING_KEY.format(worker="dead")
+        self.redis.scan_iter.return_value = [processing_key.encode()]
+        self.redis.exists.return_value = 0
+        self.redis.rpoplpush.side_effect = [b"job", None]
+
+        requeue_abandoned_jobs()
+
+        self.redis.rpoplpush.assert_called_with(processing_key, CLOSE_QUEUE_KEY)
+        self.assertEqual(self.redis.rpoplpush.call_count, 2)
+
+    def test_requeue_abandoned_jobs_skips_live_workers(self):
+        self.redis.scan_iter.return_value = [
+            CLOSE_PROCESSING_KEY.format(worker="alive").encode()
+        ]
+        self.redis.exists.return_value = 1
+
+        requeue_abandoned_jobs()
+
+        self.redis.rpoplpush.assert_not_called()
@@ -0,0 +1,321 @@
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from redis.exceptions import WatchError
+
+from dowc.core.locks import RedisWebDAVLock, WebDAVLock, get_lock_class
+from dowc.core.models import DocumentLock
+
+
+class FakeRedis:
+    """
+    Implements the few Redis commands used by the Redis lock backend.
+
+    Every write bumps the version of the key, so transactions fail if a
+    watched key changed.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.pttls = {}
+        self.versions = {}
+
+    def _changed(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value.encode()
+        if ex is not None:
+            px = ex * 1000
+        self.pttls[key] = px if px is not None else -1
+        self._changed(key)
+        return True
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+            self.pttls.pop(key, None)
+            self._changed(key)
+
+    def sadd(self, key, *values):
+        self.data.setdefault(key, set()).update(value.encode() for value in values)
+        self.pttls.setdefault(key, -1)
+        self._changed(key)
+
+    def srem(self, key, *values):
+        self.data.get(key, set()).difference_update(value.encode() for value in values)
+        self._changed(key)
+
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    def pttl(self, key):
+        return self.pttls.get(key, -2)
+
+    def ttl(self, key):
+        pttl = self.pttl(key)
+        return pttl // 1000 if pttl >= 0 else pttl
+
+    def pexpire(self, key, milliseconds):
+        self.pttls[key] = milliseconds
+        self._changed(key)
+
+    def expire(self, key, seconds):
+        self.pexpire(key, seconds * 1000)
+
+    def persist(self, key):
+        self.pttls[key] = -1
+        self._changed(key)
+
+    def scan_iter(self, pattern):
+        return [key for key in self.data if key.startswith(pattern.rstrip("*"))]
+
+    def transaction(self, func, *watches, value_from_callable=False):
+        while True:
+            pipe = FakePipeline(self)
+            pipe.watch(*watches)
+            try:
+                func_value = func(pipe)
+                exec_value = pipe.execute()
+            except WatchError:
+                continue
+            return func_value if value_from_callable else exec_value
+
+
+class FakePipeline:
+    """
+    Runs commands right away until MULTI, and queues them until EXEC after.
+    """
+
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.watched = {}
+        self.queue = None
+
+    def watch(self, *keys):
+        for key in keys:
+            self.watched[key] = self.redis.versions.get(key, 0)
+
+    def multi(self):
+        self.queue = []
+
+    def execute(self):
+        for key, version in self.watched.items():
+            if self.redis.versions.get(key, 0) != version:
+                raise WatchError()
+        return [command(*args, **kwargs) for command, args, kwargs in self.queue or []]
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, name)
+        if self.queue is None:
+            return command
+        return lambda *args, **kwargs: self.queue.append((command, args, kwargs))
+
+
+def get_lock(lock_class, path: str):
+    resource = MagicMock()
+    resource.get_path.return_value = path
+    return lock_class(resource)
+
+
+class WebDAVLockTests(TestCase):
+    def test_acquire_refresh_and_release(self):
+        lock = get_lock(WebDAVLock, "/some/path")
+
+        token = lock.acquire("exclusive", "write", 0, 600, "owner")
+
+        self.assertEqual(lock.get(), [token])
+        self.assertTrue(lock.refresh(f"(<opaquelocktoken:{token}>)"))
+        self.assertTrue(lock.release(f"<opaquelocktoken:{token}>"))
+        self.assertFalse(lock.refresh(f"(<opaquelocktoken:{token}>)"))
+        self.assertFalse(DocumentLock.objects.exists())
+
+    def test_if_header_with_etag(self):
+        lock = get_lock(WebDAVLock, "/some/path")
+        token = lock.acquire("exclusive", "write", 0, 600, "owner")
+
+        self.assertTrue(lock.refresh(f'(<opaquelocktoken:{token}> ["etag"])'))
+        self.assertTrue(lock.release(f'(<opaquelocktoken:{token}> ["etag"])'))
+
+    def test_invalid_token(self):
+        lock = get_lock(WebDAVLock, "/some/path")
+        lock.acquire("exclusive", "write", 0, 600, "owner")
+
+        for token in ["(<opaquelocktoken:invalid>)", '(["etag"])', "<DAV:no-lock>"]:
+            with self.subTest(token=token):
+                self.assertFalse(lock.refresh(token))
+                self.assertFalse(lock.release(token))
+        self.assertEqual(DocumentLock.objects.count(), 1)
+
+    def test_expired_lock(self):
+        lock = get_lock(WebDAVLock, "/some/path")
+        token = lock.acquire("exclusive", "write", 0, 600, "owner")
+        DocumentLock.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(lock.get(), [])
+        self.assertFalse(lock.refresh(f"(<opaquelocktoken:{token}>)"))
+
+        # Acquiring a new lock cleans up the expired lock of the resource
+        new_token = lock.acquire("exclusive", "write", 0, 600, "owner")
+
+        self.assertEqual(
+            list(DocumentLock.objects.values_list("token", flat=True)), [new_token]
+        )
+
+    def test_refresh_extends_lock(self):
+        lock = get_lock(WebDAVLock, "/some/path")
+        token = lock.acquire("exclusive", "write", 0, 600, "owner")
+        expires_at = timezone.now() + timedelta(seconds=10)
+        DocumentLock.objects.update(expires_at=expires_at)
+
+        self.assertTrue(lock.refresh(f"(<opaquelocktoken:{token}>)"))
+
+        document_lock = DocumentLock.objects.get()
+        self.assertEqual(document_lock.token, token)
+        self.assertGreater(
+            document_lock.expires_at, expires_at + timedelta(seconds=500)
+        )
+
+    def test_lock_without_timeout_does_not_expire(self):
+        lock = get_lock(WebDAVLock, "/some/path")
+        token = lock.acquire("exclusive", "write", 0, 0, "owner")
+
+        self.assertIsNone(DocumentLock.objects.get().expires_at)
+        self.assertEqual(lock.get(), [token])
+        self.assertTrue(lock.refresh(f"(<opaquelocktoken:{token}>)"))
+
+    def test_clean_locks(self):
+        lock = get_lock(WebDAVLock, "/some/path")
+        for i in range(3):
+            lock.acquire("exclusive", "write", 0, 600, "owner")
+        DocumentLock.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        token = get_lock(WebDAVLock, "/other/path").acquire(
+            "exclusive", "write", 0, 600, "owner"
+        )
+        stdout = StringIO()
+
+        call_command("clean_locks", batch_size=2, stdout=stdout)
+
+        self.assertEqual(stdout.getvalue(), "Deleted 3 expired lock(s).\n")
+        self.assertEqual(
+            list(DocumentLock.objects.values_list("token", flat=True)), [token]
+        )
+
+    def test_default_backend(self):
+        self.assertIs(get_lock_class(), WebDAVLock)
+
+
+@override_settings(WEBDAV_LOCK_BACKEND="dowc.core.locks.RedisWebDAVLock")
+class RedisWebDAVLockTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis = FakeRedis()
+        patcher = patch("dowc.core.locks.get_redis_connection", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_configured_backend(self):
+        self.assertIs(get_lock_class(), RedisWebDAVLock)
+
+    def test_acquire_refresh_and_release(self):
+        lock = get_lock(RedisWebDAVLock, "/some/path")
+
+        token = lock.acquire("exclusive", "write", 0, 600, "owner")
+
+        self.assertEqual(lock.get(), [token])
+        self.assertEqual(self.redis.ttl(RedisWebDAVLock.token_key(token)), 600)
+        self.assertEqual(self.redis.ttl(RedisWebDAVLock.path_key("/some/path")), 600)
+        self.assertFalse(DocumentLock.objects.exists())
+
+        self.redis.expire(RedisWebDAVLock.token_key(token), 10)
+        self.assertTrue(lock.refresh(f"(<opaquelocktoken:{token}>)"))
+        self.assertEqual(self.redis.ttl(RedisWebDAVLock.token_key(token)), 600)
+
+        self.assertTrue(lock.release(f"<opaquelocktoken:{token}>"))
+        self.assertEqual(lock.get(), [])
+        self.assertFalse(lock.refresh(f"(<opaquelocktoken:{token}>)"))
+        self.assertFalse(lock.release(f"<opaquelocktoken:{token}>"))
+
+    def test_invalid_token(self):
+        lock = get_lock(RedisWebDAVLock, "/some/path")
+        token = lock.acquire("exclusive", "write", 0, 600, "owner")
+
+        self.assertFalse(lock.refresh("(<opaquelocktoken:invalid>)"))
+        self.assertFalse(lock.release("(<opaquelocktoken:invalid>)"))
+        self.assertTrue(lock.release(f'(<opaquelocktoken:{token}> ["etag"])'))
+
+    def test_expired_locks_are_not_returned(self):
+        lock = get_lock(RedisWebDAVLock, "/some/path")
+        token = lock.acquire("exclusive", "write", 0, 600, "owner")
+        other_token = lock.acquire("exclusive", "write", 0, 600, "owner")
+
+        # Redis expires the lock by itself
+        self.redis.delete(RedisWebDAVLock.token_key(token))
+
+        self.assertEqual(lock.get(), [other_token])
+
+    def test_del_locks_for_paths(self):
+        token = get_lock(RedisWebDAVLock, "/some/path").acquire(
+            "exclusive", "write", 0, 600, "owner"
+        )
+        other_lock = get_lock(RedisWebDAVLock, "/other/path")
+        other_token = other_lock.acquire("exclusive", "write", 0, 600, "owner")
+
+        RedisWebDAVLock.del_locks_for_paths(["/some/path"])
+
+        self.assertFalse(self.redis.exists(RedisWebDAVLock.token_key(token)))
+        self.assertEqual(other_lock.get(), [other_token])
+
+        RedisWebDAVLock.del_all_locks()
+
+        self.assertEqual(self.redis.data, {})
+
+    def test_refresh_lock_released_concurrently(self):
+        lock = get_lock(RedisWebDAVLock, "/some/path")
+        token = lock.acquire("exclusive", "write", 0, 600, "owner")
+        get = self.redis.get
+
+        def get_and_release(key):
+            value = get(key)
+            # Another request releases the lock right after it was read.
+            self.redis.get = get
+            lock.release(f"<opaquelocktoken:{token}>")
+            return value
+
+        self.redis.get = get_and_release
+
+        self.assertFalse(lock.refresh(f"(<opaquelocktoken:{token}>)"))
+        self.assertFalse(self.redis.exists(RedisWebDAVLock.token_key(token)))
+
+    def test_acquire_keeps_longest_expiry_of_concurrent_locks(self):
+        lock = get_lock(RedisWebDAVLock, "/some/path")
+        path_key = RedisWebDAVLock.path_key("/some/path")
+        pttl = self.redis.pttl
+        tokens = []
+
+        def pttl_and_acquire(key):
+            value = pttl(key)
+            # Another request acquires a longer lock right after the expiry
+            # of the set was read.
+            self.redis.pttl = pttl
+            tokens.append(lock.acquire("exclusive", "write", 0, 600, "owner"))
+            return value
+
+        self.redis.pttl = pttl_and_acquire
+        tokens.append(lock.acquire("exclusive", "write", 0, 10, "owner"))
+
+        self.assertEqual(sorted(lock.get()), sorted(tokens))
+        self.assertEqual(self.redis.ttl(path_key), 600)
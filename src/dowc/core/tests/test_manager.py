@@ -1,8 +1,12 @@
 import uuid
+from datetime import timedelta
 from unittest.mock import patch
 
 from django.core import mail
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from privates.test import temp_private_root
@@ -18,7 +22,9 @@ from dowc.core.constants import (
     DOCUMENT_COULD_NOT_BE_UPDATED,
     DocFileTypes,
 )
-from dowc.core.models import DocumentFile
+from dowc.core.locks import WebDAVLock
+from dowc.core.models import DocumentFile, DocumentLock, get_propfind_version_key
+from dowc.core.resource import WebDavResource
 from dowc.core.tests.factories import DocumentFileFactory
 
 
@@ -55,7 +61,8 @@ class DocumentFileManagerTests(TestCase):
         # Create fake content
         cls.content = b"some content"
         cls.download_document_content_patcher = patch(
-            "dowc.core.models.get_document_content", return_value=cls.content
+            "dowc.core.models.stream_document_content",
+            return_value=[cls.content],
         )
 
         cls.get_client_patcher = patch(
@@ -102,6 +109,20 @@ class DocumentFileManagerTests(TestCase):
         self.assertFalse(DocumentFile.objects.all().exists())
         self.assertFalse(storage.exists(doc_name))
 
+    def test_delete_documentfiles_deletes_locks(self):
+        """
+        Tests if the WebDAV locks of deleted documentfiles are deleted
+        """
+        docfile = DocumentFileFactory.create(
+            drc_url=self.test_doc_url, purpose=DocFileTypes.read, user=self.user
+        )
+        resource = WebDavResource(docfile.document.name)
+        WebDAVLock(resource).acquire("exclusive", "write", "0", 0, "owner")
+
+        DocumentFile.objects.delete()
+
+        self.assertFalse(DocumentLock.objects.exists())
+
     def test_delete_read_documentfiles_and_safe_for_deletion(self):
         """
         Tests if files and data belonging to safe_for_deletion and read documentfiles are deleted
@@ -265,7 +286,8 @@ class DocumentFileManagerTests(TestCase):
             with patch(
                 "dowc.core.managers.unlock_document", return_value=(self.document, True)
             ):
-                deleted = DocumentFile.objects.force_delete()
+                with self.captureOnCommitCallbacks(execute=True):
+                    deleted = DocumentFile.objects.force_delete()
         self.assertEqual(deleted, 1)
         self.assertFalse(DocumentFile.objects.all().exists())
         self.assertFalse(storage.exists(doc_name))
@@ -273,6 +295,87 @@ class DocumentFileManagerTests(TestCase):
         # Check if receiver signal is received and an email is sent.
         self.assertTrue(len(mail.outbox) > 0)
 
+    @override_settings(DRC_BULK_UPDATE_WORKERS=2)
+    def test_force_delete_write_documentfiles_only_updates_changed(self):
+        """
+        Tests if only the documents that were edited are updated on the DRC
+        """
+        docfiles = DocumentFileFactory.create_batch(
+            3,
+            drc_url=self.test_doc_url,
+            purpose=DocFileTypes.write,
+            user=self.user,
+            safe_for_deletion=False,
+            error=False,
+            emailed=False,
+        )
+        edited = docfiles[1]
+        with open(edited.document.path, "wb") as f:
+            f.write(b"some edited content")
+
+        with patch(
+            "dowc.core.managers.update_document", return_value=(self.document, True)
+        ) as mock_update:
+            with patch(
+                "dowc.core.managers.unlock_document", return_value=(self.document, True)
+            ):
+                deleted = DocumentFile.objects.force_delete()
+
+        self.assertEqual(deleted, 3)
+        mock_update.assert_called_once()
+        url, data = mock_update.call_args[0]
+        self.assertEqual(url, edited.unversioned_url)
+        self.assertEqual(data["bestandsomvang"], len(b"some edited content"))
+
+    def test_force_delete_write_documentfiles_in_bulk(self):
+        """
+        Tests if files, locks and emails of force deleted write_documentfiles
+        are handled in bulk
+        """
+        docfiles = DocumentFileFactory.create_batch(
+            2,
+            drc_url=self.test_doc_url,
+            purpose=DocFileTypes.write,
+            user=self.user,
+            safe_for_deletion=False,
+            error=False,
+            emailed=False,
+        )
+        for docfile in docfiles:
+            resource = WebDavResource(docfile.document.name)
+            WebDAVLock(resource).acquire("exclusive", "write", "0", 0, "owner")
+        other_lock = DocumentLock.objects.create(
+            resource_path="/some/other/path",
+            lockscope="exclusive",
+            locktype="write",
+            depth="0",
+            timeout=0,
+        )
+        file_names = [
+            (docfile.document.storage, field_file.name)
+            for docfile in docfiles
+            for field_file in (docfile.document, docfile.original_document)
+        ]
+        version_key = get_propfind_version_key(docfiles[0])
+        cache.set(version_key, "some-version")
+
+        with patch(
+            "dowc.core.managers.unlock_document", return_value=(self.document, True)
+        ):
+            with self.captureOnCommitCallbacks(execute=True):
+                deleted = DocumentFile.objects.force_delete()
+
+        self.assertEqual(deleted, 2)
+        self.assertFalse(DocumentFile.objects.exists())
+        for storage, name in file_names:
+            self.assertFalse(storage.exists(name))
+        self.assertEqual(list(DocumentLock.objects.all()), [other_lock])
+        self.assertIsNone(cache.get(version_key))
+
+        # Both documents belong to the same user, who gets a single email.
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.user.email])
+
     def test_force_delete_write_documentfiles_cannot_update(self):
         """
         Tests if files belonging to write_documentfiles are force deleted
@@ -370,10 +473,154 @@ class DocumentFileManagerTests(TestCase):
             with patch(
                 "dowc.core.managers.unlock_document", return_value=(self.document, True)
             ):
-                deleted = DocumentFile.objects.force_delete()
+                with self.captureOnCommitCallbacks(execute=True):
+                    deleted = DocumentFile.objects.force_delete()
         self.assertEqual(deleted, 1)
         self.assertFalse(DocumentFile.objects.all().exists())
         self.assertFalse(storage.exists(doc_name))
 
         # Check if receiver signal is received and an email is sent.
         self.assertTrue(len(mail.outbox) > 0)
+
+    def test_force_delete_write_documentfiles_rolled_back(self):
+        """
+        Tests if the files of force deleted write_documentfiles are kept and
+        no email is sent if the deletion is rolled back
+        """
+        docfile = DocumentFileFactory.create(
+            drc_url=self.test_doc_url,
+            purpose=DocFileTypes.write,
+            user=self.user,
+        )
+        storage = docfile.document.storage
+        doc_name = docfile.document.name
+
+        with patch(
+            "dowc.core.managers.unlock_document", return_value=(self.document, True)
+        ):
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(RuntimeError):
+                    with transaction.atomic():
+                        DocumentFile.objects.force_delete()
+                        raise RuntimeError("rollback")
+
+        self.assertTrue(DocumentFile.objects.filter(pk=docfile.pk).exists())
+        self.assertTrue(storage.exists(doc_name))
+        self.assertFalse(mail.outbox)
+
+    def test_force_delete_skips_closing_documentfiles(self):
+        """
+        Tests if write_documentfiles that are being closed by a background
+        worker are left alone
+        """
+        DocumentFileFactory.create(
+            drc_url=self.test_doc_url,
+            purpose=DocFileTypes.write,
+            user=self.user,
+            closing=True,
+        )
+        DocumentFileFactory.create(
+            drc_url=self.test_doc_url,
+            purpose=DocFileTypes.write,
+            user=self.user,
+            closing=True,
+            error=True,
+        )
+
+        with patch("dowc.core.managers.unlock_document") as mock_unlock:
+            deleted = DocumentFile.objects.force_delete()
+            retried, retry_deleted = DocumentFile.objects.retry_errored()
+
+        self.assertEqual((deleted, retried, retry_deleted), (0, 0, 0))
+        mock_unlock.assert_not_called()
+        self.assertEqual(DocumentFile.objects.count(), 2)
+
+    def test_retry_errored_documentfiles(self):
+        """
+        Tests if errored write_documentfiles are retried and deleted
+        """
+        docfile = DocumentFileFactory.create(
+            drc_url=self.test_doc_url,
+            purpose=DocFileTypes.write,
+            user=self.user,
+            error=True,
+            error_msg=DOCUMENT_COULD_NOT_BE_UNLOCKED,
+        )
+
+        with patch(
+            "dowc.core.managers.unlock_document", return_value=(self.document, True)
+        ):
+            retried, deleted = DocumentFile.objects.retry_errored()
+
+        self.assertEqual((retried, deleted), (1, 1))
+        self.assertFalse(DocumentFile.objects.filter(pk=docfile.pk).exists())
+
+    def test_retry_errored_documentfiles_drc_unavailable(self):
+        """
+        Tests if errored write_documentfiles stay errored, without counting
+        the attempt, if the DRC is unavailable
+        """
+        docfile = DocumentFileFactory.create(
+            drc_url=self.test_doc_url,
+            purpose=DocFileTypes.write,
+            user=self.user,
+            error=True,
+            error_msg=DOCUMENT_COULD_NOT_BE_UNLOCKED,
+        )
+
+        with patch(
+            "dowc.core.managers.unlock_document",
+            return_value=(docfile.unversioned_url, None),
+        ):
+            retried, deleted = DocumentFile.objects.retry_errored()
+
+        self.assertEqual((retried, deleted), (1, 0))
+        docfile.refresh_from_db()
+        self.assertTrue(docfile.error)
+        self.assertEqual(docfile.error_msg, DOCUMENT_COULD_NOT_BE_UNLOCKED)
+        self.assertEqual(docfile.error_attempts, 0)
+        self.assertIsNone(docfile.next_retry)
+
+    @override_settings(DOCUMENT_ERROR_MAX_ATTEMPTS=2, DOCUMENT_ERROR_RETRY_DELAY=60)
+    def test_retry_errored_documentfiles_backoff_and_escalation(self):
+        """
+        Tests if write_documentfiles that error again are retried later and
+        escalated after the maximum number of attempts
+        """
+        docfile = DocumentFileFactory.create(
+            drc_url=self.test_doc_url,
+            purpose=DocFileTypes.write,
+            user=self.user,
+            error=True,
+            error_msg=DOCUMENT_COULD_NOT_BE_UNLOCKED,
+        )
+
+        with patch(
+            "dowc.core.managers.unlock_document",
+            return_value=(docfile.unversioned_url, False),
+        ):
+            self.assertEqual(DocumentFile.objects.retry_errored(), (1, 0))
+
+            docfile.refresh_from_db()
+            self.assertTrue(docfile.error)
+            self.assertEqual(docfile.error_attempts, 1)
+            self.assertAlmostEqual(
+                docfile.next_retry,
+                timezone.now() + timedelta(seconds=60),
+                delta=timedelta(seconds=5),
+            )
+
+            # Not due for a retry yet
+            self.assertEqual(DocumentFile.objects.retry_errored(), (0, 0))
+
+            DocumentFile.objects.filter(pk=docfile.pk).update(next_retry=timezone.now())
+            with patch("dowc.core.managers.logger") as mock_logger:
+                self.assertEqual(DocumentFile.objects.retry_errored(), (1, 0))
+
+            mock_logger.error.assert_called_once()
+            docfile.refresh_from_db()
+            self.assertEqual(docfile.error_attempts, 2)
+            self.assertIsNone(docfile.next_retry)
+
+            # Escalated documentfiles are no longer retried
+            self.assertEqual(DocumentFile.objects.retry_errored(), (0, 0))
@@ -0,0 +1,447 @@
+import hashlib
+import os
+import uuid
+from io import BytesIO
+from unittest.mock import ANY, patch
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.http import http_date
+
+from djangodav.responses import HttpResponseMultiStatus
+from privates.test import temp_private_root
+from zgw_consumers.api_models.base import factory
+from zgw_consumers.api_models.documenten import Document
+from zgw_consumers.test import generate_oas_component
+
+from dowc.accounts.tests.factories import UserFactory
+from dowc.core.constants import DOCUMENTFILE_CACHE_KEY, DocFileTypes
+from dowc.core.exceptions import DocumentTooLarge
+from dowc.core.models import DocumentFile, get_propfind_version_key
+from dowc.core.resource import WebDavResource, get_temporary_folder, get_temporary_path
+from dowc.core.tests.factories import DocumentFileFactory
+from dowc.core.tokens import document_token_generator
+
+DRC_URL = "https://some.drc.nl/api/v1/"
+
+
+def get_temporary_files(docfile) -> list:
+    directory = get_temporary_folder(docfile.document.path)
+    if not os.path.isdir(directory):
+        return []
+    return [name for name in os.listdir(directory) if name.endswith(".tmp")]
+
+
+class WebDavTestCase(TestCase):
+    """
+    Creates a documentfile with `content` for `purpose` and logs in its user.
+    """
+
+    purpose = DocFileTypes.write
+    content = b"original"
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = UserFactory.create()
+
+        cls.test_doc_url = f"{DRC_URL}enkelvoudiginformatieobjecten/{uuid.uuid4()}"
+        doc_data = generate_oas_component(
+            "drc",
+            "schemas/EnkelvoudigInformatieObject",
+        )
+        doc_data.update({"bestandsnaam": "bestandsnaam.txt", "url": cls.test_doc_url})
+        cls.document = factory(Document, doc_data)
+
+    def setUp(self):
+        super().setUp()
+        with patch("dowc.core.models.get_document", return_value=self.document), patch(
+            "dowc.core.models.stream_document_content", return_value=[self.content]
+        ), patch("dowc.core.models.lock_document", return_value=uuid.uuid4().hex):
+            self.docfile = DocumentFileFactory.create(
+                drc_url=self.test_doc_url, purpose=self.purpose, user=self.user
+            )
+
+        self.url = reverse(
+            "core:webdav-document",
+            kwargs={
+                "uuid": str(self.docfile.uuid),
+                "token": document_token_generator.make_token(
+                    self.user, str(self.docfile.uuid)
+                ),
+                "purpose": self.docfile.purpose,
+                "path": self.docfile.document.name,
+            },
+        )
+        self.client.force_login(self.user)
+
+
+@temp_private_root()
+class WebDavGetTests(WebDavTestCase):
+    purpose = DocFileTypes.read
+    content = b"0123456789"
+
+    def test_get(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.content)
+        self.assertEqual(response["Content-Length"], "10")
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertTrue(response["ETag"].startswith('"'))
+        self.assertIn("Last-Modified", response)
+
+    def test_documentfile_is_retrieved_once(self):
+        with CaptureQueriesContext(connection) as first_request:
+            self.client.get(self.url)
+        with CaptureQueriesContext(connection) as second_request:
+            self.client.get(self.url)
+
+        def docfile_queries(context):
+            return [
+                query
+                for query in context.captured_queries
+                if 'FROM "core_documentfile"' in query["sql"]
+            ]
+
+        self.assertEqual(len(docfile_queries(first_request)), 1)
+        self.assertEqual(len(docfile_queries(second_request)), 0)
+
+        # Changes to the documentfile clear the cache
+        self.docfile.save()
+        with CaptureQueriesContext(connection) as third_request:
+            self.client.get(self.url)
+
+        self.assertEqual(len(docfile_queries(third_request)), 1)
+
+        # Deleted documentfiles aren't served from the cache
+        self.docfile.delete()
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_head(self):
+        response = self.client.head(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response["Content-Length"], "10")
+
+    def test_get_not_modified(self):
+        response = self.client.get(self.url)
+
+        for headers in [
+            {"HTTP_IF_NONE_MATCH": response["ETag"]},
+            {"HTTP_IF_MODIFIED_SINCE": response["Last-Modified"]},
+        ]:
+            with self.subTest(headers=headers):
+                not_modified = self.client.get(self.url, **headers)
+
+                self.assertEqual(not_modified.status_code, 304)
+                self.assertEqual(not_modified["ETag"], response["ETag"])
+
+        modified = self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"')
+
+        self.assertEqual(modified.status_code, 200)
+
+    def test_get_range(self):
+        for range_header, content, content_range in [
+            ("bytes=2-5", b"2345", "bytes 2-5/10"),
+            ("bytes=7-", b"789", "bytes 7-9/10"),
+            ("bytes=-3", b"789", "bytes 7-9/10"),
+            ("bytes=8-100", b"89", "bytes 8-9/10"),
+        ]:
+            with self.subTest(range=range_header):
+                response = self.client.get(self.url, HTTP_RANGE=range_header)
+
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(b"".join(response.streaming_content), content)
+                self.assertEqual(response["Content-Range"], content_range)
+                self.assertEqual(response["Content-Length"], str(len(content)))
+
+    def test_get_range_ignored(self):
+        etag = self.client.get(self.url)["ETag"]
+
+        for headers in [
+            {"HTTP_RANGE": "bytes=0-1,4-5"},
+            {"HTTP_RANGE": "bytes=5-2"},
+            {"HTTP_RANGE": "bytes=2-5", "HTTP_IF_RANGE": '"other"'},
+            {"HTTP_RANGE": "bytes=2-5", "HTTP_IF_RANGE": http_date(0)},
+        ]:
+            with self.subTest(headers=headers):
+                response = self.client.get(self.url, **headers)
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(b"".join(response.streaming_content), self.content)
+
+        response = self.client.get(self.url, HTTP_RANGE="bytes=2-5", HTTP_IF_RANGE=etag)
+
+        self.assertEqual(response.status_code, 206)
+
+    def test_get_range_not_satisfiable(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=10-")
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */10")
+
+    @override_settings(
+        WEBDAV_SENDFILE_ENABLED=True,
+        SENDFILE_BACKEND="django_sendfile.backends.nginx",
+        SENDFILE_URL="/private/",
+    )
+    def test_get_sendfile(self):
+        with self.settings(SENDFILE_ROOT=self.docfile.document.storage.location):
+            response = self.client.get(self.url, HTTP_RANGE="bytes=2-5")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(
+            response["X-Accel-Redirect"], f"/private/{self.docfile.document.name}"
+        )
+        self.assertIn("ETag", response)
+
+
+@temp_private_root()
+class WebDavPutTests(WebDavTestCase):
+    def test_put(self):
+        response = self.client.put(
+            self.url, data=b"edited", content_type="application/octet-stream"
+        )
+
+        self.assertEqual(response.status_code, 204)
+        self.docfile.refresh_from_db()
+        with self.docfile.document.open("rb") as f:
+            self.assertEqual(f.read(), b"edited")
+        self.assertEqual(
+            self.docfile.document_digest, hashlib.sha256(b"edited").hexdigest()
+        )
+        # The temporary file replaced the document
+        self.assertEqual(get_temporary_files(self.docfile), [])
+        self.assertTrue(self.docfile.update_drc_document())
+
+    def test_put_new_name_keeps_other_fields(self):
+        # The cached documentfile doesn't know the document is being closed
+        stale_docfile = DocumentFile.objects.select_related("user").get(
+            pk=self.docfile.pk
+        )
+        DocumentFile.objects.filter(pk=self.docfile.pk).update(closing=True)
+        cache.set(DOCUMENTFILE_CACHE_KEY.format(uuid=self.docfile.uuid), stale_docfile)
+        path = os.path.join(os.path.dirname(self.docfile.document.name), "other.txt")
+        url = reverse(
+            "core:webdav-document",
+            kwargs={
+                "uuid": str(self.docfile.uuid),
+                "token": document_token_generator.make_token(
+                    self.user, str(self.docfile.uuid)
+                ),
+                "purpose": self.docfile.purpose,
+                "path": path,
+            },
+        )
+
+        response = self.client.put(
+            url, data=b"edited", content_type="application/octet-stream"
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.docfile.refresh_from_db()
+        self.assertEqual(self.docfile.filename, "other.txt")
+        self.assertTrue(self.docfile.changed_name)
+        self.assertTrue(self.docfile.closing)
+
+    def test_update_clears_cached_documentfile(self):
+        self.client.put(
+            self.url, data=b"edited", content_type="application/octet-stream"
+        )
+        cache_key = DOCUMENTFILE_CACHE_KEY.format(uuid=self.docfile.uuid)
+        cache.set(cache_key, self.docfile)
+
+        with self.assertNumQueries(2):
+            DocumentFile.objects.filter(pk=self.docfile.pk).update(closing=True)
+
+        self.assertIsNone(cache.get(cache_key))
+
+    def test_update_documentfile_clears_cache_without_query(self):
+        cache_key = DOCUMENTFILE_CACHE_KEY.format(uuid=self.docfile.uuid)
+        cache.set(cache_key, self.docfile)
+
+        # The uuid is known, so only the update itself is queried.
+        with self.assertNumQueries(1):
+            DocumentFile.objects.for_documentfile(self.docfile).filter(
+                closing=False
+            ).update(closing=True)
+
+        self.assertIsNone(cache.get(cache_key))
+        self.docfile.refresh_from_db()
+        self.assertTrue(self.docfile.closing)
+
+    def test_put_digest_update_queries(self):
+        # Load the documentfile in the cache.
+        self.client.put(
+            self.url, data=b"original", content_type="application/octet-stream"
+        )
+
+        # The digest update doesn't query the uuid of the documentfile first.
+        with CaptureQueriesContext(connection) as queries:
+            self.client.put(
+                self.url, data=b"edited", content_type="application/octet-stream"
+            )
+
+        self.assertFalse(
+            [
+                query
+                for query in queries
+                if query["sql"].startswith('SELECT "core_documentfile"."uuid"')
+            ]
+        )
+
+    def test_digest_not_used_after_other_writes(self):
+        # Saving the original content leaves the document unchanged
+        self.client.put(
+            self.url, data=b"original", content_type="application/octet-stream"
+        )
+        self.docfile.refresh_from_db()
+        self.assertIsNone(self.docfile.update_drc_document())
+
+        # A write that doesn't go through the WebDAV PUT
+        with open(self.docfile.document.path, "wb") as f:
+            f.write(b"0riginal")
+
+        self.assertTrue(self.docfile.update_drc_document())
+
+    def test_put_temporary_file_outside_webdav_folder(self):
+        public_folder = os.path.dirname(self.docfile.document.path)
+        replaced = []
+
+        def replace(src, dst):
+            replaced.append((src, sorted(os.listdir(public_folder))))
+            os.rename(src, dst)
+
+        with patch("dowc.core.resource.os.replace", side_effect=replace):
+            response = self.client.put(
+                self.url, data=b"edited", content_type="application/octet-stream"
+            )
+
+        self.assertEqual(response.status_code, 204)
+        [(tmp_path, public_files)] = replaced
+        self.assertEqual(
+            os.path.dirname(tmp_path), get_temporary_folder(self.docfile.document.path)
+        )
+        self.assertFalse([name for name in public_files if name.endswith(".tmp")])
+
+    def test_delete_removes_left_over_temporary_files(self):
+        path = self.docfile.document.path
+        os.makedirs(get_temporary_folder(path), exist_ok=True)
+        left_over = get_temporary_path(path)
+        other = get_temporary_path(f"{path}.docx")
+        for tmp_path in (left_over, other):
+            with open(tmp_path, "wb") as f:
+                f.write(b"edit")
+
+        self.docfile.safe_for_deletion = True
+        self.docfile.delete()
+
+        self.assertFalse(os.path.exists(left_over))
+        # Temporary files of other documents are left alone.
+        self.assertTrue(os.path.exists(other))
+        os.remove(other)
+
+    @override_settings(WEBDAV_PUT_MAX_SIZE=5)
+    def test_put_too_large(self):
+        response = self.client.put(
+            self.url, data=b"edited", content_type="application/octet-stream"
+        )
+
+        self.assertEqual(response.status_code, 413)
+        self.docfile.refresh_from_db()
+        with self.docfile.document.open("rb") as f:
+            self.assertEqual(f.read(), b"original")
+        self.assertEqual(self.docfile.document_digest, "")
+
+    @override_settings(WEBDAV_PUT_MAX_SIZE=5, WEBDAV_PUT_BUFFER_SIZE=2)
+    def test_write_too_large_without_content_length(self):
+        resource = WebDavResource(self.docfile.document.name)
+        request = BytesIO(b"edited")
+        request.META = {}
+
+        with self.assertRaises(DocumentTooLarge):
+            resource.write(request)
+
+        with self.docfile.document.open("rb") as f:
+            self.assertEqual(f.read(), b"original")
+        self.assertEqual(get_temporary_files(self.docfile), [])
+
+
+@temp_private_root()
+class WebDavPropfindTests(WebDavTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def propfind(self):
+        return self.client.generic("PROPFIND", self.url, HTTP_DEPTH="0")
+
+    def patch_propfind(self):
+        def propfind(view, request, path, *args, **kwargs):
+            size = view.resource.getcontentlength
+            return HttpResponseMultiStatus(f"<multistatus>{size}</multistatus>")
+
+        return patch(
+            "dowc.core.views.views.DavView.propfind",
+            side_effect=propfind,
+            autospec=True,
+        )
+
+    def test_propfind_is_cached(self):
+        with self.patch_propfind() as propfind:
+            response = self.propfind()
+            cached = self.propfind()
+
+        propfind.assert_called_once()
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(cached.status_code, 207)
+        self.assertEqual(cached.content, b"<multistatus>8</multistatus>")
+
+    def test_put_clears_propfind_cache(self):
+        with self.patch_propfind() as propfind:
+            self.propfind()
+            response = self.client.put(
+                self.url, data=b"edited!!!", content_type="application/octet-stream"
+            )
+            self.assertEqual(response.status_code, 204)
+
+            response = self.propfind()
+
+        self.assertEqual(propfind.call_count, 2)
+        self.assertEqual(response.content, b"<multistatus>9</multistatus>")
+
+    def test_propfind_version_expires(self):
+        version_key = get_propfind_version_key(self.docfile)
+
+        with patch("dowc.core.views.cache.add", wraps=cache.add) as mock_add:
+            with self.patch_propfind():
+                self.propfind()
+
+        mock_add.assert_called_once_with(version_key, ANY, timeout=60)
+
+    def test_delete_clears_propfind_version(self):
+        version_key = get_propfind_version_key(self.docfile)
+        with self.patch_propfind():
+            self.propfind()
+        self.assertIsNotNone(cache.get(version_key))
+
+        self.docfile.safe_for_deletion = True
+        self.docfile.delete()
+
+        self.assertIsNone(cache.get(version_key))
+
+    @override_settings(WEBDAV_PROPFIND_CACHE_TIMEOUT=0)
+    def test_propfind_cache_disabled(self):
+        with self.patch_propfind() as propfind:
+            self.propfind()
+            self.propfind()
+
+        self.assertEqual(propfind.call_count, 2)
@@ -1,27 +1,99 @@
 import functools
+import itertools
 import logging
-from typing import Optional, Tuple, Union
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple, Union
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import File
 
-import lxml.html
 import requests
 from requests.exceptions import HTTPError
+from urllib3.exceptions import NewConnectionError
 from zds_client.client import ClientError
 from zgw_consumers.api_models.base import factory
 from zgw_consumers.api_models.documenten import Document
+from zgw_consumers.concurrent import parallel
 from zgw_consumers.models import Service
 
-from dowc.client import Client
+from dowc.client import Client, get_timeout
+
+from .files import Base64JSONBody, MultipartFileRangeBody
 
 logger = logging.getLogger(__name__)
 
 
-def clean_token(token: str) -> str:
-    for char in ["(", ")"]:
-        token = token.replace(char, "")
+UUID_PATTERN = r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+LOCK_TOKEN_RE = re.compile(rf"opaquelocktoken:({UUID_PATTERN})", re.IGNORECASE)
+UUID_RE = re.compile(UUID_PATTERN, re.IGNORECASE)
+
+
+def clean_token(token: str) -> Optional[str]:
+    """
+    Returns the uuid of the lock token in a `Lock-Token` or `If` header, like
+    `<opaquelocktoken:<uuid>>` or `(<opaquelocktoken:<uuid>> ["etag"])`.
+
+    Returns None if the header doesn't contain a lock token.
+    """
+    if match := LOCK_TOKEN_RE.search(token):
+        return match.group(1)
+
+    token = token.strip("()<> ")
+    return token if UUID_RE.fullmatch(token) else None
+
+
+class ClientCache:
+    """
+    In-process cache of the clients per API root.
+
+    The services are loaded once per `DRC_CLIENT_CACHE_TIMEOUT` seconds and
+    their clients are built on first use. The cache is cleared whenever a
+    service is saved or deleted in this process, other processes pick up the
+    change once their cache expires.
+    """
 
-    # Get token from <opaquetoken:<token>>
-    token = lxml.html.fromstring(token).tag
-    return token
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._services: Dict[str, Service] = {}
+        self._clients: Dict[str, Client] = {}
+        self._expires = 0.0
+
+    def get(self, url: str) -> Optional[Client]:
+        with self._lock:
+            if time.monotonic() >= self._expires:
+                self._load()
+
+            # Match the most specific API root, like Service.get_service.
+            for api_root, service in self._services.items():
+                if url.startswith(api_root):
+                    break
+            else:
+                return None
+
+            if api_root not in self._clients:
+                self._clients[api_root] = service.build_client()
+            return self._clients[api_root]
+
+    def _load(self) -> None:
+        services = sorted(
+            Service.objects.all(), key=lambda service: len(service.api_root)
+        )
+        self._services = {service.api_root: service for service in reversed(services)}
+        self._clients = {}
+        self._expires = time.monotonic() + settings.DRC_CLIENT_CACHE_TIMEOUT
+
+    def clear(self) -> None:
+        with self._lock:
+            self._services = {}
+            self._clients = {}
+            self._expires = 0.0
+
+
+client_cache = ClientCache()
 
 
 def get_client(url: str) -> Client:
@@ -29,7 +101,7 @@ def get_client(url: str) -> Client:
     Gets drc client based on URL.
     """
 
-    client = Service.get_client(url)
+    client = client_cache.get(url)
     if client is None:
         raise RuntimeError(f"Could not find a service for '{url}'")
 
@@ -55,13 +127,145 @@ def require_client(func):
     return wrapped_func
 
 
+class DocumentPartUploadError(Exception):
+    """
+    Raised when a part of a document could not be uploaded after retrying.
+    """
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request to a service that is considered down.
+    """
+
+
+class CircuitBreaker:
+    """
+    In-process circuit breaker per API root.
+
+    After `DRC_CIRCUIT_BREAKER_THRESHOLD` consecutive failed calls the circuit
+    opens and calls fail fast for `DRC_CIRCUIT_BREAKER_TIMEOUT` seconds. Then a
+    single trial call is let through, which closes the circuit again if it
+    succeeds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failures: Dict[str, int] = {}
+        self._open_until: Dict[str, float] = {}
+
+    def check(self, api_root: str) -> None:
+        with self._lock:
+            open_until = self._open_until.get(api_root)
+            if open_until is None:
+                return
+
+            now = time.monotonic()
+            if now < open_until:
+                raise CircuitOpenError(f"The circuit for '{api_root}' is open.")
+
+            # Let this call through as trial and keep failing the others fast.
+            self._open_until[api_root] = now + settings.DRC_CIRCUIT_BREAKER_TIMEOUT
+
+    def record_success(self, api_root: str) -> None:
+        with self._lock:
+            self._failures.pop(api_root, None)
+            self._open_until.pop(api_root, None)
+
+    def record_failure(self, api_root: str) -> None:
+        with self._lock:
+            failures = self._failures.get(api_root, 0) + 1
+            self._failures[api_root] = failures
+            if failures >= settings.DRC_CIRCUIT_BREAKER_THRESHOLD:
+                if api_root not in self._open_until:
+                    logger.error("Opening the circuit for '%s'.", api_root)
+                self._open_until[api_root] = (
+                    time.monotonic() + settings.DRC_CIRCUIT_BREAKER_TIMEOUT
+                )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._failures = {}
+            self._open_until = {}
+
+
+circuit_breaker = CircuitBreaker()
+
+
+def is_transient_error(exc: Exception) -> bool:
+    """
+    Connection errors, timeouts and server errors are worth retrying. Client
+    errors are not.
+    """
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(exc, HTTPError):
+        return exc.response is None or exc.response.status_code >= 500
+    return False
+
+
+def is_connect_error(exc: Exception) -> bool:
+    """
+    Connection errors that occurred before the request was sent.
+    """
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    if not isinstance(exc, requests.ConnectionError) or not exc.args:
+        return False
+    return isinstance(getattr(exc.args[0], "reason", None), NewConnectionError)
+
+
+def call_drc(
+    client: Client,
+    func: Callable,
+    *args,
+    retry_if: Callable[[Exception], bool] = is_transient_error,
+    retries: Optional[int] = None,
+    **kwargs,
+) -> Any:
+    """
+    Calls `func`, which sends requests to the API of `client`.
+
+    Transient errors for which `retry_if` is true are retried up to `retries`
+    times, or `DRC_RETRIES` times by default, with an exponential backoff and
+    jitter. Calls fail fast with a `CircuitOpenError` while the circuit of the
+    API is open.
+    """
+    if retries is None:
+        retries = settings.DRC_RETRIES
+    api_root = client.base_url
+    for attempt in itertools.count():
+        circuit_breaker.check(api_root)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            if not is_transient_error(exc):
+                raise
+
+            circuit_breaker.record_failure(api_root)
+            if attempt >= retries or not retry_if(exc):
+                raise
+
+            delay = settings.DRC_RETRY_BACKOFF * 2**attempt
+            logger.warning(
+                "Request to '%s' failed, retrying in at most %.1fs.",
+                api_root,
+                delay,
+                exc_info=True,
+            )
+            time.sleep(random.uniform(0, delay))
+        else:
+            circuit_breaker.record_success(api_root)
+            return result
+
+
 @require_client
 def get_document(url: str, client: Optional[Client] = None) -> Document:
     """
     Gets a document by URL reference.
     """
 
-    response = client.retrieve("enkelvoudiginformatieobject", url=url)
+    response = call_drc(client, client.retrieve, "enkelvoudiginformatieobject", url=url)
     # TODO CHECK RESPONSE IN CASE DOCUMENT DOESN'T EXIST
     return factory(Document, response)
 
@@ -70,10 +274,19 @@ def get_document(url: str, client: Optional[Client] = None) -> Document:
 def lock_document(url: str, client: Optional[Client] = None) -> str:
     """
     Locks a document by URL reference.
+
+    Locking isn't idempotent: if the lock of a request that reached the DRC
+    got lost, retrying fails and the document stays locked with an unknown
+    lock. So the request is only retried if it wasn't sent.
     """
 
-    lock_result = client.operation(
-        "enkelvoudiginformatieobject_lock", data={}, url=f"{url}/lock"
+    lock_result = call_drc(
+        client,
+        client.operation,
+        "enkelvoudiginformatieobject_lock",
+        data={},
+        url=f"{url}/lock",
+        retry_if=is_connect_error,
     )
     lock = lock_result["lock"]
     return lock
@@ -86,31 +299,58 @@ def unlock_document(
     """
     Unlocks a document by URL reference.
 
+    Returns the document and True if it was unlocked, the url and False if the
+    DRC refused, or the url and None if the DRC is unavailable and the unlock
+    should be tried again later.
+
     """
     try:
-        client.request(
+        call_drc(
+            client,
+            client.request,
             f"{url}/unlock",
             "enkelvoudiginformatieobject_unlock",
             "POST",
             expected_status=204,
             json={"lock": lock},
         )
-        doc_data = client.retrieve("enkelvoudiginformatieobject", url=url)
+        doc_data = call_drc(
+            client, client.retrieve, "enkelvoudiginformatieobject", url=url
+        )
         return factory(Document, doc_data), True
     except (ClientError, HTTPError) as exc:
         logger.warning("Could not unlock {url}.".format(url=url), exc_info=True)
         return url, False
+    except (CircuitOpenError, requests.RequestException):
+        logger.warning(
+            "Could not reach the DRC to unlock {url}.".format(url=url), exc_info=True
+        )
+        return url, None
 
 
 @require_client
-def get_document_content(content_url: str, client: Optional[Client] = None) -> bytes:
+def stream_document_content(
+    content_url: str, client: Optional[Client] = None
+) -> Iterator[bytes]:
     """
-    Gets document content.
+    Streams document content in chunks of `DRC_CONTENT_CHUNK_SIZE` bytes.
+
+    The content is never held in memory as a whole, which keeps the memory
+    footprint bounded by the chunk size rather than the document size.
     """
 
-    response = requests.get(content_url, headers=client.auth.credentials())
-    response.raise_for_status()
-    return response.content
+    def get_response() -> requests.Response:
+        response = client.session.get(
+            content_url,
+            headers=client.auth.credentials(),
+            stream=True,
+            timeout=get_timeout(),
+        )
+        response.raise_for_status()
+        return response
+
+    response = call_drc(client, get_response)
+    return response.iter_content(chunk_size=settings.DRC_CONTENT_CHUNK_SIZE)
 
 
 @require_client
@@ -120,12 +360,151 @@ def update_document(
     """
     Updates a document by URL reference.
 
+    If the `inhoud` is given as a file, it is base64 encoded while it is
+    streamed to the DRC instead of being encoded in memory. Files of at least
+    `DRC_UPLOAD_IN_PARTS_THRESHOLD` bytes are uploaded in parts if the DRC
+    supports it.
+
+    Returns the document and True if it was updated, the url and False if the
+    DRC refused, or the url and None if the DRC is unavailable and the update
+    should be tried again later.
+
     """
     try:
-        response = client.partial_update(
-            "enkelvoudiginformatieobject", data=data, url=url
-        )
+        content = data.get("inhoud")
+        if (
+            isinstance(content, File)
+            and content.size >= settings.DRC_UPLOAD_IN_PARTS_THRESHOLD
+            and supports_bestandsdelen(client)
+        ):
+            response = upload_document_in_parts(url, data, client)
+        elif isinstance(content, File):
+            op_suffix = client.operation_suffix_mapping["partial_update"]
+            response = call_drc(
+                client,
+                client.request,
+                url,
+                f"enkelvoudiginformatieobject{op_suffix}",
+                method="PATCH",
+                data=Base64JSONBody(data, "inhoud"),
+            )
+        else:
+            response = call_drc(
+                client,
+                client.partial_update,
+                "enkelvoudiginformatieobject",
+                data=data,
+                url=url,
+            )
         return factory(Document, response), True
-    except (ClientError, HTTPError) as exc:
+    except (ClientError, HTTPError, DocumentPartUploadError) as exc:
         logger.warning("Could not update {url}.".format(url=url), exc_info=True)
         return url, False
+    except (CircuitOpenError, requests.RequestException):
+        logger.warning(
+            "Could not reach the DRC to update {url}.".format(url=url), exc_info=True
+        )
+        return url, None
+
+
+def supports_bestandsdelen(client: Client) -> bool:
+    """
+    Checks if the DRC supports uploading documents in parts (bestandsdelen).
+    """
+    return any(
+        operation.get("operationId") == "bestandsdeel_update"
+        for methods in client.schema["paths"].values()
+        for operation in methods.values()
+        if isinstance(operation, dict)
+    )
+
+
+def upload_document_in_parts(url: str, data: dict, client: Client) -> dict:
+    """
+    Uploads the `inhoud` of a document in parts (bestandsdelen).
+
+    The DRC decides on the number and size of the parts when the upload is
+    started. The parts are uploaded in parallel and retried individually. The
+    DRC merges the parts when the document is unlocked.
+
+    An upload that was interrupted is resumed with the parts that were not yet
+    completed, as long as the document is still locked with the same lock and
+    the file has not changed since.
+    """
+    content = data["inhoud"]
+    cache_key = f"dowc:bestandsdelen:{url}:{data['lock']}"
+    fingerprint = (
+        f"{content.size}:"
+        f"{content.storage.get_modified_time(content.name).timestamp()}"
+    )
+
+    parts = []
+    if cache.get(cache_key) == fingerprint:
+        document = call_drc(
+            client, client.retrieve, "enkelvoudiginformatieobject", url=url
+        )
+        parts = document.get("bestandsdelen", [])
+
+    if not parts:
+        document = call_drc(
+            client,
+            client.partial_update,
+            "enkelvoudiginformatieobject",
+            data={**data, "inhoud": None, "bestandsomvang": content.size},
+            url=url,
+        )
+        parts = document["bestandsdelen"]
+        cache.set(cache_key, fingerprint, timeout=60 * 60 * 24)
+
+    # Parts are uploaded in order of their volgnummer, so the offset of a part
+    # is the sum of the sizes of the parts before it.
+    offset = 0
+    pending = []
+    for part in sorted(parts, key=lambda part: part["volgnummer"]):
+        if not part["voltooid"]:
+            pending.append((part, offset))
+        offset += part["omvang"]
+
+    with parallel(max_workers=settings.DRC_UPLOAD_PART_WORKERS) as executor:
+        futures = [
+            executor.submit(upload_document_part, part, offset, data, client)
+            for part, offset in pending
+        ]
+    for future in futures:
+        future.result()
+
+    cache.delete(cache_key)
+    return call_drc(client, client.retrieve, "enkelvoudiginformatieobject", url=url)
+
+
+def upload_document_part(part: dict, offset: int, data: dict, client: Client) -> None:
+    """
+    Uploads a single part (bestandsdeel) of a document.
+
+    Transient errors are retried up to `DRC_UPLOAD_PART_RETRIES` times through
+    `call_drc`. A `DocumentPartUploadError` is raised if the DRC refuses the
+    part.
+    """
+    body = MultipartFileRangeBody(
+        {"lock": data["lock"], "inhoud": data["inhoud"]},
+        "inhoud",
+        offset=offset,
+        size=part["omvang"],
+    )
+    try:
+        call_drc(
+            client,
+            client.request,
+            part["url"],
+            "bestandsdeel_update",
+            method="PUT",
+            data=body,
+            headers={"Content-Type": body.content_type},
+            retries=settings.DRC_UPLOAD_PART_RETRIES,
+        )
+    except (ClientError, HTTPError) as exc:
+        raise DocumentPartUploadError(
+            "Uploading part {volgnummer} of {url} failed.".format(
+                volgnummer=part["volgnummer"], url=part["url"]
+            )
+        ) from exc
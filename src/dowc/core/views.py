@@ -1,28 +1,79 @@
+import hashlib
 import os
-from typing import Optional
+import re
+import uuid
+from typing import Optional, Tuple
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from django.views.decorators.csrf import csrf_exempt
 
+from django_sendfile import sendfile
 from djangodav import views
+from djangodav.responses import HttpResponseMultiStatus
+from lxml import etree
 from rest_framework.permissions import IsAuthenticated
 
 from dowc.core.authentication import WebDavADFSAuthentication
-from dowc.core.utils import clean_token
 
-from .locks import WebDAVLock
+from .constants import DOCUMENTFILE_CACHE_KEY
+from .files import read_file_range
+from .locks import get_lock_class
 from .mixins import WebDAVRestViewMixin
-from .models import CoreConfig, DocumentFile, DocumentLock
+from .models import CoreConfig, DocumentFile, get_propfind_version_key
 from .permissions import PathIsAllowed, TokenIsValid, UserOwnsDocumentFile
 from .resource import WebDavResource
 
+# Methods that change the resources in the folder of a documentfile.
+PROPFIND_INVALIDATING_METHODS = ["PUT", "DELETE", "MOVE", "COPY", "MKCOL", "PROPPATCH"]
+
+PROPFIND_CACHE_KEY = "dowc:propfind:{version}:{key}"
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def get_byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Returns the first and last byte of the single byte range in a Range header.
+
+    Returns `None` if the whole file should be sent, i.e. if the header is
+    invalid or requests multiple ranges. Raises a `ValueError` if the range
+    can't be satisfied.
+
+    """
+    match = RANGE_RE.match(header.replace(" ", ""))
+    if not match or not any(match.groups()):
+        return None
+    if size == 0:
+        raise ValueError("The file is empty.")
+
+    first, last = match.groups()
+    if not first:
+        # A suffix range: the last bytes of the file.
+        if int(last) == 0:
+            raise ValueError("Empty suffix range.")
+        return max(size - int(last), 0), size - 1
+
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise ValueError("Range starts after the end of the file.")
+    return first, min(int(last), size - 1) if last else size - 1
+
 
 class WebDavView(WebDAVRestViewMixin, views.DavView):
     resource_class = WebDavResource
-    lock_class = WebDAVLock
+    _object: Optional[DocumentFile] = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.lock_class = get_lock_class()
         if CoreConfig.get_solo().webdav_adfs_authentication:
             self.authentication_classes = (WebDavADFSAuthentication,)
             self.permission_classes = (
@@ -38,11 +89,190 @@ class WebDavView(WebDAVRestViewMixin, views.DavView):
                 TokenIsValid,
             )
 
-    def get_object(self) -> Optional[DocumentFile]:
-        return get_object_or_404(
-            DocumentFile.objects.select_related("user"), uuid=self.kwargs["uuid"]
+    def get_object(self) -> DocumentFile:
+        """
+        Returns the documentfile of the request.
+
+        The permissions and the handlers all need the documentfile, so it is
+        retrieved once per request and cached for a short while, because
+        WebDAV clients send many requests for the same document.
+
+        """
+        if self._object is None:
+            cache_key = DOCUMENTFILE_CACHE_KEY.format(uuid=self.kwargs["uuid"])
+            self._object = cache.get(cache_key)
+            if self._object is None:
+                self._object = get_object_or_404(
+                    DocumentFile.objects.select_related("user"),
+                    uuid=self.kwargs["uuid"],
+                )
+                if settings.WEBDAV_OBJECT_CACHE_TIMEOUT:
+                    cache.set(
+                        cache_key,
+                        self._object,
+                        timeout=settings.WEBDAV_OBJECT_CACHE_TIMEOUT,
+                    )
+        return self._object
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        response = super().dispatch(request, *args, **kwargs)
+        if request.method.upper() in PROPFIND_INVALIDATING_METHODS and self._object:
+            self.clear_propfind_cache()
+        return response
+
+    def clear_propfind_cache(self):
+        """
+        Makes sure the cached PROPFIND responses of the folder of the
+        documentfile aren't used after a resource in it changed.
+
+        """
+        cache.set(
+            get_propfind_version_key(self.get_object()),
+            uuid.uuid4().hex,
+            timeout=settings.WEBDAV_PROPFIND_CACHE_TIMEOUT,
+        )
+
+    def get_propfind_cache_key(self, xbody) -> Optional[str]:
+        """
+        Returns the cache key of the PROPFIND response of the resource.
+
+        The key changes when the resource is modified on disk and whenever a
+        resource in the folder of the documentfile is changed over WebDAV.
+
+        """
+        try:
+            stat = os.stat(self.resource.get_abs_path())
+        except OSError:
+            return None
+
+        # The responses of an expired version are never used again, so the
+        # version only has to outlive the responses cached with it.
+        version_key = get_propfind_version_key(self.get_object())
+        cache.add(
+            version_key,
+            uuid.uuid4().hex,
+            timeout=settings.WEBDAV_PROPFIND_CACHE_TIMEOUT,
+        )
+        version = cache.get(version_key)
+        if version is None:
+            return None
+
+        key = hashlib.sha256()
+        for part in [
+            self.base_url,
+            self.resource.get_path(),
+            str(self.get_depth()),
+            str(stat.st_mtime_ns),
+            etree.tostring(xbody("/*")[0]).decode() if xbody else "",
+        ]:
+            key.update(part.encode())
+            key.update(b"\0")
+        return PROPFIND_CACHE_KEY.format(version=version, key=key.hexdigest())
+
+    def propfind(self, request, path, xbody=None, *args, **kwargs):
+        if not settings.WEBDAV_PROPFIND_CACHE_TIMEOUT or not self.has_access(
+            self.resource, "read"
+        ):
+            return super().propfind(request, path, xbody, *args, **kwargs)
+
+        cache_key = self.get_propfind_cache_key(xbody)
+        if cache_key and (content := cache.get(cache_key)) is not None:
+            return self.build_cached_xml_response(content)
+
+        response = super().propfind(request, path, xbody, *args, **kwargs)
+        if cache_key and response.status_code == 207:
+            cache.set(
+                cache_key,
+                response.content,
+                timeout=settings.WEBDAV_PROPFIND_CACHE_TIMEOUT,
+            )
+        return response
+
+    def build_cached_xml_response(self, content: bytes) -> HttpResponse:
+        return HttpResponseMultiStatus(
+            content, content_type=f'text/xml; charset="{self.xml_encoding}"'
         )
 
+    def get(self, request, path, head=False, *args, **kwargs):
+        if path.endswith("/") or not self.resource.is_object:
+            return super().get(request, path, head, *args, **kwargs)
+        if not self.has_access(self.resource, "read"):
+            return self.no_access()
+
+        abs_path = self.resource.get_abs_path()
+        stat = os.stat(abs_path)
+        etag = quote_etag(self.resource.getetag)
+        last_modified = int(stat.st_mtime)
+        headers = {
+            "ETag": etag,
+            "Last-Modified": http_date(last_modified),
+            "Accept-Ranges": "bytes",
+        }
+
+        # Answers If-None-Match and If-Modified-Since with a 304.
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = self.get_file_response(
+                request, abs_path, stat.st_size, head, etag, last_modified
+            )
+
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    def get_file_response(
+        self,
+        request,
+        abs_path: str,
+        size: int,
+        head: bool,
+        etag: str,
+        last_modified: int,
+    ) -> HttpResponse:
+        content_type = self.resource.content_type or "application/octet-stream"
+
+        if settings.WEBDAV_SENDFILE_ENABLED and not head:
+            # The web server handles Range requests itself.
+            return sendfile(
+                request, abs_path, attachment_filename=False, mimetype=content_type
+            )
+
+        byte_range = None
+        range_header = request.headers.get("Range")
+        if_range = request.headers.get("If-Range")
+        if range_header and (
+            not if_range
+            or if_range == etag
+            or parse_http_date_safe(if_range) == last_modified
+        ):
+            try:
+                byte_range = get_byte_range(range_header, size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = f"bytes */{size}"
+                return response
+
+        if head:
+            response = HttpResponse(content_type=content_type)
+            response["Content-Length"] = size
+            return response
+
+        if byte_range:
+            first, last = byte_range
+            response = StreamingHttpResponse(
+                read_file_range(abs_path, first, last - first + 1),
+                status=206,
+                content_type=content_type,
+            )
+            response["Content-Range"] = f"bytes {first}-{last}/{size}"
+            response["Content-Length"] = last - first + 1
+            return response
+
+        return FileResponse(open(abs_path, "rb"), content_type=content_type)
+
     def put(self, request, path, *args, **kwargs):
         # Update relevant model fields if name is changed:
         docfile = self.get_object()
@@ -50,16 +280,24 @@ class WebDavView(WebDAVRestViewMixin, views.DavView):
             docfile.document.name = path
             docfile.filename = os.path.basename(path)
             docfile.changed_name = True
-            docfile.save()
+            # The documentfile may come from the cache, so only the changed
+            # fields are saved.
+            docfile.save(update_fields=["document", "filename", "changed_name"])
 
+        # The resource is replaced if the document is created.
+        resource = self.resource
         response = super().put(request, path, *args, **kwargs)
+        if resource.digest:
+            DocumentFile.objects.for_documentfile(docfile).update(
+                document_digest=resource.digest,
+                document_digest_size=resource.stat.st_size,
+                document_digest_mtime_ns=resource.stat.st_mtime_ns,
+            )
         return response
 
     def lock(self, request, path, *args, **kwargs):
         if token_header := request.headers.get("If"):
-            token = clean_token(token_header)
-            locks = DocumentLock.objects.filter(token=token)
-            if locks.exists():
+            if self.lock_class(self.resource).refresh(token_header):
                 return HttpResponse(status=200)
             return HttpResponse(status=400)
         else:
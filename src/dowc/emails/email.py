@@ -1,11 +1,16 @@
+import json
 import logging
-from typing import List
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
 
 from django.conf import settings
 from django.core.mail import send_mass_mail
 from django.template.loader import get_template
 from django.utils.translation import gettext_lazy as _
 
+from django_redis import get_redis_connection
+
 from .data import EmailData
 
 logger = logging.getLogger(__name__)
@@ -13,25 +18,126 @@ logger = logging.getLogger(__name__)
 TEMPLATE_PATH = "emails/base.txt"
 SUBJECT = _("We saved your unfinished document: {filename}")
 
+MULTIPLE_TEMPLATE_PATH = "emails/multiple.txt"
+MULTIPLE_SUBJECT = _("We saved your unfinished documents")
 
-def send_emails(email_data: List[EmailData]) -> int:
-    email_template = get_template(TEMPLATE_PATH)
-    emails = []
+EMAIL_QUEUE_KEY = "dowc:emails"
+
+Message = Tuple[str, str, str, List[str]]
+
+_collected: Optional[List[EmailData]] = None
+_collect_lock = threading.Lock()
+
+
+@contextmanager
+def collect_emails():
+    """
+    Collects the emails that are sent within the block and sends them at
+    the end, so users with several documents get a single email.
+
+    Collection is process wide, so emails sent from worker threads are
+    collected as well.
+
+    """
+    global _collected
+
+    with _collect_lock:
+        if _collected is not None:
+            # Already collecting, the outer block sends the emails.
+            nested = True
+        else:
+            nested = False
+            _collected = []
+
+    if nested:
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        with _collect_lock:
+            email_data, _collected = _collected, None
+        if email_data:
+            send_emails(email_data)
+
+
+def render_messages(email_data: List[EmailData]) -> List[Message]:
+    """
+    Renders one message per user, listing all documents of that user.
+
+    """
+    per_user: Dict[int, List[EmailData]] = {}
     for email in email_data:
         if email.user.email:
-            email_message = email_template.render(email.as_context())
-            emails.append(
-                (
-                    SUBJECT.format(filename=email.filename),
-                    email_message,
-                    settings.DEFAULT_FROM_EMAIL,
-                    [email.user.email],
-                )
-            )
+            per_user.setdefault(email.user.pk, []).append(email)
         else:
             logger.warning(
                 f"User with username {email.user.username} has no known email address."
             )
 
-    results = send_mass_mail(emails, fail_silently=False)
+    messages = []
+    for emails in per_user.values():
+        if len(emails) == 1:
+            subject = SUBJECT.format(filename=emails[0].filename)
+            body = get_template(TEMPLATE_PATH).render(emails[0].as_context())
+        else:
+            subject = str(MULTIPLE_SUBJECT)
+            body = get_template(MULTIPLE_TEMPLATE_PATH).render(
+                {"name": emails[0].name, "documents": emails}
+            )
+        messages.append(
+            (subject, body, settings.DEFAULT_FROM_EMAIL, [emails[0].user.email])
+        )
+    return messages
+
+
+def send_emails(email_data: List[EmailData]) -> int:
+    with _collect_lock:
+        if _collected is not None:
+            _collected.extend(email_data)
+            return 0
+
+    messages = render_messages(email_data)
+    if settings.EMAIL_QUEUE_ENABLED:
+        return queue_messages(messages)
+
+    # All messages are sent over a single connection.
+    results = send_mass_mail(messages, fail_silently=False)
     return results
+
+
+def queue_messages(messages: List[Message]) -> int:
+    """
+    Queues rendered messages in Redis, to be sent by `send_queued_emails`.
+
+    """
+    if messages:
+        get_redis_connection("default").rpush(
+            EMAIL_QUEUE_KEY, *[json.dumps(message) for message in messages]
+        )
+    return len(messages)
+
+
+def send_queued_emails(batch_size: int = 100) -> int:
+    """
+    Sends the queued messages in batches over a single connection per batch.
+
+    """
+    redis = get_redis_connection("default")
+    sent = 0
+    while True:
+        pipe = redis.pipeline()
+        pipe.lrange(EMAIL_QUEUE_KEY, 0, batch_size - 1)
+        pipe.ltrim(EMAIL_QUEUE_KEY, batch_size, -1)
+        raw_messages, _trimmed = pipe.execute()
+        if not raw_messages:
+            return sent
+
+        messages = [tuple(json.loads(message)) for message in raw_messages]
+        try:
+            sent += send_mass_mail(messages, fail_silently=False)
+        except Exception:
+            # Put the batch back in front of the queue for the next run.
+            redis.lpush(EMAIL_QUEUE_KEY, *reversed(raw_messages))
+            raise
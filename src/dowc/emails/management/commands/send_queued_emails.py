@@ -0,0 +1,19 @@
+from django.core.management import BaseCommand
+
+from dowc.emails.email import send_queued_emails
+
+
+class Command(BaseCommand):
+    help = "Send the emails that were queued in Redis."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of emails that are sent over a single connection.",
+        )
+
+    def handle(self, **options):
+        sent = send_queued_emails(batch_size=options["batch_size"])
+        self.stdout.write(f"Sent {sent} queued email(s).")
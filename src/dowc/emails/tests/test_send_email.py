@@ -1,12 +1,14 @@
-from unittest.mock import patch
+import json
+from unittest.mock import MagicMock, patch
 
 from django.core import mail
-from django.test import TestCase
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 from django.utils.translation import gettext_lazy as _
 
 from dowc.accounts.tests.factories import UserFactory
 
-from ..email import send_emails
+from ..email import EMAIL_QUEUE_KEY, collect_emails, send_emails
 from .factories import EmailDataFactory
 
 
@@ -73,3 +75,78 @@ class SendEmailTests(TestCase):
         mock_logger.assert_called_with(
             f"User with username {user.username} has no known email address."
         )
+
+    def test_send_email_multiple_documents(self):
+        user = UserFactory.create()
+        email_data = EmailDataFactory.create_batch(2, user=user)
+        other_email_data = EmailDataFactory.create()
+
+        result = send_emails(email_data + [other_email_data])
+
+        self.assertEqual(result, 2)
+        self.assertEqual(len(mail.outbox), 2)
+        email = mail.outbox[0]
+        self.assertEqual(email.subject, _("We saved your unfinished documents"))
+        self.assertEqual(
+            email.body,
+            "Beste {name},\n\n".format(name=user.username)
+            + "Uw openstaande documenten zijn gesloten en de wijzigingen zijn doorgevoerd.\n\n"
+            + "".join(f"- {data.filename}: {data.info_url}\n" for data in email_data)
+            + "\nMet vriendelijke groeten,\n\nFunctioneel Beheer Gemeente Utrecht",
+        )
+        self.assertEqual(email.to, [user.email])
+        self.assertEqual(mail.outbox[1].to, [other_email_data.user.email])
+
+    def test_collect_emails(self):
+        user = UserFactory.create()
+
+        with collect_emails():
+            with collect_emails():
+                send_emails([EmailDataFactory.create(user=user)])
+            send_emails([EmailDataFactory.create(user=user)])
+            self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(
+            mail.outbox[0].subject, _("We saved your unfinished documents")
+        )
+
+
+class QueuedEmailTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.queue = []
+
+        redis = MagicMock()
+        redis.rpush.side_effect = lambda key, *values: self.queue.extend(values)
+
+        def execute():
+            batch = self.queue[:2]
+            del self.queue[:2]
+            return batch, True
+
+        redis.pipeline.return_value.execute.side_effect = execute
+
+        patcher = patch("dowc.emails.email.get_redis_connection", return_value=redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(EMAIL_QUEUE_ENABLED=True)
+    def test_send_queued_emails(self):
+        email_data = EmailDataFactory.create_batch(3)
+
+        result = send_emails(email_data)
+
+        self.assertEqual(result, 3)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(len(self.queue), 3)
+        self.assertEqual(json.loads(self.queue[0])[3], [email_data[0].user.email])
+
+        call_command("send_queued_emails", batch_size=2)
+
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(self.queue, [])
+        self.assertEqual(
+            [email.to for email in mail.outbox],
+            [[data.user.email] for data in email_data],
+        )